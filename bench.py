@@ -0,0 +1,706 @@
+# bench.py
+# 回答フローのオフライン負荷試験・ベンチマーク（Discord に接続しない）
+#
+#   python bench.py --users 200                # N人が同時に全問回答
+#   python bench.py --users 200 --rest-ms 80   # Discord REST の往復を 80ms と仮定
+#   python bench.py --users 200 --pool 200     # 予備ルームを200件用意した状態で
+#   python bench.py --micro-only --json out.json
+#   python bench.py --storage 100000            # 回答の保存形式（旧: 1回答1行 / 新: 回答ベクトル）の比較
+#   python bench.py --users 200 --backend both  # 同じ負荷を STORAGE_BACKEND=sqlite / memory で流して比べる
+#
+# bot.py の on_interaction / create_or_open_room / match を偽の Interaction・チャンネルで直接呼び、
+# クリックごとの処理時間・ACK までの時間（3秒制限）・スループット・DB ファイルの増分を出す。
+# 続けて db.py の公開関数を1つずつ計測する（--json で結果を保存して変更前後を比べる）。
+
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import discord
+
+INTERACTION_DEADLINE = 3.0  # Discord の初回応答期限（秒）
+
+
+# =========================================================
+# 集計
+# =========================================================
+def percentile(sorted_samples: List[float], q: float) -> float:
+    """nearest-rank（sorted_samples は昇順）"""
+    if not sorted_samples:
+        return 0.0
+    k = max(0, min(len(sorted_samples) - 1, math.ceil(q * len(sorted_samples)) - 1))
+    return sorted_samples[k]
+
+
+def summarize(samples: List[float], wall: Optional[float] = None) -> dict:
+    s = sorted(samples)
+    total = sum(s)
+    out = {
+        "count": len(s),
+        "mean_ms": total / len(s) * 1000 if s else 0.0,
+        "p50_ms": percentile(s, 0.50) * 1000,
+        "p95_ms": percentile(s, 0.95) * 1000,
+        "p99_ms": percentile(s, 0.99) * 1000,
+        "max_ms": (s[-1] if s else 0.0) * 1000,
+    }
+    # 逐次実行なら合計時間、並行実行なら実時間で割る
+    elapsed = wall if wall is not None else total
+    out["ops_per_sec"] = len(s) / elapsed if elapsed > 0 else 0.0
+    return out
+
+
+def print_table(title: str, rows: Dict[str, dict]) -> None:
+    print(f"\n== {title}")
+    print(f"{'name':<28} {'count':>7} {'ops/s':>10} {'mean':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}  (ms)")
+    for name, r in rows.items():
+        print(
+            f"{name:<28} {r['count']:>7} {r['ops_per_sec']:>10.1f} {r['mean_ms']:>8.2f} {r['p50_ms']:>8.2f}"
+            f" {r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['max_ms']:>8.2f}"
+        )
+
+
+def db_files_size(path: str) -> Dict[str, int]:
+    sizes = {}
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            sizes["db" + suffix.replace("-", "_")] = os.path.getsize(path + suffix)
+        except OSError:
+            sizes["db" + suffix.replace("-", "_")] = 0
+    return sizes
+
+
+def dir_size(path: str) -> int:
+    try:
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    except OSError:
+        return 0
+
+
+# =========================================================
+# 偽の Discord オブジェクト（bot.py が使う属性・メソッドだけ）
+# =========================================================
+_ids = itertools.count(10**15)
+
+
+class FakeREST:
+    """REST 呼び出しの代わりに rest_ms だけ待つ（0 なら待たずにイベントループへ1回譲る）"""
+
+    def __init__(self, rest_ms: float):
+        self.delay = rest_ms / 1000.0
+        self.calls = 0
+
+    async def call(self) -> None:
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+
+
+class FakeHTTPResponse:
+    """discord.HTTPException に渡す最低限の応答"""
+
+    def __init__(self, status: int):
+        self.status = status
+        self.reason = ""
+
+
+class FakeMessage:
+    def __init__(self, rest: FakeREST, channel: "FakeChannel", content=None, embed=None, view=None):
+        self._rest = rest
+        self.id = next(_ids)
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+        self.view = view
+
+    async def edit(self, **fields):
+        await self._rest.call()
+        for k, v in fields.items():
+            setattr(self, k, v)
+        return self
+
+
+class FakeChannel(discord.TextChannel):
+    """isinstance(ch, discord.TextChannel) を通すためのサブクラス（親の __init__ は呼ばない）"""
+
+    def __init__(self, rest: FakeREST, guild: "FakeGuild", name: str, topic: str):
+        self._rest = rest
+        self.id = next(_ids)
+        self.guild = guild
+        self.name = name
+        self.topic = topic
+        self.messages: Dict[int, FakeMessage] = {}
+        self.question_message: Optional[FakeMessage] = None
+
+    async def send(self, content=None, *, embed=None, view=None, **kw):
+        await self._rest.call()
+        msg = FakeMessage(self._rest, self, content, embed, view)
+        self.messages[msg.id] = msg
+        if view is not None:
+            self.question_message = msg
+        return msg
+
+    def get_partial_message(self, message_id: int):
+        msg = self.messages.get(message_id)
+        if msg is None:
+            msg = self.messages[message_id] = FakeMessage(self._rest, self)
+            msg.id = message_id
+        return msg
+
+    async def edit(self, *, name=None, topic=None, overwrites=None, reason=None, **kw):
+        await self._rest.call()
+        if self.id not in self.guild.channels:
+            raise discord.NotFound(FakeHTTPResponse(404), "Unknown Channel")
+        if name is not None:
+            self.name = name
+        if topic is not None:
+            self.topic = topic
+        return self
+
+    async def delete(self, *, reason=None):
+        await self._rest.call()
+        self.guild.channels.pop(self.id, None)
+
+
+class FakeMember(discord.Member):
+    def __init__(self, guild: "FakeGuild", user_id: int, name: str):
+        self.guild = guild
+        self._fake_id = user_id
+        self._fake_name = name
+
+    @property
+    def id(self):
+        return self._fake_id
+
+    @property
+    def display_name(self):
+        return self._fake_name
+
+    @property
+    def mention(self):
+        return f"<@{self._fake_id}>"
+
+    @property
+    def roles(self):
+        return []
+
+    def __hash__(self):
+        return hash(self._fake_id)
+
+    def __eq__(self, other):
+        return self is other
+
+
+class FakeGuild:
+    def __init__(self, rest: FakeREST, guild_id: int = 1):
+        self._rest = rest
+        self.id = guild_id
+        self.me = object()
+        self.default_role = object()
+        self.channels: Dict[int, FakeChannel] = {}
+
+    def get_channel(self, channel_id: int):
+        return self.channels.get(channel_id)
+
+    @property
+    def text_channels(self):
+        return list(self.channels.values())
+
+    async def create_text_channel(self, name: str, *, topic: str = None, overwrites=None, **kw):
+        await self._rest.call()
+        ch = FakeChannel(self._rest, self, name, topic)
+        self.channels[ch.id] = ch
+        return ch
+
+
+class FakeResponse:
+    def __init__(self, interaction: "FakeInteraction"):
+        self._interaction = interaction
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def _ack(self):
+        if self._done:
+            raise discord.InteractionResponded(self._interaction)
+        self._done = True
+        self._interaction.acked_after = time.perf_counter() - self._interaction.created
+        await self._interaction.rest.call()
+
+    async def defer(self, *, ephemeral: bool = False, thinking: bool = False):
+        await self._ack()
+
+    async def send_message(self, content=None, *, embed=None, ephemeral: bool = False, view=None, **kw):
+        await self._ack()
+        self._interaction.replies.append(content)
+
+
+class FakeFollowup:
+    def __init__(self, interaction: "FakeInteraction"):
+        self._interaction = interaction
+
+    async def send(self, content=None, *, embed=None, ephemeral: bool = False, **kw):
+        await self._interaction.rest.call()
+        self._interaction.replies.append(content)
+
+
+class FakeInteraction:
+    def __init__(self, rest: FakeREST, guild: FakeGuild, user: FakeMember, channel=None,
+                 custom_id: Optional[str] = None, message: Optional[FakeMessage] = None):
+        self.rest = rest
+        self.id = next(_ids)
+        self.type = discord.InteractionType.component if custom_id else discord.InteractionType.application_command
+        self.data = {"custom_id": custom_id} if custom_id else {}
+        self.guild = guild
+        self.user = user
+        self.channel = channel
+        self.channel_id = channel.id if channel is not None else None
+        self.message = message
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.replies: List[Optional[str]] = []
+        self.created = time.perf_counter()
+        self.acked_after: Optional[float] = None
+
+    async def edit_original_response(self, **fields):
+        await self.rest.call()
+        if self.message is None:
+            raise discord.ClientException("no original response")
+        return await self.message.edit(**fields)
+
+
+# =========================================================
+# 負荷試験（N人が同時に 全問回答 → /match）
+# =========================================================
+async def run_load(bot_module, users: int, rest_ms: float, think_ms: float, seed: int, pool: int = 0) -> dict:
+    import db
+    from room_pool import SPARE_TOPIC
+    rest = FakeREST(rest_ms)
+    guild = FakeGuild(rest)
+
+    # 予備ルームを pool 件だけ先に作っておく（補充タスクは動かさない）
+    spares = [FakeChannel(rest, guild, "match-spare", SPARE_TOPIC) for _ in range(pool)]
+    for ch in spares:
+        guild.channels[ch.id] = ch
+    bot_module.room_pool.replace_guild(guild.id, [ch.id for ch in spares])
+    pool_before = dict(bot_module.room_pool.stats)
+    rng = random.Random(seed)
+    n_questions = len(bot_module.BANK)
+
+    samples: Dict[str, List[float]] = {"create_or_open_room": [], "on_interaction": [], "match": []}
+    acks: List[float] = []
+    errors: List[str] = []
+
+    async def one_user(i: int):
+        user_id = 10**12 + i
+        member = FakeMember(guild, user_id, f"bench{i}")
+
+        inter = FakeInteraction(rest, guild, member)
+        t0 = time.perf_counter()
+        await bot_module.create_or_open_room(inter)
+        samples["create_or_open_room"].append(time.perf_counter() - t0)
+
+        ch = guild.get_channel(bot_module.room_registry.channel_of(guild.id, user_id))
+        if ch is None or ch.question_message is None:
+            errors.append(f"user {user_id}: room was not created")
+            return
+
+        for idx in range(n_questions):
+            if think_ms > 0:
+                await asyncio.sleep(rng.uniform(0.5, 1.5) * think_ms / 1000.0)
+            key = rng.choice("ABCDE")
+            inter = FakeInteraction(rest, guild, member, ch, f"ans:{user_id}:{idx}:{key}", ch.question_message)
+            t0 = time.perf_counter()
+            await bot_module.on_interaction(inter)
+            samples["on_interaction"].append(time.perf_counter() - t0)
+            if inter.acked_after is not None:
+                acks.append(inter.acked_after)
+            for r in inter.replies:
+                if r and r.startswith("⚠️"):
+                    errors.append(f"user {user_id} q{idx}: {r}")
+
+        inter = FakeInteraction(rest, guild, member, ch)
+        t0 = time.perf_counter()
+        await bot_module.match.callback(inter)
+        samples["match"].append(time.perf_counter() - t0)
+
+    size_before = db_files_size(db.DB_PATH)
+    t_start = time.perf_counter()
+    await asyncio.gather(*(one_user(i) for i in range(users)))
+    wall = time.perf_counter() - t_start
+    bot_module.room_closer.stop()
+    await asyncio.to_thread(db.flush)
+    size_after = db_files_size(db.DB_PATH)
+
+    completed = await asyncio.to_thread(db.get_user_counters)
+    rows = {name: summarize(s, wall) for name, s in samples.items()}
+    ack = summarize(acks, wall)
+    return {
+        "users": users,
+        "questions": n_questions,
+        "rest_ms": rest_ms,
+        "think_ms": think_ms,
+        "wall_sec": wall,
+        "clicks_per_sec": len(samples["on_interaction"]) / wall if wall > 0 else 0.0,
+        "handlers": rows,
+        "ack": ack,
+        "ack_over_deadline": sum(1 for a in acks if a >= INTERACTION_DEADLINE),
+        "rest_calls": rest.calls,
+        "completed_users": completed["completed"],
+        "room_pool": {
+            "size": pool,
+            **{k: bot_module.room_pool.stats[k] - pool_before[k] for k in ("claimed", "empty", "stale")},
+        },
+        "errors": errors[:20],
+        "error_count": len(errors),
+        "db_size_before": size_before,
+        "db_size_after": size_after,
+    }
+
+
+# =========================================================
+# db.py のマイクロベンチマーク
+# =========================================================
+def micro_cases(db, iterations: int) -> List[Tuple[str, Callable[[int], object], int]]:
+    """
+    (名前, fn(i), 回数)。上から順に流す（前のケースが作った行を後のケースが使う）
+    i ごとに別ユーザーにするので、キャッシュに当たるかどうかは実運用のクリックに近い
+    """
+    from question_bank import BANK
+    ids = BANK.ids
+    n = len(BANK)
+    base = 2 * 10**12
+    few = max(1, iterations // 100)
+
+    def uid(i: int) -> int:
+        return base + i
+
+    return [
+        ("set_state", lambda i: db.set_state(uid(i), 0), iterations),
+        ("get_state", lambda i: db.get_state(uid(i)), iterations),
+        ("get_or_create_order", lambda i: db.get_or_create_order(uid(i), ids), iterations),
+        ("record_answer", lambda i: db.record_answer(uid(i), 0, "A", ids), iterations),
+        ("save_answer", lambda i: db.save_answer(uid(i), ids[1], "B"), iterations),
+        ("load_answers", lambda i: db.load_answers(uid(i)), iterations),
+        ("get_profile", lambda i: db.get_profile(uid(i)), iterations),
+        ("set_message_id", lambda i: db.set_message_id(uid(i), i + 1), iterations),
+        ("get_message_id", lambda i: db.get_message_id(uid(i)), iterations),
+        ("reset_message_id", lambda i: db.reset_message_id(uid(i)), iterations),
+        ("reset_order", lambda i: db.reset_order(uid(i)), iterations),
+        ("start_session", lambda i: db.start_session(uid(i), ids), iterations),
+        ("get_user_counters", lambda i: db.get_user_counters(), iterations),
+        ("count_total_users", lambda i: db.count_total_users(), few),
+        ("count_completed_users", lambda i: db.count_completed_users(n), few),
+        ("save_room", lambda i: db.save_room(1, uid(i), uid(i)), iterations),
+        ("count_rooms", lambda i: db.count_rooms(1), few),
+        ("delete_room", lambda i: db.delete_room(uid(i)), iterations),
+        ("add_room_deadline", lambda i: db.add_room_deadline(uid(i), 1, uid(i), time.time() + 3600), iterations),
+        ("load_room_deadlines", lambda i: db.load_room_deadlines(), few),
+        ("delete_room_deadlines", lambda i: db.delete_room_deadlines([uid(i)]), iterations),
+        ("load_completed_profiles", lambda i: db.load_completed_profiles(), few),
+        ("check_user_counters", lambda i: db.check_user_counters(), few),
+        ("rebuild_profiles", lambda i: db.rebuild_profiles(), max(1, iterations // 1000)),
+        ("save_match_lists", lambda i: db.save_match_lists({uid(i): [(100, uid(i + 1)), (83, uid(i + 2))]}), iterations),
+        ("get_match_list", lambda i: db.get_match_list(uid(i)), iterations),
+        ("reset_user", lambda i: db.reset_user(uid(i)), iterations),
+    ]
+
+
+def run_micro(iterations: int, only: Optional[List[str]] = None) -> Dict[str, dict]:
+    import db
+    results = {}
+    for name, fn, count in micro_cases(db, iterations):
+        if only and name not in only:
+            continue
+        samples = []
+        for i in range(count):
+            t0 = time.perf_counter()
+            fn(i)
+            samples.append(time.perf_counter() - t0)
+        results[name] = summarize(samples)
+    db.flush()
+    return results
+
+
+# =========================================================
+# 回答の保存形式（1回答1行 → 1ユーザー1行の回答ベクトル）の比較
+# =========================================================
+def _file_pages(con: sqlite3.Connection) -> Dict[str, int]:
+    con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    page_size = con.execute("PRAGMA page_size").fetchone()[0]
+    pages = con.execute("PRAGMA page_count").fetchone()[0]
+    free = con.execute("PRAGMA freelist_count").fetchone()[0]
+    return {"file_bytes": pages * page_size, "used_bytes": (pages - free) * page_size}
+
+
+def _time_samples(fn: Callable[[int], object], keys: List[int]) -> dict:
+    samples = []
+    for key in keys:
+        t0 = time.perf_counter()
+        fn(key)
+        samples.append(time.perf_counter() - t0)
+    return summarize(samples)
+
+
+def run_storage(users: int, samples: int, seed: int) -> dict:
+    """
+    旧形式（answers: 1回答1行）で users 人分の DB を作り、マイグレーションで回答ベクトルに詰め直して
+    DB サイズ・1人分のプロフィール読み込み・全件走査の時間を比べる
+    """
+    import db
+    from profiles import aggregate
+    from question_bank import BANK
+
+    rng = random.Random(seed)
+    names = [name for name, _ in db.MIGRATIONS]
+    legacy_version = names.index("pack_answers")
+    letters = "ABCDE"
+
+    # 旧形式までのマイグレーションだけ流して、回答を1回答1行で入れる
+    con = sqlite3.connect(db.DB_PATH)
+    con.execute("PRAGMA journal_mode=WAL")
+    with con:
+        cur = con.cursor()
+        for _, fn in db.MIGRATIONS[:legacy_version]:
+            fn(cur)
+        cur.execute(f"PRAGMA user_version={legacy_version}")
+        cur.executemany("INSERT INTO user_state(user_id, idx) VALUES(?, ?)", [(u, len(BANK)) for u in range(1, users + 1)])
+        cur.executemany(
+            "INSERT INTO answers(user_id, question_id, answer) VALUES(?, ?, ?)",
+            ((u, q, rng.choice(letters)) for u in range(1, users + 1) for q in BANK.ids),
+        )
+
+    keys = [rng.randint(1, users) for _ in range(samples)]
+    report = {"users": users, "questions": len(BANK), "samples": samples}
+
+    def legacy_profile(uid: int):
+        rows = con.execute(
+            "SELECT question_id, answer FROM answers WHERE user_id=? ORDER BY question_id", (uid,)
+        ).fetchall()
+        return aggregate(rows)
+
+    def legacy_scan():
+        return con.execute("SELECT user_id, question_id, answer FROM answers ORDER BY user_id, question_id").fetchall()
+
+    report["legacy"] = {
+        **_file_pages(con),
+        "profile_load": _time_samples(legacy_profile, keys),
+        "full_scan_sec": _time_samples(lambda _: legacy_scan(), [0])["mean_ms"] / 1000,
+    }
+    con.close()
+
+    t0 = time.perf_counter()
+    db.init_db()
+    report["migration_sec"] = time.perf_counter() - t0
+
+    con = sqlite3.connect(db.DB_PATH)
+    before_vacuum = _file_pages(con)
+
+    def packed_scan():
+        return [(uid, db.unpack_answers(blob)) for uid, blob in con.execute("SELECT user_id, answers FROM answer_vectors")]
+
+    report["packed"] = {
+        "file_bytes_before_vacuum": before_vacuum["file_bytes"],
+        "profile_load": _time_samples(lambda uid: aggregate(db.load_answers(uid)), keys),
+        "full_scan_sec": _time_samples(lambda _: packed_scan(), [0])["mean_ms"] / 1000,
+    }
+    con.execute("VACUUM")
+    report["packed"].update(_file_pages(con))
+    con.close()
+    return report
+
+
+def print_storage(r: dict) -> None:
+    print(f"\n== answer storage: {r['users']} users x {r['questions']} questions")
+    mib = 1024 * 1024
+    for name in ("legacy", "packed"):
+        x = r[name]
+        load = x["profile_load"]
+        print(
+            f"{name:<7} db {x['used_bytes'] / mib:8.1f} MiB ({x['used_bytes'] / r['users']:6.0f} B/user)"
+            f"  profile load p50 {load['p50_ms']:.3f}ms p99 {load['p99_ms']:.3f}ms"
+            f"  full scan {x['full_scan_sec']:.2f}s"
+        )
+    print(f"migration {r['migration_sec']:.2f}s"
+          f" (file {r['packed']['file_bytes_before_vacuum'] / mib:.1f} MiB after init_db; the first init_db after v11 also runs VACUUM)")
+
+
+# =========================================================
+# 保存先（STORAGE_BACKEND）の比較
+# =========================================================
+def _strip_options(argv: List[str], names: Tuple[str, ...]) -> List[str]:
+    out, skip = [], False
+    for a in argv:
+        if skip:
+            skip = False
+        elif a in names:
+            skip = True
+        elif not a.startswith(tuple(n + "=" for n in names)):
+            out.append(a)
+    return out
+
+
+def run_backends(argv: List[str]) -> dict:
+    """同じ引数（同じ負荷・同じ seed）で backend ごとに別プロセスで流し、結果の JSON を集める"""
+    base = _strip_options(argv, ("--backend", "--json", "--db"))
+    reports = {}
+    with tempfile.TemporaryDirectory(prefix="bench-backends-") as tmp:
+        for backend in ("sqlite", "memory"):
+            out = os.path.join(tmp, f"{backend}.json")
+            print(f"\n##### STORAGE_BACKEND={backend}")
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), *base, "--backend", backend, "--json", out])
+            with open(out, encoding="utf-8") as f:
+                reports[backend] = json.load(f)
+            reports[backend]["exit_code"] = proc.returncode
+    return reports
+
+
+def print_backends(reports: Dict[str, dict]) -> None:
+    names = list(reports)
+    print(f"\n== backends ({' vs '.join(names)})")
+    print(f"{'':<34}" + "".join(f"{n:>14}" for n in names))
+
+    def row(label: str, get: Callable[[dict], Optional[float]], fmt: str = "{:>14.2f}") -> None:
+        values = []
+        for n in names:
+            try:
+                values.append(fmt.format(get(reports[n])))
+            except (KeyError, TypeError):
+                values.append(f"{'-':>14}")
+        print(f"{label:<34}" + "".join(values))
+
+    if all("load" in r for r in reports.values()):
+        row("load clicks/s", lambda r: r["load"]["clicks_per_sec"], "{:>14.1f}")
+        for h in ("create_or_open_room", "on_interaction", "match"):
+            row(f"{h} p50 ms", lambda r, h=h: r["load"]["handlers"][h]["p50_ms"])
+            row(f"{h} p99 ms", lambda r, h=h: r["load"]["handlers"][h]["p99_ms"])
+        row("ack p99 ms", lambda r: r["load"]["ack"]["p99_ms"])
+    micro = [name for name in next(iter(reports.values())).get("micro", {})]
+    for name in micro:
+        row(f"{name} ops/s", lambda r, name=name: r["micro"][name]["ops_per_sec"], "{:>14.0f}")
+    row("reopen ms", lambda r: r["reopen_ms"], "{:>14.1f}")
+    row("files KiB (db + wal + memstore)", lambda r: r["files_final"] / 1024, "{:>14.1f}")
+
+
+# =========================================================
+# main
+# =========================================================
+def main(argv: Optional[List[str]] = None) -> int:
+    p = argparse.ArgumentParser(description="回答フローのオフライン負荷試験")
+    p.add_argument("--users", type=int, default=100, help="同時に回答する人数")
+    p.add_argument("--rest-ms", type=float, default=0.0, help="Discord REST 1回あたりの仮の往復時間（ms）")
+    p.add_argument("--think-ms", type=float, default=0.0, help="クリック間の平均待ち（ms）")
+    p.add_argument("--pool", type=int, default=0, help="先に用意しておく予備ルーム数（0 なら全員その場で作成）")
+    p.add_argument("--iterations", type=int, default=2000, help="マイクロベンチの1関数あたりの回数")
+    p.add_argument("--micro", nargs="*", default=None, help="マイクロベンチを指定した関数だけにする")
+    p.add_argument("--load-only", action="store_true")
+    p.add_argument("--micro-only", action="store_true")
+    p.add_argument("--db", default=None, help="DB ファイル（既定: 一時ディレクトリに新規作成）")
+    p.add_argument("--write-mode", default=None, choices=["sync", "group", "async"], help="DB_WRITE_MODE")
+    p.add_argument("--backend", default=None, choices=["sqlite", "memory", "both"],
+                   help="STORAGE_BACKEND（both: 同じ負荷を両方で流して比べる）")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", default=None, help="結果を JSON で保存するパス")
+    p.add_argument("--storage", type=int, default=0, metavar="USERS",
+                   help="回答の保存形式の比較だけを USERS 人分で行う（例: 100000）")
+    p.add_argument("--storage-samples", type=int, default=2000, help="プロフィール読み込みを計る人数")
+    args = p.parse_args(argv)
+
+    if args.backend == "both":
+        reports = run_backends(list(sys.argv[1:] if argv is None else argv))
+        print_backends(reports)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(reports, f, ensure_ascii=False, indent=2)
+        return max(r["exit_code"] for r in reports.values())
+
+    # db.py は import 時に環境変数を読むので、import より先に決める
+    tmpdir = None
+    if args.db is None:
+        tmpdir = tempfile.TemporaryDirectory(prefix="bench-")
+        args.db = os.path.join(tmpdir.name, "bench.db")
+    os.environ["DB_PATH"] = args.db
+    if args.write_mode:
+        os.environ["DB_WRITE_MODE"] = args.write_mode
+    if args.backend:
+        os.environ["STORAGE_BACKEND"] = args.backend
+
+    if args.storage:
+        import db
+        report = {"db_path": args.db, "storage": run_storage(args.storage, args.storage_samples, args.seed)}
+        print_storage(report["storage"])
+        db.stop_writer()
+        db.close_all_connections()
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        if tmpdir is not None:
+            tmpdir.cleanup()
+        return 0
+
+    import bot as bot_module
+    import db
+
+    db.init_db()
+    bot_module.load_match_engine()
+
+    report = {"db_path": args.db, "write_mode": db.DB_WRITE_MODE, "backend": db.STORAGE_BACKEND}
+
+    if not args.micro_only:
+        load = asyncio.run(run_load(bot_module, args.users, args.rest_ms, args.think_ms, args.seed, args.pool))
+        report["load"] = load
+        print(f"\n== load: {load['users']} users x {load['questions']} questions"
+              f" (rest {load['rest_ms']}ms, think {load['think_ms']}ms, write mode {db.DB_WRITE_MODE},"
+              f" backend {db.STORAGE_BACKEND})")
+        print(f"wall {load['wall_sec']:.2f}s / {load['clicks_per_sec']:.1f} clicks/s"
+              f" / completed {load['completed_users']} / REST calls {load['rest_calls']}")
+        print(f"ack p99 {load['ack']['p99_ms']:.1f}ms / over {INTERACTION_DEADLINE:.0f}s: {load['ack_over_deadline']}")
+        rp = load["room_pool"]
+        print(f"rooms: {rp['claimed']} from pool of {rp['size']} / {rp['empty']} created on demand")
+        before, after = load["db_size_before"], load["db_size_after"]
+        grown = sum(after.values()) - sum(before.values())
+        print(f"db growth {grown / 1024:.1f} KiB ({grown / max(1, load['users']):.0f} B/user) {after}")
+        print_table("handlers (end to end)", load["handlers"])
+        if load["error_count"]:
+            print(f"\n!! {load['error_count']} errors")
+            for e in load["errors"]:
+                print("  ", e)
+
+    if not args.load_only:
+        micro = run_micro(args.iterations, args.micro)
+        report["micro"] = micro
+        print_table(f"db.py micro ({args.iterations} iterations, mode {db.DB_WRITE_MODE}, backend {db.STORAGE_BACKEND})", micro)
+
+    # 開き直し（memory はスナップショットの読み込み + ログの再生）
+    db.flush()
+    t0 = time.perf_counter()
+    db.init_db()
+    report["reopen_ms"] = (time.perf_counter() - t0) * 1000
+    report["store"] = db.storage_stats()
+
+    db.stop_writer()
+    db.close_all_connections()
+    report["db_size_final"] = db_files_size(args.db)
+    report["files_final"] = sum(report["db_size_final"].values()) + dir_size(db.MEMORY_STORE_DIR or args.db + ".memstore")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nsaved: {args.json}")
+
+    if tmpdir is not None:
+        tmpdir.cleanup()
+    return 1 if report.get("load", {}).get("error_count") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
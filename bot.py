@@ -3,34 +3,71 @@ import re
 import json
 import random
 import asyncio
-import sqlite3
-from collections import defaultdict, Counter
-from typing import List, Tuple, Optional
+import time
+from collections import Counter
+from typing import Awaitable, Callable, Dict, List, Sequence, Tuple, Optional
 
 import discord
 from discord.ext import commands
-
-from questions import QUESTIONS
+from discord.webhook.async_ import async_context
+
+import metrics
+from question_bank import BANK
+from matching import MatchEngine
+from rooms import RoomRegistry, room_owner_from_topic
+from room_pool import SPARE_TOPIC, RoomPool, is_spare_topic
+from scheduler import DeadlineScheduler
+from interaction_gate import InteractionGate
+from profiler import SamplingProfiler
+from join_batcher import JoinBatcher
+from profiles import STAR_MAP
 from db import (
     init_db,
-    get_state, set_state,
-    save_answer, load_answers, reset_user,
-    get_or_create_order, reset_order,
-    get_message_id, set_message_id, reset_message_id,
-    count_total_users, count_completed_users, count_inprogress_users,
+    record_answer, flush,
+    get_profile, load_completed_profiles, rebuild_profiles,
+    save_match_lists, replace_match_lists, get_match_list, load_match_lists,
+    start_session,
+    set_message_id,
+    get_user_counters, check_user_counters, count_rooms, get_answer_stats,
+    get_meta, set_meta,
+    find_stale_sessions, list_session_users, archive_sessions, incremental_vacuum, page_stats,
+    storage_stats, connection_stats, writer_stats, session_cache_stats,
+    save_room, delete_room, replace_guild_rooms,
+    add_room_deadline, delete_room_deadlines, load_room_deadlines,
+    DB_CALL_SECONDS,
 )
 
 # =========================================================
 # 環境変数
 # =========================================================
-TOKEN = os.environ["DISCORD_TOKEN"]
+TOKEN = os.environ.get("DISCORD_TOKEN", "")  # 起動時（__main__）だけ必須。bench.py などから import するときは不要
 GUILD_ID = int(os.environ.get("GUILD_ID", "0"))
 
 AUTO_CLOSE_SECONDS = int(os.environ.get("AUTO_CLOSE_SECONDS", "3600"))  # 既定: 60分
+AUTO_CLOSE_BATCH_SIZE = int(os.environ.get("AUTO_CLOSE_BATCH_SIZE", "5"))              # 1回にまとめて消すルーム数
+AUTO_CLOSE_BATCH_INTERVAL = float(os.environ.get("AUTO_CLOSE_BATCH_INTERVAL", "1.0"))  # バッチ間の待ち（秒）
 BOTADMIN_ROLE_ID = int(os.environ.get("BOTADMIN_ROLE_ID", "1469582684845113467"))        # /panel など
 ADMIN_ROLE_ID = int(os.environ.get("ADMIN_ROLE_ID", "1469624897587118081"))              # /sync /ping など
 ADMIN_CHANNEL_ID = int(os.environ.get("ADMIN_CHANNEL_ID", "1469593018637090897"))        # /logs などに使う（任意）
 WELCOME_CHANNEL_ID = int(os.environ.get("WELCOME_CHANNEL_ID", "1466960571688550537"))    # join時にパネルを置く場所
+WELCOME_BATCH_WINDOW = float(os.environ.get("WELCOME_BATCH_WINDOW", "5.0"))  # 参加をまとめる時間窓（秒）
+WELCOME_BATCH_MAX = int(os.environ.get("WELCOME_BATCH_MAX", "50"))           # 1通でメンションする最大人数
+
+ROOM_POOL_SIZE = int(os.environ.get("ROOM_POOL_SIZE", "10"))                          # ギルドごとの予備ルーム数（0 で無効）
+ROOM_POOL_REFILL_INTERVAL = float(os.environ.get("ROOM_POOL_REFILL_INTERVAL", "2.0"))  # 予備ルームを1件作るごとの待ち（秒）
+
+SESSION_TTL_DAYS = float(os.environ.get("SESSION_TTL_DAYS", "14"))              # これより長く進んでいない未完了セッションを整理
+COMPACT_INTERVAL_HOURS = float(os.environ.get("COMPACT_INTERVAL_HOURS", "6"))  # 整理の間隔（0 なら /compact だけ）
+COMPACT_BATCH_SIZE = int(os.environ.get("COMPACT_BATCH_SIZE", "500"))           # 1トランザクションで移すユーザー数
+COMPACT_BATCH_PAUSE = float(os.environ.get("COMPACT_BATCH_PAUSE", "0.2"))       # バッチ間の待ち（秒）
+COMPACT_VACUUM_PAGES = int(os.environ.get("COMPACT_VACUUM_PAGES", "1000"))      # incremental_vacuum 1回で返すページ数
+
+MATCH_REBUILD_WORKERS = int(os.environ.get("MATCH_REBUILD_WORKERS", "0"))  # 上位リスト一括作成のプロセス数（0 = CPU数）
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))            # 0 なら /metrics の HTTP は起動しない
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")                     # /profile の出力先
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))     # サンプリング間隔
+PROFILE_MAX_SECONDS = int(os.environ.get("PROFILE_MAX_SECONDS", "120"))
 
 # db.py のDBパスと合わせる（db.pyが "app.db" の想定）
 DB_PATH = os.environ.get("DB_PATH", "app.db")
@@ -51,6 +88,72 @@ intents = discord.Intents.default()
 intents.members = True  # on_member_join 用
 bot = commands.Bot(command_prefix="!", intents=intents)
 
+# /match 用：診断完了ユーザーのピック行列と各自の上位リスト（on_ready で一括ロード、完了/リセットで更新）
+match_engine = MatchEngine(list(BANK.categories), list_size=3)
+# 上位リストの更新と保存の順番をそろえる（後の更新が先に保存されて古いリストで上書きしないように）
+match_lists_lock = asyncio.Lock()
+
+# 回答クリックのユーザー別直列化・重複除去（interaction token の有効期限 15分 を TTL に）
+interaction_gate = InteractionGate(dedup_ttl=900)
+
+# 診断ルームの索引（on_ready で1回走査して作り、チャンネル作成/削除イベントで更新）
+room_registry = RoomRegistry()
+
+# =========================================================
+# 計測（db.py の関数は db.py 側で計測済み）
+# =========================================================
+HANDLER_SECONDS = metrics.REGISTRY.histogram("handler_seconds", "end-to-end handler latency", ["handler"])
+HANDLER_ERRORS = metrics.REGISTRY.counter("handler_errors_total", "handler exceptions", ["handler"])
+DISCORD_REQUEST_SECONDS = metrics.REGISTRY.histogram(
+    "discord_request_seconds", "Discord REST latency including rate-limit waits", ["route"]
+)
+DISCORD_REQUEST_ERRORS = metrics.REGISTRY.counter(
+    "discord_request_errors_total", "Discord REST errors", ["route", "status"]
+)
+
+
+def timed_handler(name: str):
+    return metrics.timed(HANDLER_SECONDS.labels(handler=name), HANDLER_ERRORS.labels(handler=name))
+
+
+def timed_discord_request(request):
+    """
+    HTTPClient.request / webhook アダプタの request を包む。
+    bot.py からの REST 呼び出し（interaction の応答・編集も含む）はすべてここを通る。
+    route はパスのテンプレート（"PATCH /channels/{channel_id}/messages/{message_id}" など）なので種類は増えない
+    """
+    async def wrapper(route, *args, **kw):
+        label = f"{route.method} {route.path}"
+        start = time.perf_counter()
+        try:
+            return await request(route, *args, **kw)
+        except discord.HTTPException as e:
+            DISCORD_REQUEST_ERRORS.labels(route=label, status=e.status).inc()
+            raise
+        finally:
+            DISCORD_REQUEST_SECONDS.labels(route=label).observe(time.perf_counter() - start)
+    return wrapper
+
+
+bot.http.request = timed_discord_request(bot.http.request)
+_webhook_adapter = async_context.get()
+_webhook_adapter.request = timed_discord_request(_webhook_adapter.request)
+
+metrics.REGISTRY.gauge("match_engine_users", "completed users loaded in the match engine").set_function(
+    lambda: len(match_engine)
+)
+metrics.REGISTRY.gauge("room_registry_rooms", "indexed diagnosis rooms").set_function(lambda: len(room_registry))
+metrics.REGISTRY.gauge("interaction_gate_active_users", "users with a click in progress").set_function(
+    lambda: interaction_gate.snapshot()["active_users"]
+)
+INTERACTION_GATE_CLICKS = metrics.REGISTRY.gauge(
+    "interaction_gate_clicks", "answer clicks by gate outcome (cumulative)", ["outcome"]
+)
+for _outcome in ("admitted", "duplicates", "stale", "db_skipped", "coalesced", "renders"):
+    INTERACTION_GATE_CLICKS.labels(outcome=_outcome).set_function(
+        lambda outcome=_outcome: interaction_gate.stats[outcome]
+    )
+
 # =========================================================
 # 共通ユーティリティ
 # =========================================================
@@ -72,15 +175,11 @@ def has_role_id(member: discord.Member, role_id: int) -> bool:
 def is_user_room(channel: discord.abc.GuildChannel, user_id: int) -> bool:
     """
     ルーム名が変わっても壊れないよう topic で判定
-    topic: "user:{id} ..."
+    topic: "user:{id} ..." から作った room_registry を引くだけ（O(1)）
     """
     if not isinstance(channel, discord.TextChannel):
         return False
-    return (channel.topic or "").startswith(f"user:{user_id}")
-
-# 5段階：A=★1〜E=★5
-STAR_MAP = {"A": 1, "B": 2, "C": 3, "D": 4, "E": 5}
-VALID_ANS = set(STAR_MAP.keys())
+    return room_registry.owner_of(channel.id) == user_id
 
 def stars(letter: str) -> str:
     n = STAR_MAP.get(letter, 3)
@@ -93,12 +192,6 @@ def progress_bar(current: int, total: int, width: int = 12) -> str:
     filled = max(0, min(width, filled))
     return "■" * filled + "□" * (width - filled)
 
-def q_by_id(qid: int) -> dict:
-    for q in QUESTIONS:
-        if q["id"] == qid:
-            return q
-    raise KeyError(f"question id not found: {qid}")
-
 # =========================================================
 # Embed（質問表示）
 # =========================================================
@@ -138,29 +231,11 @@ def build_profile(user_id: int):
     """
     picks:  dict(category -> "A".."E")  最頻回答
     meters: dict(category -> 1..5       平均星）
+    profiles テーブルの1行読み（集計は回答保存時に済んでいる）
     """
-    answers = load_answers(user_id)
-    qid_to_cat = {q["id"]: q.get("category") for q in QUESTIONS}
-
-    by_cat = defaultdict(list)
-    for qid, ans in answers:
-        cat = qid_to_cat.get(qid)
-        if cat and ans in VALID_ANS:
-            by_cat[cat].append(ans)
-
-    picks = {}
-    meters = {}
-    for cat, lst in by_cat.items():
-        c = Counter(lst)
-        picks[cat] = c.most_common(1)[0][0]
-        meters[cat] = int(round(sum(STAR_MAP[x] for x in lst) / len(lst)))
-
-    return picks, meters
-
-def categorized_result(user_id: int) -> str:
-    picks, meters = build_profile(user_id)
+    return get_profile(user_id)
 
-    CATS = ["game_style", "communication", "play_time", "distance", "money", "future"]
+def categorized_result(picks: dict) -> str:
 
     LABEL = {
         "game_style": "🎮 ゲームスタイル",
@@ -217,7 +292,7 @@ def categorized_result(user_id: int) -> str:
     }
 
     lines = []
-    for cat in CATS:
+    for cat in BANK.categories:
         if cat not in picks:
             continue
         letter = picks[cat]
@@ -268,59 +343,187 @@ class StartRoomView(discord.ui.View):
             return
         await create_or_open_room(interaction)
 
-async def post_panel(channel: discord.TextChannel):
+def build_panel_embed(recent_joins: int = 0) -> discord.Embed:
     embed = discord.Embed(
         title="🎮 診断スタート",
         description="下のボタンを押すと、あなた専用の診断ルームが作成されます。",
     )
-    await channel.send(embed=embed, view=StartRoomView())
+    if recent_joins:
+        embed.set_footer(text=f"🆕 直近 {recent_joins} 人が参加しました")
+    return embed
+
+async def post_panel(channel: discord.TextChannel, recent_joins: int = 0) -> discord.Message:
+    return await channel.send(embed=build_panel_embed(recent_joins), view=StartRoomView())
 
 # =========================================================
 # 固定メッセージ更新（質問Embed）
 # =========================================================
-async def upsert_question_message(channel: discord.TextChannel, user_id: int, idx: int, order: List[int]):
+# REST 呼び出しの節約状況（question_edits_total{outcome}）
+#   fetch_saved: 編集前の fetch_message を省いた回数（回答1件あたり1回）
+#   interaction_edit / partial_edit: 押されたメッセージを webhook で直接編集 / ID指定で編集
+#   not_found: 404 で送り直した回数
+QUESTION_EDITS = metrics.REGISTRY.counter("question_edits_total", "question message edits by outcome", ["outcome"])
+ANSWERS_ACCEPTED = metrics.REGISTRY.counter("answers_accepted_total", "answer clicks that advanced a session")
+
+async def edit_message_by_id(
+    channel: discord.TextChannel, mid: int, interaction: Optional[discord.Interaction] = None, **fields
+):
+    """
+    fetch せずに ID で直接編集する。
+    ボタンが付いていたメッセージそのものなら interaction 経由で編集（チャンネルのレート制限枠を使わない）
+    戻り値: 編集後のメッセージ / メッセージが消えていた（404）なら None
+    それ以外のエラーは呼び出し側へそのまま投げる
+    """
+    try:
+        if interaction is not None and interaction.message is not None and interaction.message.id == mid:
+            msg = await interaction.edit_original_response(**fields)
+            QUESTION_EDITS.labels(outcome="interaction_edit").inc()
+        else:
+            msg = await channel.get_partial_message(mid).edit(**fields)
+            QUESTION_EDITS.labels(outcome="partial_edit").inc()
+    except discord.NotFound:
+        QUESTION_EDITS.labels(outcome="not_found").inc()
+        return None
+    QUESTION_EDITS.labels(outcome="fetch_saved").inc()
+    return msg
+
+async def upsert_question_message(
+    channel: discord.TextChannel, user_id: int, idx: int, order: Sequence[int], mid: Optional[int],
+    interaction: Optional[discord.Interaction] = None,
+):
+    """
+    mid: 現在の固定メッセージID（呼び出し側が取得済みのものを渡す。無ければ新規送信）
+    """
     qid = order[idx]
-    q = q_by_id(qid)
+    q = BANK.question(qid)
 
     embed = build_question_embed(idx, len(order), q)
     view = AnswerView(user_id, idx)
 
-    mid = await asyncio.to_thread(get_message_id, user_id)
-
-    if mid is None:
-        msg = await channel.send(embed=embed, view=view)
-        await asyncio.to_thread(set_message_id, user_id, msg.id)
-        return msg
+    if mid is not None:
+        msg = await edit_message_by_id(channel, mid, interaction, embed=embed, view=view)
+        if msg is not None:
+            return msg
 
-    try:
-        msg = await channel.fetch_message(mid)
-        await msg.edit(embed=embed, view=view)
-        return msg
-    except Exception:
-        msg = await channel.send(embed=embed, view=view)
-        await asyncio.to_thread(set_message_id, user_id, msg.id)
-        return msg
+    msg = await channel.send(embed=embed, view=view)
+    await asyncio.to_thread(set_message_id, user_id, msg.id)
+    return msg
 
 # =========================================================
 # ルーム自動削除
 # =========================================================
+# 期限は room_deadlines に保存し、1本のスケジューラでまとめて消す（再起動しても再開）
+async def close_due_rooms(batch):
+    async def close_one(channel_id: int, user_id: int):
+        ch = bot.get_channel(channel_id)  # キャッシュから（fetch しない）
+        if isinstance(ch, discord.TextChannel) and is_user_room(ch, user_id):
+            try:
+                await ch.delete(reason=f"Auto close after diagnosis (user:{user_id})")
+            except Exception:
+                pass
+
+    await asyncio.gather(*(close_one(channel_id, user_id) for channel_id, (_, user_id) in batch))
+    await asyncio.to_thread(delete_room_deadlines, [channel_id for channel_id, _ in batch])
+
+room_closer = DeadlineScheduler(
+    close_due_rooms,
+    batch_size=AUTO_CLOSE_BATCH_SIZE,
+    batch_interval=AUTO_CLOSE_BATCH_INTERVAL,
+)
+metrics.REGISTRY.gauge("room_closer_pending", "rooms waiting for auto close").set_function(lambda: len(room_closer))
+ROOM_CLOSER_LAG = metrics.REGISTRY.gauge(
+    "room_closer_lag_seconds", "auto close delay past the deadline (last / max / current overdue)", ["kind"]
+)
+for _kind, _field in (("last", "lag_last"), ("max", "lag_max"), ("overdue", "overdue")):
+    ROOM_CLOSER_LAG.labels(kind=_kind).set_function(lambda field=_field: room_closer.snapshot()[field])
+ROOM_CLOSER_EVENTS = metrics.REGISTRY.gauge("room_closer_events", "auto close rooms / batches / errors (cumulative)", ["kind"])
+for _kind in ("fired", "batches", "errors"):
+    ROOM_CLOSER_EVENTS.labels(kind=_kind).set_function(lambda kind=_kind: room_closer.stats[kind])
+def _room_closer_next_in() -> float:
+    next_in = room_closer.snapshot()["next_in"]
+    return -1.0 if next_in is None else next_in
+
+metrics.REGISTRY.gauge(
+    "room_closer_next_due_seconds", "seconds until the next auto close (-1 if none)"
+).set_function(_room_closer_next_in)
+
 async def schedule_auto_delete(channel: discord.TextChannel, user_id: int, seconds: int):
-    await asyncio.sleep(seconds)
-    try:
-        # 念のためまだ存在するか
-        _ = await channel.guild.fetch_channel(channel.id)
-    except Exception:
-        return
+    due_at = time.time() + seconds
+    await asyncio.to_thread(add_room_deadline, channel.id, channel.guild.id, user_id, due_at)
+    room_closer.schedule(channel.id, due_at, (channel.guild.id, user_id))
 
-    if is_user_room(channel, user_id):
-        try:
-            await channel.delete(reason=f"Auto close after diagnosis (user:{user_id})")
-        except Exception:
-            pass
+async def resume_auto_delete() -> None:
+    for channel_id, guild_id, user_id, due_at in await asyncio.to_thread(load_room_deadlines):
+        room_closer.schedule(channel_id, due_at, (guild_id, user_id))
+    room_closer.start()
 
 # =========================================================
 # ルーム作成・開始
 # =========================================================
+ROOM_NOTICE = "📝 このルームは診断専用です。ボタンで回答してください。"
+
+ROOM_CLAIM_SECONDS = metrics.REGISTRY.histogram(
+    "room_claim_seconds", "time to get a diagnosis channel for /room", ["source"]
+)
+ROOM_POOL_REFILLS = metrics.REGISTRY.counter("room_pool_refills_total", "spare rooms created in the background")
+
+def room_overwrites(guild: discord.Guild, member: Optional[discord.Member] = None) -> dict:
+    """本人だけが見られる（member=None なら誰も見られない予備ルーム用）"""
+    overwrites = {
+        guild.default_role: discord.PermissionOverwrite(view_channel=False),
+        guild.me: discord.PermissionOverwrite(view_channel=True, send_messages=True, manage_channels=True),
+    }
+    if member is not None:
+        overwrites[member] = discord.PermissionOverwrite(view_channel=True, send_messages=False)
+    return overwrites
+
+async def create_spare_room(guild_id: int) -> int:
+    """予備ルームを1件作る（room_pool の補充タスクから呼ばれる）。案内文も先に送っておく"""
+    guild = bot.get_guild(guild_id)
+    if guild is None or guild.me is None:
+        raise RuntimeError(f"guild {guild_id} is not available")
+    ch = await guild.create_text_channel("match-spare", topic=SPARE_TOPIC, overwrites=room_overwrites(guild))
+    await ch.send(ROOM_NOTICE)
+    ROOM_POOL_REFILLS.inc()
+    return ch.id
+
+# 非公開の予備ルーム（on_ready で既存の予備を拾い直し、補充を始める）
+room_pool = RoomPool(create_spare_room, ROOM_POOL_SIZE, ROOM_POOL_REFILL_INTERVAL)
+metrics.REGISTRY.gauge("room_pool_spare", "spare diagnosis rooms ready to claim").set_function(lambda: len(room_pool))
+
+async def open_room_channel(
+    guild: discord.Guild, member: discord.Member, channel_name: str,
+    before_create: Optional[Callable[[], Awaitable[None]]] = None,
+) -> discord.TextChannel:
+    """
+    予備ルームがあれば名前・topic・権限を1回の編集で書き換えて渡す。
+    無ければ（または消えていれば）その場で作る。before_create はその場で作る直前に呼ぶ（ACK 用）
+    """
+    start = time.perf_counter()
+    topic = f"user:{member.id} name:{member.display_name}"
+    overwrites = room_overwrites(guild, member)
+
+    while (spare_id := room_pool.take(guild.id)) is not None:
+        ch = guild.get_channel(spare_id)
+        if not isinstance(ch, discord.TextChannel):
+            room_pool.stats["stale"] += 1
+            continue
+        try:
+            await ch.edit(name=channel_name, topic=topic, overwrites=overwrites, reason=f"Claim room (user:{member.id})")
+        except discord.NotFound:
+            room_pool.stats["stale"] += 1
+            continue
+        ROOM_CLAIM_SECONDS.labels(source="pool").observe(time.perf_counter() - start)
+        return ch
+
+    if before_create is not None:
+        await before_create()
+    ch = await guild.create_text_channel(channel_name, topic=topic, overwrites=overwrites)
+    await ch.send(ROOM_NOTICE)
+    ROOM_CLAIM_SECONDS.labels(source="create").observe(time.perf_counter() - start)
+    return ch
+
+@timed_handler("create_or_open_room")
 async def create_or_open_room(interaction: discord.Interaction):
     guild = interaction.guild
     assert guild is not None
@@ -333,45 +536,229 @@ async def create_or_open_room(interaction: discord.Interaction):
     channel_name = f"match-{safe_name}-{user_id % 10000}"
 
     # 既存ルーム再利用
-    for ch in guild.text_channels:
-        if is_user_room(ch, user_id):
+    existing_id = room_registry.channel_of(guild.id, user_id)
+    if existing_id is not None:
+        ch = guild.get_channel(existing_id)
+        if isinstance(ch, discord.TextChannel):
             await interaction.response.send_message(f"既にあります：{ch.mention}", ephemeral=True)
             return
+        # 削除イベントを取りこぼしていた
+        room_registry.remove_channel(existing_id)
+        await asyncio.to_thread(delete_room, existing_id)
 
     if guild.me is None:
         await interaction.response.send_message("Bot情報の取得に失敗しました。少し待ってから再度お試しください。", ephemeral=True)
         return
 
-    overwrites = {
-        guild.default_role: discord.PermissionOverwrite(view_channel=False),
-        member: discord.PermissionOverwrite(view_channel=True, send_messages=False),
-        guild.me: discord.PermissionOverwrite(view_channel=True, send_messages=True, manage_channels=True),
-    }
+    async def defer_before_create():
+        # 予備が無かった（取り合いに負けた・消えていた）ときはその場で作る。
+        # レート制限で3秒を超えうるので、作る前にACK
+        if not interaction.response.is_done():
+            await interaction.response.defer(ephemeral=True, thinking=True)
+
+    # 前のセッションの進み具合は捨てる（新しい質問メッセージのクリックは DB で判定）
+    interaction_gate.reset(user_id)
+
+    # ルームの用意と初期化（sqliteはブロックするので to_thread）は互いに待たずに並行で
+    ch, order, _ = await asyncio.gather(
+        open_room_channel(guild, member, channel_name, defer_before_create),
+        asyncio.to_thread(start_session, user_id, BANK.ids),
+        update_match_lists(match_engine.remove, user_id),
+    )
+    room_registry.add(guild.id, user_id, ch.id)
 
-    ch = await guild.create_text_channel(
-        channel_name,
-        topic=f"user:{user_id} name:{member.display_name}",
-        overwrites=overwrites
+    text = f"専用ルームを作成しました：{ch.mention}"
+    await asyncio.gather(
+        asyncio.to_thread(save_room, guild.id, user_id, ch.id),
+        interaction.followup.send(text, ephemeral=True) if interaction.response.is_done()
+        else interaction.response.send_message(text, ephemeral=True),
     )
+    await upsert_question_message(ch, user_id, 0, order, None)
+
+async def update_match_lists(change, *args) -> None:
+    """match_engine.upsert / remove を実行し、変わった上位リストだけを保存する"""
+    async with match_lists_lock:
+        changed = change(*args)
+        await asyncio.to_thread(save_match_lists, changed)
+
+def load_match_engine() -> None:
+    """完了プロフィールを読み込み、保存済みの上位リストがそろっていなければ一括で作り直す"""
+    match_engine.load(load_completed_profiles())
+    if match_engine.load_lists(load_match_lists()):
+        return
+    t0 = time.perf_counter()
+    lists = match_engine.rebuild_lists(MATCH_REBUILD_WORKERS or os.cpu_count() or 1)
+    replace_match_lists(lists)
+    print(f"match lists rebuilt: {len(lists)} users in {time.perf_counter() - t0:.1f}s")
+
+async def rebuild_room_registry() -> None:
+    """ギルドごとにチャンネルを1回だけ走査して索引とテーブル・予備ルームを作り直す"""
+    for guild in bot.guilds:
+        rooms, spares = [], []
+        for ch in guild.text_channels:
+            owner = room_owner_from_topic(ch.topic)
+            if owner is not None:
+                rooms.append((owner, ch.id))
+            elif is_spare_topic(ch.topic):
+                spares.append(ch.id)
+        room_registry.replace_guild(guild.id, rooms)
+        room_pool.replace_guild(guild.id, spares)
+        await asyncio.to_thread(replace_guild_rooms, guild.id, rooms)
+
+# =========================================================
+# 参加時の案内（まとめて1通 + 固定パネルの編集）
+# =========================================================
+# 以前は参加1人ごとに「ようこそ」1通 + パネル1通（= 2回の REST）を送っていた。
+# 今は窓ごとに「ようこそ」1通 + パネル1回の編集。パネルの message_id は meta に保存して再起動後も編集し続ける
+WELCOME_JOINS = metrics.REGISTRY.counter("welcome_joins_total", "member joins queued for the welcome message")
+WELCOME_API_CALLS = metrics.REGISTRY.counter("welcome_api_calls_total", "REST calls made for welcome batches", ["kind"])
+WELCOME_CALLS_SAVED = metrics.REGISTRY.counter(
+    "welcome_api_calls_saved_total", "REST calls saved compared with one welcome and one panel per join"
+)
 
-    await interaction.response.send_message(f"専用ルームを作成しました：{ch.mention}", ephemeral=True)
-    await ch.send("📝 このルームは診断専用です。ボタンで回答してください。")
+welcome_panels: Dict[int, int] = {}  # channel_id -> パネルの message_id（meta の読み直しを省く）
 
-    # 初期化（sqliteはブロックするので to_thread）
-    await asyncio.to_thread(reset_user, user_id)
-    await asyncio.to_thread(reset_order, user_id)
-    await asyncio.to_thread(reset_message_id, user_id)
-    await asyncio.to_thread(set_state, user_id, 0)
+def welcome_panel_key(channel_id: int) -> str:
+    return f"welcome_panel:{channel_id}"
 
-    order = await asyncio.to_thread(get_or_create_order, user_id, [q["id"] for q in QUESTIONS])
-    await upsert_question_message(ch, user_id, 0, order)
+async def upsert_welcome_panel(channel: discord.TextChannel, recent_joins: int) -> int:
+    """固定パネルを編集する。まだ無い・消されていたら送り直して message_id を保存。戻り値: REST 呼び出し数"""
+    calls = 0
+    mid = welcome_panels.get(channel.id)
+    if mid is None:
+        stored = await asyncio.to_thread(get_meta, welcome_panel_key(channel.id))
+        mid = int(stored) if stored else None
+
+    if mid is not None:
+        calls += 1
+        WELCOME_API_CALLS.labels(kind="panel_edit").inc()
+        msg = await edit_message_by_id(channel, mid, embed=build_panel_embed(recent_joins), view=StartRoomView())
+        if msg is not None:
+            welcome_panels[channel.id] = mid
+            return calls
+
+    calls += 1
+    WELCOME_API_CALLS.labels(kind="panel_post").inc()
+    msg = await post_panel(channel, recent_joins)
+    welcome_panels[channel.id] = msg.id
+    await asyncio.to_thread(set_meta, welcome_panel_key(channel.id), str(msg.id))
+    return calls
+
+async def send_welcome(channel_id: int, members: List[discord.Member]) -> None:
+    channel = bot.get_channel(channel_id)
+    if not isinstance(channel, discord.TextChannel):
+        return
+
+    mentions = " ".join(m.mention for m in members)
+    WELCOME_API_CALLS.labels(kind="welcome").inc()
+    await channel.send(
+        f"👋 {mentions} さん、ようこそ！パネルのボタンを押して診断スタート",
+        allowed_mentions=discord.AllowedMentions(users=True, everyone=False, roles=False),
+    )
+    calls = 1 + await upsert_welcome_panel(channel, len(members))
+    WELCOME_CALLS_SAVED.inc(max(0, 2 * len(members) - calls))
+
+welcome_batcher = JoinBatcher(send_welcome, window=WELCOME_BATCH_WINDOW, max_batch=WELCOME_BATCH_MAX)
+metrics.REGISTRY.gauge("welcome_queue_depth", "joins waiting for the next welcome batch").set_function(
+    lambda: len(welcome_batcher)
+)
+
+# =========================================================
+# 放置・退出ユーザーのセッション整理
+# =========================================================
+# SESSION_TTL_DAYS 以上進んでいない未完了セッションと、サーバーにいないユーザーのセッションを
+# archived_sessions に移し、空いたページを incremental_vacuum で返す。
+# DB の処理は COMPACT_BATCH_SIZE 人ずつ to_thread で行い、バッチの間はイベントループに譲る
+COMPACT_ARCHIVED = metrics.REGISTRY.counter("compaction_sessions_archived_total", "sessions moved to the archive", ["reason"])
+COMPACT_ROWS = metrics.REGISTRY.counter("compaction_rows_reclaimed_total", "rows deleted from live tables")
+COMPACT_BYTES = metrics.REGISTRY.counter("compaction_bytes_freed_total", "bytes returned by incremental vacuum")
+
+compact_lock = asyncio.Lock()
+compaction_task: Optional[asyncio.Task] = None
+
+async def archive_batch(user_ids: List[int], reason: str, report: Counter) -> int:
+    res = await asyncio.to_thread(archive_sessions, user_ids, reason)
+    for user_id, idx in res.users:
+        if idx >= len(BANK):
+            await update_match_lists(match_engine.remove, user_id)
+        # 残っている診断ルームは自動削除と同じ経路でまとめて消す
+        for guild in bot.guilds:
+            channel_id = room_registry.channel_of(guild.id, user_id)
+            ch = bot.get_channel(channel_id) if channel_id is not None else None
+            if isinstance(ch, discord.TextChannel):
+                await schedule_auto_delete(ch, user_id, 0)
+                report["rooms_closed"] += 1
+    COMPACT_ARCHIVED.labels(reason=reason).inc(len(res.users))
+    COMPACT_ROWS.inc(res.rows)
+    report[reason] += len(res.users)
+    report["rows"] += res.rows
+    return len(res.users)
+
+async def compact_sessions() -> Counter:
+    """
+    戻り値: ttl / left（移した人数）/ rows（消した行数）/ rooms_closed / pages_freed / bytes_freed / seconds
+            left_skipped: メンバー一覧がそろっていないので退出者の判定をしなかった
+    """
+    async with compact_lock:
+        t0 = time.perf_counter()
+        report = Counter()
+        before = await asyncio.to_thread(page_stats)
+
+        cutoff = time.time() - SESSION_TTL_DAYS * 86400
+        while True:
+            user_ids = await asyncio.to_thread(find_stale_sessions, cutoff, COMPACT_BATCH_SIZE)
+            if not user_ids or not await archive_batch(user_ids, "ttl", report):
+                break
+            await asyncio.sleep(COMPACT_BATCH_PAUSE)
+
+        # メンバーキャッシュが全員分そろっているときだけ（途中だと在籍者を退出扱いしてしまう）
+        if bot.guilds and all(g.chunked for g in bot.guilds):
+            members = {m.id for g in bot.guilds for m in g.members}
+            left = [uid for uid in await asyncio.to_thread(list_session_users) if uid not in members]
+            for i in range(0, len(left), COMPACT_BATCH_SIZE):
+                await archive_batch(left[i:i + COMPACT_BATCH_SIZE], "left", report)
+                await asyncio.sleep(COMPACT_BATCH_PAUSE)
+        else:
+            report["left_skipped"] = 1
+
+        while True:
+            freed = await asyncio.to_thread(incremental_vacuum, COMPACT_VACUUM_PAGES)
+            if not freed:
+                break
+            report["pages_freed"] += freed
+            await asyncio.sleep(COMPACT_BATCH_PAUSE)
+
+        after = await asyncio.to_thread(page_stats)
+        report["bytes_freed"] = max(0, before["page_count"] - after["page_count"]) * after["page_size"]
+        COMPACT_BYTES.inc(report["bytes_freed"])
+        report["seconds"] = round(time.perf_counter() - t0, 2)
+        print("compaction:", dict(report))
+        return report
+
+async def compaction_loop() -> None:
+    while True:
+        await asyncio.sleep(COMPACT_INTERVAL_HOURS * 3600)
+        try:
+            await compact_sessions()
+        except Exception as e:
+            print("compaction failed:", repr(e))
+
+def start_compaction() -> None:
+    global compaction_task
+    if COMPACT_INTERVAL_HOURS > 0 and (compaction_task is None or compaction_task.done()):
+        compaction_task = asyncio.create_task(compaction_loop())
 
 # =========================================================
 # イベント
 # =========================================================
 @bot.event
 async def on_ready():
-    init_db()
+    await asyncio.to_thread(init_db)
+    await asyncio.to_thread(load_match_engine)
+    await rebuild_room_registry()
+    await resume_auto_delete()
+    room_pool.start()
+    start_compaction()
     try:
         bot.add_view(StartRoomView())  # 永続ボタン
     except Exception as e:
@@ -380,20 +767,49 @@ async def on_ready():
     print("commands:", [c.name for c in bot.tree.get_commands()])
     print(f"Bot起動: {bot.user}")
 
+@bot.event
+async def on_guild_channel_create(channel: discord.abc.GuildChannel):
+    if not isinstance(channel, discord.TextChannel):
+        return
+    owner = room_owner_from_topic(channel.topic)
+    if owner is None:
+        return
+    if room_registry.owner_of(channel.id) != owner:
+        room_registry.add(channel.guild.id, owner, channel.id)
+        await asyncio.to_thread(save_room, channel.guild.id, owner, channel.id)
+
+@bot.event
+async def on_guild_channel_update(before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+    if not isinstance(after, discord.TextChannel) or getattr(before, "topic", None) == after.topic:
+        return
+    owner = room_owner_from_topic(after.topic)
+    if owner is None:
+        if room_registry.remove_channel(after.id) is not None:
+            await asyncio.to_thread(delete_room, after.id)
+    elif room_registry.owner_of(after.id) != owner:
+        room_registry.add(after.guild.id, owner, after.id)
+        await asyncio.to_thread(save_room, after.guild.id, owner, after.id)
+
+@bot.event
+async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
+    room_pool.discard(channel.id)
+    if room_registry.remove_channel(channel.id) is not None:
+        await asyncio.to_thread(delete_room, channel.id)
+    if room_closer.cancel(channel.id):
+        await asyncio.to_thread(delete_room_deadlines, [channel.id])
+
 @bot.event
 async def on_member_join(member: discord.Member):
     if member.bot:
         return
     if WELCOME_CHANNEL_ID <= 0:
         return
-    channel = member.guild.get_channel(WELCOME_CHANNEL_ID)
-    if channel is None or not isinstance(channel, discord.TextChannel):
-        return
-
-    await channel.send(f"👋 {member.mention} さん、ようこそ！ボタンを押して診断スタート")
-    await post_panel(channel)
+    # 1人ずつ送らず、WELCOME_BATCH_WINDOW 秒ぶんまとめて send_welcome へ
+    WELCOME_JOINS.inc()
+    welcome_batcher.add(WELCOME_CHANNEL_ID, member.id, member)
 
 @bot.event
+@timed_handler("on_interaction")
 async def on_interaction(interaction: discord.Interaction):
     # ボタン以外は無視（slash等はdiscord.pyが処理する）
     if interaction.type != discord.InteractionType.component:
@@ -408,6 +824,7 @@ async def on_interaction(interaction: discord.Interaction):
     if not interaction.response.is_done():
         await interaction.response.defer(ephemeral=True)
 
+    click_keys = ()
     try:
         # ans:{user_id}:{idx}:{key}
         _, uid_s, idx_s, key = cid.split(":")
@@ -419,43 +836,71 @@ async def on_interaction(interaction: discord.Interaction):
             await interaction.followup.send("これはあなたの診断ではありません。", ephemeral=True)
             return
 
-        # order取得
-        order = await asyncio.to_thread(get_or_create_order, user_id, [q["id"] for q in QUESTIONS])
-
-        # idxがズレていたら現在stateを優先
-        cur_idx = await asyncio.to_thread(get_state, user_id)
-        if isinstance(cur_idx, int) and 0 <= cur_idx < len(order):
-            idx = cur_idx
-
-        # 保存
-        q = q_by_id(order[idx])
-        await asyncio.to_thread(save_answer, user_id, q["id"], key)
-
-        next_idx = idx + 1
-        await asyncio.to_thread(set_state, user_id, next_idx)
-
-        # 完了
-        if next_idx >= len(order):
-            result_text = "✅ **診断完了！**\n\n" + categorized_result(user_id)
-            notice = f"\n\n⏳ {AUTO_CLOSE_SECONDS//60}分後にこのルームは自動削除されます。"
-
-            mid = await asyncio.to_thread(get_message_id, user_id)
-            if mid:
-                try:
-                    msg = await interaction.channel.fetch_message(mid)
-                    await msg.edit(content=result_text + notice, embed=None, view=None)
-                except Exception:
-                    await interaction.followup.send(result_text + notice, ephemeral=True)
-            else:
-                await interaction.followup.send(result_text + notice, ephemeral=True)
-
-            asyncio.create_task(schedule_auto_delete(interaction.channel, user_id, AUTO_CLOSE_SECONDS))
+        # 同じ interaction の再送は DB に触らず捨てる
+        click_keys = (("interaction", interaction.id),)
+        if not interaction_gate.admit(*click_keys):
             return
 
-        # 次の質問へ（固定メッセージ更新）
-        await upsert_question_message(interaction.channel, user_id, next_idx, order)
+        # ユーザーごとに1クリックずつ処理（メッセージ編集は最後のクリック分だけ送る）
+        async with interaction_gate.turn(user_id) as turn:
+            res = interaction_gate.progress(user_id, interaction.message.id if interaction.message else None)
+            if res is not None and idx < res.next_idx:
+                # 前のクリックで state はもう先へ進んでいる（連打・古いボタン）：DB に触らず捨てる
+                interaction_gate.stats["db_skipped"] += 1
+                res = res._replace(idx=res.next_idx, accepted=False)
+            else:
+                # order取得 → state確認 → 保存 → state前進 を1トランザクションで
+                res = await asyncio.to_thread(record_answer, user_id, idx, key, BANK.ids)
+                interaction_gate.advance(user_id, res)
+            if not res.accepted:
+                # 連打・古いボタン：今の質問を表示し直す（前のクリックの編集と同じなら送らない）
+                # 編集に失敗してボタンが古いままでも、次のクリックで追いつける
+                interaction_gate.stats["stale"] += 1
+                if res.completed:
+                    await interaction.followup.send("この診断はすでに完了しています。", ephemeral=True)
+                    return
+                turn.render(
+                    lambda: upsert_question_message(
+                        interaction.channel, user_id, res.idx, res.order, res.message_id, interaction
+                    ),
+                    key=(user_id, res.message_id, res.idx),
+                )
+                return
+            order, next_idx, mid = res.order, res.next_idx, res.message_id
+            ANSWERS_ACCEPTED.inc()
+
+            # 完了
+            if res.completed:
+                # 結果を出す前に回答の永続化を待つ（DB_WRITE_MODE=async のときだけ意味がある）
+                await asyncio.to_thread(flush)
+                picks, _ = await asyncio.to_thread(build_profile, user_id)
+                await update_match_lists(match_engine.upsert, user_id, picks)
+
+                result_text = "✅ **診断完了！**\n\n" + categorized_result(picks)
+                notice = f"\n\n⏳ {AUTO_CLOSE_SECONDS//60}分後にこのルームは自動削除されます。"
+
+                async def show_result():
+                    msg = None
+                    if mid:
+                        msg = await edit_message_by_id(
+                            interaction.channel, mid, interaction, content=result_text + notice, embed=None, view=None
+                        )
+                    if msg is None:
+                        await interaction.followup.send(result_text + notice, ephemeral=True)
+
+                turn.render(show_result, key=(user_id, mid, "done"))
+                await schedule_auto_delete(interaction.channel, user_id, AUTO_CLOSE_SECONDS)
+                return
+
+            # 次の質問へ（固定メッセージ更新）
+            turn.render(
+                lambda: upsert_question_message(interaction.channel, user_id, next_idx, order, mid, interaction),
+                key=(user_id, mid, next_idx),
+            )
 
     except Exception as e:
+        if click_keys:
+            interaction_gate.forget(*click_keys)
         await interaction.followup.send(f"⚠️ エラー：{type(e).__name__}", ephemeral=True)
         raise
 
@@ -520,6 +965,49 @@ async def sync_cmd(interaction: discord.Interaction):
         ephemeral=True
     )
 
+@bot.tree.command(name="rebuild_profiles", description="回答からプロフィールを再集計（運営専用）")
+async def rebuild_profiles_cmd(interaction: discord.Interaction):
+    if interaction.guild is None or not isinstance(interaction.user, discord.Member):
+        await interaction.response.send_message("サーバー内で実行してください。", ephemeral=True)
+        return
+
+    if not has_role_id(interaction.user, ADMIN_ROLE_ID):
+        await interaction.response.send_message("権限がありません。", ephemeral=True)
+        return
+
+    # ✅ 3秒制限回避：先にACK
+    await interaction.response.defer(ephemeral=True)
+
+    n = await asyncio.to_thread(rebuild_profiles)
+    await asyncio.to_thread(load_match_engine)
+    await interaction.followup.send(f"✅ プロフィールを再集計しました（{n}件）。", ephemeral=True)
+
+@bot.tree.command(name="rebuild_rooms", description="管理者用：ルーム索引・予備ルーム・自動削除の予定を作り直す")
+async def rebuild_rooms_cmd(interaction: discord.Interaction):
+    if interaction.guild is None or not isinstance(interaction.user, discord.Member):
+        await interaction.response.send_message("サーバー内で実行してください。", ephemeral=True)
+        return
+
+    if ADMIN_CHANNEL_ID > 0 and interaction.channel_id != ADMIN_CHANNEL_ID:
+        await interaction.response.send_message("このコマンドは管理者チャンネルでのみ使用できます。", ephemeral=True)
+        return
+
+    if not has_role_id(interaction.user, ADMIN_ROLE_ID):
+        await interaction.response.send_message("権限がありません。", ephemeral=True)
+        return
+
+    await interaction.response.defer(ephemeral=True)
+
+    before = room_registry.count(interaction.guild.id)
+    await rebuild_room_registry()
+    after = room_registry.count(interaction.guild.id)
+    await resume_auto_delete()  # 期限テーブルから読み直す（同じルームは上書きなので二重にはならない）
+    await interaction.followup.send(
+        f"✅ ルーム索引を作り直しました（{before} → {after}件 / 予備 {room_pool.count(interaction.guild.id)}件 / "
+        f"自動削除待ち {len(room_closer)}件）。",
+        ephemeral=True,
+    )
+
 @bot.tree.command(name="logs", description="管理者用：利用状況を表示（Embed）")
 async def logs(interaction: discord.Interaction):
     if interaction.guild is None or not isinstance(interaction.user, discord.Member):
@@ -535,10 +1023,11 @@ async def logs(interaction: discord.Interaction):
         await interaction.response.send_message("権限がありません。", ephemeral=True)
         return
 
-    total = count_total_users()
-    completed = count_completed_users(len(QUESTIONS))
-    inprogress = count_inprogress_users(len(QUESTIONS))
-    rooms = [ch for ch in interaction.guild.text_channels if ch.name.startswith("match-")]
+    counters = await asyncio.to_thread(get_user_counters)
+    total = counters["total"]
+    completed = counters["completed"]
+    inprogress = counters["inprogress"]
+    rooms = room_registry.count(interaction.guild.id)
 
     embed = discord.Embed(
         title="📊 診断Bot 利用状況",
@@ -547,20 +1036,300 @@ async def logs(interaction: discord.Interaction):
     embed.add_field(name="総ユーザー数", value=str(total), inline=True)
     embed.add_field(name="診断完了", value=str(completed), inline=True)
     embed.add_field(name="診断途中", value=str(inprogress), inline=True)
-    embed.add_field(name="専用ルーム数", value=str(len(rooms)), inline=True)
-    embed.add_field(name="質問数", value=str(len(QUESTIONS)), inline=True)
+    embed.add_field(name="専用ルーム数", value=str(rooms), inline=True)
+    embed.add_field(name="質問数", value=str(len(BANK)), inline=True)
     embed.set_footer(text=f"Requested by {interaction.user.display_name}")
 
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
-def compatibility_percent(picks_a: dict, picks_b: dict, categories: List[str]) -> int:
-    usable = [c for c in categories if c in picks_a and c in picks_b]
-    if not usable:
-        return 0
-    same = sum(1 for c in usable if picks_a[c] == picks_b[c])
-    return int(round(same / len(usable) * 100))
+def format_funnel(funnel: List[int]) -> str:
+    """出題順の位置ごとの到達数と、その位置で止まった数（途中の人を含む）"""
+    lines = [f"{'':>4} {'到達':>6} {'離脱':>6} {'離脱率':>6}", f"{'開始':>4} {funnel[0]:>6}"]
+    for k in range(1, len(funnel)):
+        drop = max(0, funnel[k - 1] - funnel[k])
+        rate = drop / funnel[k - 1] * 100 if funnel[k - 1] else 0.0
+        lines.append(f"{'Q%d' % k:>4} {funnel[k]:>6} {drop:>6} {rate:>5.1f}%")
+    return "```\n" + "\n".join(lines) + "\n```"
+
+def format_distribution(counts: dict) -> str:
+    total = sum(counts.values())
+    if not total:
+        return "（回答なし）"
+    return " ".join(f"{key} {counts.get(key, 0) / total * 100:.0f}%" for key in "ABCDE")
+
+@bot.tree.command(name="answer_stats", description="管理者用：離脱ポイントと回答の分布")
+async def answer_stats(interaction: discord.Interaction, question: Optional[int] = None):
+    if interaction.guild is None or not isinstance(interaction.user, discord.Member):
+        await interaction.response.send_message("サーバー内で実行してください。", ephemeral=True)
+        return
+
+    if ADMIN_CHANNEL_ID > 0 and interaction.channel_id != ADMIN_CHANNEL_ID:
+        await interaction.response.send_message("このコマンドは管理者チャンネルでのみ使用できます。", ephemeral=True)
+        return
+
+    if not has_role_id(interaction.user, ADMIN_ROLE_ID):
+        await interaction.response.send_message("権限がありません。", ephemeral=True)
+        return
+
+    if question is not None and question not in BANK.by_id:
+        await interaction.response.send_message(f"質問 id {question} はありません。", ephemeral=True)
+        return
+
+    stats = await asyncio.to_thread(get_answer_stats)
+    funnel = stats.funnel
+
+    embed = discord.Embed(title="📈 回答の分析", description="累計（やり直し前の回答も含む）。Qn は出題順の n 問目です。")
+    embed.add_field(name="離脱ポイント", value=format_funnel(funnel), inline=False)
+
+    by_category: Dict[str, Counter] = {}
+    for qid, counts in stats.answers.items():
+        cat = BANK.category_of.get(qid)
+        if cat:
+            by_category.setdefault(cat, Counter()).update(counts)
+    embed.add_field(
+        name="カテゴリ別の回答分布",
+        value="\n".join(
+            f"{CATEGORY_LABEL.get(cat, cat)}：{format_distribution(by_category.get(cat, {}))}" for cat in BANK.categories
+        ),
+        inline=False,
+    )
+
+    if question is not None:
+        counts = stats.answers.get(question, {})
+        embed.add_field(
+            name=f"Q{question}（{sum(counts.values())}件）",
+            value=f"{BANK.question(question)['text']}\n{format_distribution(counts)}",
+            inline=False,
+        )
+
+    done = funnel[-1] / funnel[0] * 100 if funnel[0] else 0.0
+    embed.set_footer(text=f"開始 {funnel[0]} / 完了 {funnel[-1]}（{done:.1f}%）")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="logs_check", description="管理者用：/logs の集計を元データから数え直す")
+async def logs_check(interaction: discord.Interaction):
+    if interaction.guild is None or not isinstance(interaction.user, discord.Member):
+        await interaction.response.send_message("サーバー内で実行してください。", ephemeral=True)
+        return
+
+    if ADMIN_CHANNEL_ID > 0 and interaction.channel_id != ADMIN_CHANNEL_ID:
+        await interaction.response.send_message("このコマンドは管理者チャンネルでのみ使用できます。", ephemeral=True)
+        return
+
+    if not has_role_id(interaction.user, ADMIN_ROLE_ID):
+        await interaction.response.send_message("権限がありません。", ephemeral=True)
+        return
+
+    await interaction.response.defer(ephemeral=True)
+
+    before, after = await asyncio.to_thread(check_user_counters)
+    rooms_db = await asyncio.to_thread(count_rooms, interaction.guild.id)
+    rooms_mem = room_registry.count(interaction.guild.id)
+
+    lines = ["🔎 **集計の整合性チェック**"]
+    for key, label in (("total", "総ユーザー数"), ("completed", "診断完了"), ("inprogress", "診断途中")):
+        mark = "✅" if before[key] == after[key] else "⚠️ 修正"
+        lines.append(f"{mark} {label}：{before[key]} → {after[key]}")
+    mark = "✅" if rooms_db == rooms_mem else "⚠️ 不一致"
+    lines.append(f"{mark} 専用ルーム数：索引 {rooms_mem} / DB {rooms_db}")
+    if rooms_db != rooms_mem:
+        lines.append("（/rebuild_rooms でルーム索引を作り直せます）")
+
+    await interaction.followup.send("\n".join(lines), ephemeral=True)
+
+@bot.tree.command(name="compact", description="管理者用：放置・退出ユーザーのセッションを整理")
+async def compact_cmd(interaction: discord.Interaction):
+    if interaction.guild is None or not isinstance(interaction.user, discord.Member):
+        await interaction.response.send_message("サーバー内で実行してください。", ephemeral=True)
+        return
+
+    if ADMIN_CHANNEL_ID > 0 and interaction.channel_id != ADMIN_CHANNEL_ID:
+        await interaction.response.send_message("このコマンドは管理者チャンネルでのみ使用できます。", ephemeral=True)
+        return
+
+    if not has_role_id(interaction.user, ADMIN_ROLE_ID):
+        await interaction.response.send_message("権限がありません。", ephemeral=True)
+        return
+
+    await interaction.response.defer(ephemeral=True)
+
+    report = await compact_sessions()
+    lines = [
+        "🧹 **セッション整理**",
+        f"放置（{SESSION_TTL_DAYS:g}日以上）：{report['ttl']}人 / 退出済み：{report['left']}人",
+        f"削除した行：{report['rows']} / 閉じたルーム：{report['rooms_closed']}",
+        f"解放：{report['bytes_freed'] / 1024:.1f} KiB（{report['pages_freed']}ページ） / {report['seconds']}秒",
+    ]
+    if report["left_skipped"]:
+        lines.append("⚠️ メンバー一覧の取得が終わっていないため、退出者の整理は行いませんでした。")
+    await interaction.followup.send("\n".join(lines), ephemeral=True)
+
+def format_latency_table(hist: metrics.Histogram, label: str, limit: int) -> str:
+    """合計時間の多い順に count / p50 / p95 / p99（ms）"""
+    rows = hist.summary(limit)
+    if not rows:
+        return "（記録なし）"
+    lines = [f"{'name':<34} {'count':>7} {'p50':>7} {'p95':>7} {'p99':>7}"]
+    for r in rows:
+        name = re.sub(r"\{\w+\}", "*", r["labels"][label])  # ルートのパラメータは * に
+        if len(name) > 34:
+            name = "…" + name[-33:]
+        lines.append(
+            f"{name:<34} {r['count']:>7} {r['p50'] * 1000:>7.1f} {r['p95'] * 1000:>7.1f} {r['p99'] * 1000:>7.1f}"
+        )
+    return "```\n" + "\n".join(lines) + "\n```"
+
+@bot.tree.command(name="metrics", description="管理者用：処理時間の内訳（ハンドラ / DB / Discord API）")
+async def metrics_cmd(interaction: discord.Interaction):
+    if interaction.guild is None or not isinstance(interaction.user, discord.Member):
+        await interaction.response.send_message("サーバー内で実行してください。", ephemeral=True)
+        return
+
+    if ADMIN_CHANNEL_ID > 0 and interaction.channel_id != ADMIN_CHANNEL_ID:
+        await interaction.response.send_message("このコマンドは管理者チャンネルでのみ使用できます。", ephemeral=True)
+        return
+
+    if not has_role_id(interaction.user, ADMIN_ROLE_ID):
+        await interaction.response.send_message("権限がありません。", ephemeral=True)
+        return
+
+    embed = discord.Embed(title="⏱️ 処理時間（ms）", description="合計時間の多い順。p50/p95/p99 はバケットからの推定値です。")
+    embed.add_field(name="ハンドラ", value=format_latency_table(HANDLER_SECONDS, "handler", 5), inline=False)
+    embed.add_field(name="DB", value=format_latency_table(DB_CALL_SECONDS, "fn", 8), inline=False)
+    embed.add_field(name="Discord API", value=format_latency_table(DISCORD_REQUEST_SECONDS, "route", 8), inline=False)
+
+    gate = interaction_gate.snapshot()
+    pool = room_pool.snapshot()
+    embed.add_field(
+        name="予備ルーム",
+        value=(
+            f"残り {room_pool.count(interaction.guild.id)} / {pool['size']}（{pool['refill_interval']:g}秒に1件補充）\n"
+            f"予備から {pool['claimed']} / その場で作成 {pool['empty']} / 消えていた {pool['stale']} / "
+            f"補充 {pool['created']} / 補充失敗 {pool['errors']}"
+        ),
+        inline=False,
+    )
+    closer = room_closer.snapshot()
+    next_in = "-" if closer["next_in"] is None else f"{closer['next_in']:.0f}秒"
+    embed.add_field(
+        name="自動削除",
+        value=(
+            f"待ち {closer['depth']} / 次まで {next_in} / 期限超過 {closer['overdue']:.1f}秒\n"
+            f"遅れ 直近 {closer['lag_last']:.1f}秒・最大 {closer['lag_max']:.1f}秒 / "
+            f"削除 {closer['fired']}件（{closer['batches']}バッチ）/ 失敗 {closer['errors']}"
+        ),
+        inline=False,
+    )
+    answers = ANSWERS_ACCEPTED.labels().value
+    edits = {outcome: child.value for (outcome,), child in QUESTION_EDITS.children()}
+    embed.add_field(
+        name="質問メッセージの編集",
+        value=(
+            f"回答 {answers:g} / interaction 経由 {edits.get('interaction_edit', 0):g} / ID 指定 {edits.get('partial_edit', 0):g} / "
+            f"404 で送り直し {edits.get('not_found', 0):g}\n"
+            f"省いた fetch {edits.get('fetch_saved', 0):g}回（回答1件あたり {edits.get('fetch_saved', 0) / answers if answers else 0:.2f}回）"
+        ),
+        inline=False,
+    )
+    embed.add_field(
+        name="回答クリック",
+        value=(
+            f"受付 {gate.get('admitted', 0)} / 再送 {gate.get('duplicates', 0)} / 連打・古いボタン {gate.get('stale', 0)}（うち DB を省いた {gate.get('db_skipped', 0)}）/ "
+            f"まとめた編集 {gate.get('coalesced', 0)} / 送った編集 {gate.get('renders', 0)}"
+        ),
+        inline=False,
+    )
+    welcome = welcome_batcher.snapshot()
+    embed.add_field(
+        name="参加案内",
+        value=(
+            f"待ち {welcome['depth']}人 / 参加 {welcome['items']}人を {welcome['batches']}回にまとめて送信 / "
+            f"節約した API 呼び出し {WELCOME_CALLS_SAVED.labels().value:g}回"
+        ),
+        inline=False,
+    )
+    conns = connection_stats()
+    embed.add_field(
+        name="DB 接続",
+        value=(
+            f"開いている {conns['open']} / 開いた {conns['opened']} / 閉じた {conns['closed']} / "
+            f"取得 {conns['checkouts']}回（使い回し {conns['checkouts'] - conns['opened']}回）"
+        ),
+        inline=False,
+    )
+    cache = session_cache_stats()
+    lookups = cache["hits"] + cache["misses"]
+    embed.add_field(
+        name="セッションキャッシュ",
+        value=(
+            f"{cache['size']} / {cache['maxsize']}件 / ヒット率 {cache['hits'] / lookups if lookups else 0:.1%}"
+            f"（ヒット {cache['hits']}・ミス {cache['misses']}）\n"
+            f"追い出し {cache['evictions']} / 期限切れ {cache['expirations']} / 無効化 {cache['invalidations']}"
+        ),
+        inline=False,
+    )
+    writer = writer_stats()
+    if writer["mode"] != "sync":
+        embed.add_field(
+            name=f"DB 書き込み（{writer['mode']}）",
+            value=(
+                f"待ち {writer['queue_depth']}件・未コミット {writer['pending']}件 / {writer['batches']}バッチで書き込み {writer['writes']}件・読み取り {writer['reads']}件 / "
+                f"最大バッチ {writer['max_batch']} / 失敗 {writer['failed']}"
+            ),
+            inline=False,
+        )
+    store = storage_stats()
+    if store["backend"] == "memory":
+        embed.add_field(
+            name="保存先（memory）",
+            value=(
+                f"セッション {store['users']} / 未書き出し {store['pending']}件 / 前回スナップショットから {store['since_snapshot']}件\n"
+                f"スナップショット {store['snapshots']}回（直近 {store['snapshot_bytes'] / 1024:.0f} KiB・{store['snapshot_ms']:.0f}ms）/ "
+                f"起動時の再生 {store['recovered_ops']}件・{store['recovery_ms']:.0f}ms / 書き出し失敗 {store['errors']}\n"
+                f"回答イベント（answer_events）書き込み済み {store['events_exported']}件・待ち {store['events_pending']}件"
+            ),
+            inline=False,
+        )
+    embed.set_footer(text=(
+        f"処理中ユーザー {gate['active_users']} / 自動削除待ち {len(room_closer)} / "
+        f"HTTP {'http://%s:%d/metrics' % (METRICS_HOST, METRICS_PORT) if METRICS_PORT > 0 else 'off'}"
+    ))
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+profile_lock = asyncio.Lock()  # /profile は同時に1本だけ
+
+@bot.tree.command(name="profile", description="管理者用：N秒間サンプリングして処理時間の内訳を取る")
+async def profile_cmd(interaction: discord.Interaction, seconds: int = 10):
+    if interaction.guild is None or not isinstance(interaction.user, discord.Member):
+        await interaction.response.send_message("サーバー内で実行してください。", ephemeral=True)
+        return
+
+    if not has_role_id(interaction.user, ADMIN_ROLE_ID):
+        await interaction.response.send_message("このコマンドは運営専用です。", ephemeral=True)
+        return
+
+    if profile_lock.locked():
+        await interaction.response.send_message("別のプロファイルを取得中です。終わってから実行してください。", ephemeral=True)
+        return
+
+    seconds = max(1, min(PROFILE_MAX_SECONDS, seconds))
+    await interaction.response.defer(ephemeral=True, thinking=True)
+
+    async with profile_lock:
+        prof = await SamplingProfiler(PROFILE_INTERVAL_MS / 1000).run(seconds)
+    collapsed_path, summary_path = await asyncio.to_thread(prof.write, PROFILE_DIR)
+
+    summary = prof.summary(10)
+    if len(summary) > 1800:
+        summary = summary[:1800] + "\n…"
+    await interaction.followup.send(
+        f"🔬 プロファイル（{seconds}秒）: `{summary_path}`\n```\n{summary}\n```",
+        file=discord.File(collapsed_path),
+        ephemeral=True,
+    )
 
 @bot.tree.command(name="match", description="相性TOP3（任意表示）")
+@timed_handler("match")
 async def match(interaction: discord.Interaction):
     if interaction.guild is None:
         await interaction.response.send_message("サーバー内で実行してください。", ephemeral=True)
@@ -571,38 +1340,17 @@ async def match(interaction: discord.Interaction):
         await interaction.response.send_message("専用ルーム内で実行してください。", ephemeral=True)
         return
 
-    # 診断完了チェック
-    if get_state(interaction.user.id) < len(QUESTIONS):
+    # 保存済みの上位リストを1行読むだけ（無ければ診断未完了）
+    top = await asyncio.to_thread(get_match_list, interaction.user.id)
+    if top is None:
         await interaction.response.send_message("診断が完了していません。先に質問に回答してください。", ephemeral=True)
         return
+    top = top[:3]
 
-    me_picks, _ = build_profile(interaction.user.id)
-
-    CATS = ["game_style", "communication", "play_time", "distance", "money", "future"]
-
-    # 全ユーザー候補（answersテーブルから拾う）
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.cursor()
-        cur.execute("SELECT DISTINCT user_id FROM answers")
-        user_ids = [int(r[0]) for r in cur.fetchall()]
-
-    results = []
-    for uid in user_ids:
-        if uid == interaction.user.id:
-            continue
-        if get_state(uid) < len(QUESTIONS):
-            continue
-        other_picks, _ = build_profile(uid)
-        pct = compatibility_percent(me_picks, other_picks, CATS)
-        results.append((pct, uid))
-
-    if not results:
+    if not top:
         await interaction.response.send_message("比較できる相手がまだいません。", ephemeral=True)
         return
 
-    results.sort(reverse=True, key=lambda x: x[0])
-    top = results[:3]
-
     lines = ["🏆 **相性TOP3（カテゴリ一致率）**"]
     for i, (pct, uid) in enumerate(top, start=1):
         lines.append(f"{i}位：<@{uid}>  **{pct}%**")
@@ -627,5 +1375,13 @@ async def close(interaction: discord.Interaction):
 # =========================================================
 # 起動
 # =========================================================
-bot.run(TOKEN)
+if __name__ == "__main__":
+    if not TOKEN:
+        raise SystemExit("DISCORD_TOKEN が設定されていません")
+
+    if METRICS_PORT > 0:
+        metrics.start_http_server(METRICS_PORT, METRICS_HOST)
+        print(f"metrics: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+    bot.run(TOKEN)
 
@@ -1,236 +1,1635 @@
+import os
 import sqlite3
 import json
-import random
-from typing import List, Tuple, Optional
+import queue
+import atexit
+import inspect
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterable, Iterator, List, Sequence, Tuple, Optional
 
-DB_PATH = "app.db"
+import metrics
+from question_bank import BANK
+from profiles import VALID_ANS, aggregate, aggregate_category
+from session_cache import MISSING, SessionCache
+from storage import (
+    AnswerResult, AnswerStats, ArchiveResult, SessionStore,
+    new_order_seed, pack_answer, seed_order, unpack_answers,
+)
+from memory_store import MemoryStore
 
+DB_PATH = os.environ.get("DB_PATH", "app.db")
 
-def init_db() -> None:
-    with sqlite3.connect(DB_PATH) as con:
+# =========================================================
+# 接続管理（スレッドごとに1本を使い回す）
+# =========================================================
+# asyncio.to_thread のワーカースレッドは使い回されるので、
+# 1クリックごとの connect / close と WAL 化前の fsync を省ける。
+BUSY_TIMEOUT_SECONDS = 5.0
+CACHED_STATEMENTS = 256           # sqlite3 側のプリペアドステートメントLRU
+PRAGMAS = (
+    # 新しい DB ではテーブル作成・WAL 化より前でないと効かない（既存の DB は init_db で1回だけ VACUUM）
+    "PRAGMA auto_vacuum=INCREMENTAL",
+    "PRAGMA journal_mode=WAL",    # 読み取りが書き込みにブロックされない
+    "PRAGMA synchronous=NORMAL",  # WAL ならチェックポイント時のみ fsync
+    "PRAGMA cache_size=-16000",   # 約16MB
+    "PRAGMA mmap_size=268435456", # 256MB
+    "PRAGMA temp_store=MEMORY",
+)
+
+_local = threading.local()
+_pool_lock = threading.Lock()
+_pool: dict[int, Tuple[threading.Thread, sqlite3.Connection]] = {}
+_pool_stats = {"opened": 0, "closed": 0, "checkouts": 0}
+_generation = 0  # close_all_connections で進める（各スレッドの古い接続を無効化）
+
+
+def _open_connection() -> sqlite3.Connection:
+    con = sqlite3.connect(
+        DB_PATH,
+        timeout=BUSY_TIMEOUT_SECONDS,
+        cached_statements=CACHED_STATEMENTS,
+        check_same_thread=False,  # 終了済みスレッドの接続を別スレッドから close するため
+    )
+    for pragma in PRAGMAS:
+        con.execute(pragma)
+    return con
+
+
+def _prune_dead_threads() -> None:
+    # _pool_lock を取った状態で呼ぶ
+    for ident, (thread, con) in list(_pool.items()):
+        if not thread.is_alive():
+            con.close()
+            del _pool[ident]
+            _pool_stats["closed"] += 1
+
+
+def _connect() -> sqlite3.Connection:
+    """
+    このスレッド用の永続接続を返す。
+    `with _connect() as con:` はトランザクションの commit/rollback だけを行い、接続は閉じない。
+    """
+    con = getattr(_local, "con", None)
+    if con is None or _local.path != DB_PATH or _local.gen != _generation:
+        if con is not None and _local.gen == _generation:
+            close_connection()
+        con = _open_connection()
+        _local.con, _local.path, _local.gen = con, DB_PATH, _generation
+        with _pool_lock:
+            _prune_dead_threads()
+            _pool[threading.get_ident()] = (threading.current_thread(), con)
+            _pool_stats["opened"] += 1
+
+    with _pool_lock:
+        _pool_stats["checkouts"] += 1
+    return con
+
+
+def close_connection() -> None:
+    """このスレッドの接続を閉じる"""
+    con = getattr(_local, "con", None)
+    if con is None:
+        return
+    _local.con = None
+    with _pool_lock:
+        _pool.pop(threading.get_ident(), None)
+        _pool_stats["closed"] += 1
+    con.close()
+
+
+def close_all_connections() -> None:
+    """全スレッドの接続を閉じる（終了時・DB_PATH 切り替え時）"""
+    global _generation
+    with _pool_lock:
+        _generation += 1
+        for _, con in _pool.values():
+            con.close()
+        _pool_stats["closed"] += len(_pool)
+        _pool.clear()
+    _local.con = None
+
+
+def connection_stats() -> dict:
+    """
+    open: 現在開いている接続数 / opened, closed: 累計
+    checkouts: 接続取得回数（opened との差が使い回しの回数）
+    """
+    with _pool_lock:
+        return {"open": len(_pool), **_pool_stats}
+
+# =========================================================
+# セッションキャッシュ（user_state / question_order / user_msg）
+# =========================================================
+# キー: ("state" | "order" | "msg", user_id)
+# 値の更新は各 _xxx(cur, ...) の中（書き込みロック中）で行うので、DBとの前後関係が崩れない。
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", "30000"))
+SESSION_CACHE_TTL = float(os.environ.get("SESSION_CACHE_TTL", "1800"))
+
+_sessions = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+
+def _invalidate_session(user_id: Optional[int]) -> None:
+    if user_id is None:
+        return
+    for table in ("state", "order", "msg"):
+        _sessions.invalidate((table, user_id))
+
+
+def session_cache_stats() -> dict:
+    """size / maxsize / hits / misses / evictions / expirations / invalidations"""
+    return _sessions.snapshot()
+
+
+# =========================================================
+# 書き込み（sync: 1呼び出し1コミット / group・async: 専用スレッドでまとめてコミット）
+# =========================================================
+# sync : 呼び出し元スレッドで即コミット（従来どおり）
+# group: 専用ライタースレッドが GROUP_COMMIT_INTERVAL_MS か GROUP_COMMIT_MAX_WRITES ごとにまとめてコミット。
+#        呼び出しはコミット完了まで待つ（耐久性は sync と同じ）
+# async: 同じくまとめてコミットするが、呼び出しは書き込みが実行された時点で戻る。
+#        耐久性が必要な箇所は flush() で待つ（クラッシュ時は直近数msの書き込みを失いうる）
+DB_WRITE_MODE = os.environ.get("DB_WRITE_MODE", "sync")
+GROUP_COMMIT_INTERVAL_MS = float(os.environ.get("GROUP_COMMIT_INTERVAL_MS", "5"))
+GROUP_COMMIT_MAX_WRITES = int(os.environ.get("GROUP_COMMIT_MAX_WRITES", "256"))
+
+
+class _Op:
+    __slots__ = ("user_id", "fn", "args", "is_write", "executed", "committed")
+
+    def __init__(self, user_id: Optional[int], fn: Callable, args: tuple, is_write: bool):
+        self.user_id = user_id
+        self.fn = fn
+        self.args = args
+        self.is_write = is_write
+        self.executed: Future = Future()   # 実行結果（コミット前）
+        self.committed: Future = Future()  # コミット完了
+
+
+class _GroupWriter:
+    """
+    書き込みを1本のスレッド・1本の接続に集め、バッチ単位で BEGIN IMMEDIATE 〜 COMMIT する。
+    各書き込みは SAVEPOINT で囲むので、1件の失敗がバッチ全体を巻き戻すことはない。
+
+    未コミットの書き込みがあるユーザーの読み取りはライタースレッドに回し、
+    同じトランザクション内で実行する（キュー中・未コミットの書き込みが見える）。
+    """
+
+    def __init__(self, interval_ms: float, max_writes: int):
+        self.interval = interval_ms / 1000.0
+        self.max_writes = max_writes
+        self._q: "queue.Queue[Optional[_Op]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending: Counter = Counter()  # user_id -> 未コミットの書き込み数
+        self._pending_total = 0
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {"batches": 0, "writes": 0, "reads": 0, "failed": 0, "max_batch": 0}
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self) -> None:
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        self._q.put(None)
+        thread.join()
+
+    def has_pending(self, user_id: Optional[int]) -> bool:
+        with self._lock:
+            if user_id is None:
+                return self._pending_total > 0
+            return self._pending[user_id] > 0
+
+    def submit(self, op: _Op) -> Future:
+        self.start()
+        if op.is_write:
+            with self._lock:
+                self._pending[op.user_id] += 1
+                self._pending_total += 1
+        self._q.put(op)
+        return op.executed
+
+    def queue_depth(self) -> int:
+        return self._q.qsize()
+
+    def _run(self) -> None:
+        con = _connect()
         cur = con.cursor()
+        while True:
+            op = self._q.get()
+            if op is None:
+                break
 
-        # --- tables ---
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS user_state (
-            user_id INTEGER PRIMARY KEY,
-            idx INTEGER NOT NULL
-        )
-        """)
+            batch: List[_Op] = []
+            writes = 0
+            deadline = time.monotonic() + self.interval
+            try:
+                cur.execute("BEGIN IMMEDIATE")
+            except Exception as e:
+                op.executed.set_exception(e)
+                self._finish([op], int(op.is_write), e)
+                continue
+            while True:
+                self._execute(cur, op)
+                batch.append(op)
+                writes += op.is_write
+                if writes >= self.max_writes:
+                    break
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    op = self._q.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if op is None:
+                    self._q.put(None)  # コミットしてから終了
+                    break
 
-        # いまのコードが期待する正式スキーマ（question_id / answer）
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS answers (
-            user_id INTEGER NOT NULL,
-            question_id INTEGER NOT NULL,
-            answer TEXT NOT NULL,
-            PRIMARY KEY (user_id, question_id)
-        )
-        """)
+            error: Optional[BaseException] = None
+            try:
+                con.commit()
+            except Exception as e:
+                error = e
+                con.rollback()
+                print("db writer: commit failed:", repr(e))
+                for failed in batch:
+                    _invalidate_session(failed.user_id)
 
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS question_order (
-            user_id INTEGER PRIMARY KEY,
-            order_json TEXT NOT NULL
-        )
-        """)
+            self._finish(batch, writes, error)
+
+    def _execute(self, cur: sqlite3.Cursor, op: _Op) -> None:
+        if not op.is_write:
+            try:
+                op.executed.set_result(op.fn(cur, *op.args))
+            except Exception as e:
+                op.executed.set_exception(e)
+            return
+
+        cur.execute("SAVEPOINT op")
+        try:
+            result = op.fn(cur, *op.args)
+        except Exception as e:
+            cur.execute("ROLLBACK TO op")
+            cur.execute("RELEASE op")
+            _invalidate_session(op.user_id)
+            op.executed.set_exception(e)
+            return
+        cur.execute("RELEASE op")
+        op.executed.set_result(result)
+
+    def _finish(self, batch: List[_Op], writes: int, error: Optional[BaseException]) -> None:
+        with self._lock:
+            for op in batch:
+                if op.is_write:
+                    self._pending[op.user_id] -= 1
+                    if self._pending[op.user_id] <= 0:
+                        del self._pending[op.user_id]
+                    self._pending_total -= 1
+            self.stats["batches"] += 1
+            self.stats["writes"] += writes
+            self.stats["reads"] += len(batch) - writes
+            self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+            if error is not None:
+                self.stats["failed"] += writes
+
+        for op in batch:
+            if error is None:
+                op.committed.set_result(None)
+            else:
+                op.committed.set_exception(error)
+
+
+_writer = _GroupWriter(GROUP_COMMIT_INTERVAL_MS, GROUP_COMMIT_MAX_WRITES)
+
+
+def _write(user_id: Optional[int], fn: Callable, *args):
+    """
+    fn(cur, *args) を書き込みとして実行する。
+    user_id は「未コミットの書き込みがあるか」の追跡に使う（全体に関わる処理は None）
+    """
+    if DB_WRITE_MODE == "sync":
+        try:
+            with _connect() as con:
+                cur = con.cursor()
+                cur.execute("BEGIN IMMEDIATE")
+                result = fn(cur, *args)
+                con.commit()
+                return result
+        except Exception:
+            # ロールバックされた書き込みの値がキャッシュに残らないように
+            _invalidate_session(user_id)
+            raise
+
+    op = _Op(user_id, fn, args, True)
+    result = _writer.submit(op).result()
+    if DB_WRITE_MODE == "group":
+        op.committed.result()
+    return result
+
+
+def _read(user_id: Optional[int], fn: Callable, *args):
+    """
+    fn(cur, *args) を読み取りとして実行する。
+    そのユーザー（None なら誰か）に未コミットの書き込みがあればライタースレッドで読む。
+    """
+    if DB_WRITE_MODE != "sync" and _writer.has_pending(user_id):
+        return _writer.submit(_Op(user_id, fn, args, False)).result()
+
+    with _connect() as con:
+        return fn(con.cursor(), *args)
+
+
+def _flush_writer() -> None:
+    if DB_WRITE_MODE == "sync":
+        return
+    op = _Op(None, lambda cur: None, (), False)
+    _writer.submit(op)
+    op.committed.result()
+
+
+def flush() -> None:
+    """
+    ここまでに受け付けた書き込みがすべてコミットされるまで待つ（sync モードでは何もしない）
+    STORAGE_BACKEND=memory ならセッションの操作ログの書き出しも待つ
+    """
+    _flush_writer()
+    if _store is not _sqlite_store:
+        _store.flush()
 
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS user_msg (
-            user_id INTEGER PRIMARY KEY,
-            message_id INTEGER NOT NULL
-        )
-        """)
 
-        # --- migration: old schema (qid/ans) -> new schema (question_id/answer) ---
-        _migrate_answers_table(cur)
+def stop_writer() -> None:
+    """未コミット分をコミットしてライタースレッドを止める（終了時）。メモリ版の保存先も書き出して閉じる"""
+    if _store is not _sqlite_store:
+        _store.close()
+    _writer.stop()
 
-        con.commit()
 
+def writer_stats() -> dict:
+    with _writer._lock:
+        stats = dict(_writer.stats)
+        stats["pending"] = _writer._pending_total
+    stats["mode"] = DB_WRITE_MODE
+    stats["queue_depth"] = _writer.queue_depth()
+    return stats
+
+
+atexit.register(stop_writer)
+
+
+# =========================================================
+# スキーマ（PRAGMA user_version で管理するマイグレーション）
+# =========================================================
+# 起動時に init_db() が未適用の分だけ順に流す。適用後のスキーマは固定なので、
+# 通常の読み書きでテーブル構造を調べる（PRAGMA table_info）ことはしない。
+# マイグレーションを追加するときは MIGRATIONS の末尾に足すだけ（番号は変えない）。
 
 def _table_columns(cur: sqlite3.Cursor, table: str) -> list[str]:
     cur.execute(f"PRAGMA table_info({table})")
     return [r[1] for r in cur.fetchall()]
 
 
-def _add_column_if_missing(cur: sqlite3.Cursor, table: str, col: str, coldef: str) -> None:
-    cols = _table_columns(cur, table)
-    if col not in cols:
-        cur.execute(f"ALTER TABLE {table} ADD COLUMN {col} {coldef}")
+def _m1_base_tables(cur: sqlite3.Cursor) -> None:
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_state (
+        user_id INTEGER PRIMARY KEY,
+        idx INTEGER NOT NULL
+    )
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS answers (
+        user_id INTEGER NOT NULL,
+        question_id INTEGER NOT NULL,
+        answer TEXT NOT NULL,
+        PRIMARY KEY (user_id, question_id)
+    )
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS question_order (
+        user_id INTEGER PRIMARY KEY,
+        order_json TEXT NOT NULL
+    )
+    """)
 
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_msg (
+        user_id INTEGER PRIMARY KEY,
+        message_id INTEGER NOT NULL
+    )
+    """)
 
-def _migrate_answers_table(cur: sqlite3.Cursor) -> None:
+
+def _m2_rebuild_answers(cur: sqlite3.Cursor) -> None:
     """
+    answers を (user_id, question_id) を主キーとする WITHOUT ROWID テーブルに作り直す。
     旧 answers: (user_id, qid, ans) PRIMARY KEY(user_id, qid)
-    新 answers: (user_id, question_id, answer) PRIMARY KEY(user_id, question_id)
-
-    旧列が存在していた場合は新列へコピーし、以後は新列で運用。
+    途中まで移行した旧DB（qid/ans と question_id/answer が混在）もここで1本化する。
     """
     cols = _table_columns(cur, "answers")
+    if "qid" in cols and "question_id" in cols:
+        qexpr, aexpr = "COALESCE(question_id, qid)", "COALESCE(answer, ans)"
+    elif "qid" in cols:
+        qexpr, aexpr = "qid", "ans"
+    else:
+        qexpr, aexpr = "question_id", "answer"
+
+    cur.execute("""
+    CREATE TABLE answers_new (
+        user_id INTEGER NOT NULL,
+        question_id INTEGER NOT NULL,
+        answer TEXT NOT NULL,
+        PRIMARY KEY (user_id, question_id)
+    ) WITHOUT ROWID
+    """)
+    cur.execute(f"""
+    INSERT OR REPLACE INTO answers_new(user_id, question_id, answer)
+    SELECT user_id, {qexpr}, {aexpr}
+    FROM answers
+    WHERE {qexpr} IS NOT NULL AND {aexpr} IS NOT NULL
+    ORDER BY rowid
+    """)
+    cur.execute("DROP TABLE answers")
+    cur.execute("ALTER TABLE answers_new RENAME TO answers")
+
+    # /logs の idx 条件つき COUNT 用
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_state_idx ON user_state(idx)")
+
+
+def _m3_profiles(cur: sqlite3.Cursor) -> None:
+    # プロフィール（回答の集計結果）。save_answer / set_state と同じトランザクションで更新する
+    # picks / meters / counts はカテゴリをキーにした JSON
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS profiles (
+        user_id INTEGER PRIMARY KEY,
+        picks TEXT NOT NULL,
+        meters TEXT NOT NULL,
+        counts TEXT NOT NULL,
+        completed INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_profiles_completed ON profiles(completed)")
+
+    # 既存DBに profiles を追加した直後は answers から作っておく（この時点の answers は1回答1行）
+    cur.execute("SELECT 1 FROM profiles LIMIT 1")
+    if cur.fetchone() is None:
+        _write_profiles(cur, _legacy_answer_rows(cur))
+
+
+def _m4_meta(cur: sqlite3.Cursor) -> None:
+    # 小さな設定値・バージョン類（bank_version など）
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )
+    """)
+
+
+def _m5_user_rooms(cur: sqlite3.Cursor) -> None:
+    # 診断ルーム（channel_id はギルドをまたいで一意）
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_rooms (
+        guild_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        channel_id INTEGER NOT NULL UNIQUE,
+        PRIMARY KEY (guild_id, user_id)
+    )
+    """)
+
+
+def _m6_room_deadlines(cur: sqlite3.Cursor) -> None:
+    # ルーム自動削除の期限（due_at は UNIX 時刻）。再起動後もここから再開する
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS room_deadlines (
+        channel_id INTEGER PRIMARY KEY,
+        guild_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        due_at REAL NOT NULL
+    )
+    """)
+
+
+def _m7_stats_counters(cur: sqlite3.Cursor) -> None:
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS stats_counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )
+    """)
+    _recount_users(cur)
+
+
+def _m8_match_lists(cur: sqlite3.Cursor) -> None:
+    # entries: [[相性％, user_id], ...]（相性の高い順）。中身は起動時に bot.py が作る
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS match_lists (
+        user_id INTEGER PRIMARY KEY,
+        entries TEXT NOT NULL
+    )
+    """)
 
-    # もし旧スキーマで作られてしまっている場合、列を追加してデータをコピーする
-    if "qid" in cols and "ans" in cols:
-        _add_column_if_missing(cur, "answers", "question_id", "INTEGER")
-        _add_column_if_missing(cur, "answers", "answer", "TEXT")
 
-        # まだコピーしていない行だけコピー（question_idがNULLのもの）
+def _legacy_answer_rows(cur: sqlite3.Cursor) -> Iterator[Tuple[int, List[Tuple[int, str]], int]]:
+    """1回答1行の answers から (user_id, [(question_id, answer), ...], idx) をユーザー順に"""
+    cur.execute("""
+    SELECT a.user_id, a.question_id, a.answer, COALESCE(s.idx, 0)
+    FROM answers a
+    LEFT JOIN user_state s ON s.user_id = a.user_id
+    ORDER BY a.user_id, a.question_id
+    """)
+    uid, answers, idx = None, [], 0
+    for row_uid, qid, ans, row_idx in cur.fetchall():
+        if row_uid != uid:
+            if uid is not None:
+                yield uid, answers, idx
+            uid, answers, idx = int(row_uid), [], int(row_idx)
+        answers.append((int(qid), ans))
+    if uid is not None:
+        yield uid, answers, idx
+
+
+def _m9_pack_answers(cur: sqlite3.Cursor) -> None:
+    """
+    answers（1回答1行・ユーザーあたり30行＋主キー索引）を answer_vectors（1ユーザー1行）に詰め直す。
+    1文字でない回答は詰められないので捨てる（ボタンの回答は A〜E のみ）
+    """
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS answer_vectors (
+        user_id INTEGER PRIMARY KEY,
+        answers BLOB NOT NULL
+    )
+    """)
+    rows, dropped = [], 0
+    for uid, answers, _ in _legacy_answer_rows(cur):
+        blob = b""
+        for qid, ans in answers:
+            try:
+                blob = pack_answer(blob, qid, ans)
+            except ValueError:
+                dropped += 1
+        if blob:
+            rows.append((uid, blob))
+    cur.executemany("INSERT OR REPLACE INTO answer_vectors(user_id, answers) VALUES(?, ?)", rows)
+    cur.execute("DROP TABLE answers")
+    if dropped:
+        print(f"pack answers: dropped {dropped} answers that are not a single character")
+
+
+def _m10_order_seeds(cur: sqlite3.Cursor) -> None:
+    """
+    question_order を「ユーザーごとの 64bit シード1個」の形に作り直す。
+    既存の order_json 行はそのまま移し、そのユーザーがリセットするまで読めるようにする
+    """
+    cur.execute("""
+    CREATE TABLE question_order_new (
+        user_id INTEGER PRIMARY KEY,
+        seed INTEGER,
+        order_json TEXT,
+        CHECK (seed IS NOT NULL OR order_json IS NOT NULL)
+    )
+    """)
+    cur.execute("INSERT INTO question_order_new(user_id, order_json) SELECT user_id, order_json FROM question_order")
+    cur.execute("DROP TABLE question_order")
+    cur.execute("ALTER TABLE question_order_new RENAME TO question_order")
+
+
+def _m11_session_archive(cur: sqlite3.Cursor) -> None:
+    """
+    user_state に最終更新時刻を足し（既存の行は移行時刻から数える）、
+    放置・退出ユーザーのセッションを移す archived_sessions を作る
+    """
+    if "updated_at" not in _table_columns(cur, "user_state"):
+        cur.execute("ALTER TABLE user_state ADD COLUMN updated_at REAL")
+    cur.execute("UPDATE user_state SET updated_at=? WHERE updated_at IS NULL", (time.time(),))
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_state_updated ON user_state(updated_at)")
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS archived_sessions (
+        user_id INTEGER PRIMARY KEY,
+        idx INTEGER NOT NULL,
+        answers BLOB,
+        order_seed INTEGER,
+        order_json TEXT,
+        updated_at REAL,
+        reason TEXT NOT NULL,
+        archived_at REAL NOT NULL
+    )
+    """)
+
+
+def _m12_answer_stats(cur: sqlite3.Cursor) -> None:
+    """
+    回答イベント（追記のみ）と、そこから足し込む集計テーブル。
+    集計は今ある回答（answer_vectors）と進み具合（user_state）から初期化する（過去のイベントは残っていない）
+    """
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS answer_events (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        question_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        answer TEXT NOT NULL,
+        at REAL NOT NULL
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS question_answer_counts (
+        question_id INTEGER NOT NULL,
+        answer TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (question_id, answer)
+    ) WITHOUT ROWID
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS funnel_counts (
+        step INTEGER PRIMARY KEY,
+        count INTEGER NOT NULL
+    )
+    """)
+
+    counts: Counter = Counter()
+    cur.execute("SELECT answers FROM answer_vectors")
+    for (blob,) in cur.fetchall():
+        counts.update(unpack_answers(blob))
+    cur.executemany(
+        "INSERT OR REPLACE INTO question_answer_counts(question_id, answer, count) VALUES(?, ?, ?)",
+        [(qid, ans, n) for (qid, ans), n in counts.items()]
+    )
+
+    # step k = idx >= k の人数（idx ごとの人数を後ろから足す）
+    cur.execute("SELECT MIN(idx, ?), COUNT(*) FROM user_state GROUP BY 1", (len(BANK),))
+    at_idx = dict(cur.fetchall())
+    reached = 0
+    funnel = []
+    for step in range(len(BANK), -1, -1):
+        reached += at_idx.get(step, 0)
+        funnel.append((step, reached))
+    cur.executemany("INSERT OR REPLACE INTO funnel_counts(step, count) VALUES(?, ?)", funnel)
+
+
+MIGRATIONS: List[Tuple[str, Callable[[sqlite3.Cursor], None]]] = [
+    ("base_tables", _m1_base_tables),
+    ("rebuild_answers", _m2_rebuild_answers),
+    ("profiles", _m3_profiles),
+    ("meta", _m4_meta),
+    ("user_rooms", _m5_user_rooms),
+    ("room_deadlines", _m6_room_deadlines),
+    ("stats_counters", _m7_stats_counters),
+    ("match_lists", _m8_match_lists),
+    ("pack_answers", _m9_pack_answers),
+    ("order_seeds", _m10_order_seeds),
+    ("session_archive", _m11_session_archive),
+    ("answer_stats", _m12_answer_stats),
+]
+
+# 直近の init_db() で適用したマイグレーション [(version, name, 秒)]
+migration_report: List[Tuple[int, str, float]] = []
+
+
+def init_db() -> None:
+    con = _connect()
+    cur = con.cursor()
+    cur.execute("PRAGMA user_version")
+    current = int(cur.fetchone()[0])
+
+    migration_report.clear()
+    _sessions.clear()
+    for version, (name, migrate) in enumerate(MIGRATIONS, start=1):
+        if version <= current:
+            continue
+        t0 = time.perf_counter()
+        with con:
+            cur.execute("BEGIN IMMEDIATE")
+            migrate(cur)
+            cur.execute(f"PRAGMA user_version = {version}")
+        elapsed = time.perf_counter() - t0
+        migration_report.append((version, name, elapsed))
+        print(f"db migration v{version} {name}: {elapsed * 1000:.1f}ms")
+
+    # 質問バンクが変わっていたら profiles を作り直す（初回は記録だけ）
+    with con:
+        cur.execute("BEGIN IMMEDIATE")
+        stored = _get_meta(cur, "bank_version")
+        if stored is not None and stored != BANK.version:
+            n = _rebuild_profiles(cur)
+            cur.execute("DELETE FROM match_lists")
+            _recount_users(cur)  # 「完了」の基準（質問数）も変わりうる
+            print(f"question bank changed ({stored} -> {BANK.version}): rebuilt {n} profiles")
+        _set_meta(cur, "bank_version", BANK.version)
+
+    # 新しい DB は _open_connection で INCREMENTAL になっている。
+    # それ以前からの DB は1回だけ VACUUM して incremental_vacuum できる形にする（compact_sessions の空き領域の返却用）
+    cur.execute("PRAGMA auto_vacuum")
+    if int(cur.fetchone()[0]) != 2:
+        t0 = time.perf_counter()
+        cur.execute("VACUUM")
+        print(f"db auto_vacuum=INCREMENTAL: vacuumed in {(time.perf_counter() - t0) * 1000:.1f}ms")
+
+    _open_store()
+
+
+def _get_meta(cur: sqlite3.Cursor, key: str) -> Optional[str]:
+    cur.execute("SELECT value FROM meta WHERE key=?", (key,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def _set_meta(cur: sqlite3.Cursor, key: str, value: str) -> None:
+    cur.execute("""
+    INSERT INTO meta(key, value) VALUES(?, ?)
+    ON CONFLICT(key) DO UPDATE SET value=excluded.value
+    """, (key, value))
+
+
+def get_meta(key: str) -> Optional[str]:
+    return _read(None, _get_meta, key)
+
+
+def set_meta(key: str, value: str) -> None:
+    _write(None, _set_meta, key, value)
+
+
+def _update_profile_category(cur: sqlite3.Cursor, user_id: int, question_id: int, blob: bytes) -> None:
+    """
+    回答したカテゴリ（最大5問）だけ集計し直して profiles に反映する
+    blob: 保存後の回答ベクトル
+    """
+    cat = BANK.category_of.get(question_id)
+    if not cat:
+        return
+    letters = [
+        chr(blob[q]) for q in BANK.ids_by_category[cat]
+        if q < len(blob) and chr(blob[q]) in VALID_ANS
+    ]
+
+    cur.execute("SELECT picks, meters, counts FROM profiles WHERE user_id=?", (user_id,))
+    row = cur.fetchone()
+    picks, meters, counts = (json.loads(x) for x in row) if row else ({}, {}, {})
+
+    if letters:
+        picks[cat], meters[cat], counts[cat] = aggregate_category(letters)
+    else:
+        picks.pop(cat, None)
+        meters.pop(cat, None)
+        counts.pop(cat, None)
+
+    cur.execute("""
+    INSERT INTO profiles(user_id, picks, meters, counts) VALUES(?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        picks=excluded.picks, meters=excluded.meters, counts=excluded.counts
+    """, (user_id, json.dumps(picks), json.dumps(meters), json.dumps(counts)))
+
+
+def _answer_rows(cur: sqlite3.Cursor) -> Iterator[Tuple[int, List[Tuple[int, str]], int]]:
+    """(user_id, [(question_id, answer), ...], idx) を全ユーザー分"""
+    cur.execute("""
+    SELECT v.user_id, v.answers, COALESCE(s.idx, 0)
+    FROM answer_vectors v
+    LEFT JOIN user_state s ON s.user_id = v.user_id
+    """)
+    for uid, blob, idx in cur.fetchall():
+        yield int(uid), unpack_answers(blob), int(idx)
+
+
+def _rebuild_profiles(cur: sqlite3.Cursor) -> int:
+    return _write_profiles(cur, _answer_rows(cur))
+
+
+def _write_profiles(cur: sqlite3.Cursor, answer_rows: Iterable[Tuple[int, List[Tuple[int, str]], int]]) -> int:
+    rows = []
+    for uid, answers, idx in answer_rows:
+        picks, meters, counts = aggregate(answers)
+        completed = 1 if idx >= len(BANK) else 0
+        rows.append((uid, json.dumps(picks), json.dumps(meters), json.dumps(counts), completed))
+
+    cur.execute("DELETE FROM profiles")
+    cur.executemany(
+        "INSERT INTO profiles(user_id, picks, meters, counts, completed) VALUES(?, ?, ?, ?, ?)",
+        rows
+    )
+    return len(rows)
+
+
+# --- 回答ベクトル（1ユーザー1行。詰め方は storage.pack_answer / unpack_answers）---
+def _get_answer_vector(cur: sqlite3.Cursor, user_id: int) -> bytes:
+    cur.execute("SELECT answers FROM answer_vectors WHERE user_id=?", (user_id,))
+    row = cur.fetchone()
+    return bytes(row[0]) if row else b""
+
+
+def _get_state(cur: sqlite3.Cursor, user_id: int) -> Optional[int]:
+    cur.execute("SELECT idx FROM user_state WHERE user_id=?", (user_id,))
+    row = cur.fetchone()
+    idx = int(row[0]) if row else None
+    if idx is not None:
+        _sessions.fill(("state", user_id), idx)
+    return idx
+
+
+def _init_state(cur: sqlite3.Cursor, user_id: int) -> None:
+    cur.execute("INSERT OR IGNORE INTO user_state(user_id, idx, updated_at) VALUES(?, 0, ?)", (user_id, time.time()))
+    if cur.rowcount == 1:
+        _count_state_change(cur, None, 0)
+    _sessions.invalidate(("state", user_id))
+
+
+def _set_state(cur: sqlite3.Cursor, user_id: int, idx: int, expected: Optional[int] = None) -> bool:
+    """
+    expected を渡すと「現在値が expected のときだけ」更新する（読まずに判定できる）
+    戻り値: 更新したか
+    """
+    if expected is None:
+        old = _get_state(cur, user_id)
         cur.execute("""
-        UPDATE answers
-        SET question_id = qid
-        WHERE question_id IS NULL
-        """)
+        INSERT INTO user_state(user_id, idx, updated_at) VALUES(?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET idx=excluded.idx, updated_at=excluded.updated_at
+        """, (user_id, idx, time.time()))
+    else:
+        cur.execute(
+            "UPDATE user_state SET idx=?, updated_at=? WHERE user_id=? AND idx=?",
+            (idx, time.time(), user_id, expected)
+        )
+        if cur.rowcount != 1:
+            _sessions.invalidate(("state", user_id))
+            return False
+        old = expected
+
+    _count_state_change(cur, old, idx)
+
+    cur.execute(
+        "UPDATE profiles SET completed=? WHERE user_id=?",
+        (1 if idx >= len(BANK) else 0, user_id)
+    )
+    _sessions.put(("state", user_id), idx)
+    return True
+
+
+def _save_answer(cur: sqlite3.Cursor, user_id: int, question_id: int, answer: str) -> None:
+    # 書き込みロック中なので 読む → 1バイト書き換える → 書く の間に他の書き込みは入らない
+    blob = pack_answer(_get_answer_vector(cur, user_id), question_id, answer)
+    cur.execute("""
+    INSERT INTO answer_vectors(user_id, answers) VALUES(?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET answers=excluded.answers
+    """, (user_id, blob))
+
+    _update_profile_category(cur, user_id, question_id, blob)
+
+
+def _record_answer(cur: sqlite3.Cursor, user_id: int, idx: int, answer: str, question_ids: Sequence[int]) -> AnswerResult:
+    # キャッシュは書き込みロックの中で読む（外で読むと、間に入った start_session より前の order / message_id を使ってしまう）
+    order = _sessions.get(("order", user_id))
+    if order is MISSING:
+        order = _get_or_create_order(cur, user_id, question_ids)
+    mid = _sessions.get(("msg", user_id))
+    if mid is MISSING:
+        mid = _get_message_id(cur, user_id)
+
+    # 押されたボタンの idx が現在の state と一致するときだけ進める。
+    # 条件付き UPDATE なので state を読まずに判定できる（一致しなかったときだけ読む）
+    accepted = False
+    if 0 <= idx < len(order):
+        accepted = _set_state(cur, user_id, idx + 1, expected=idx)
+        if not accepted and idx == 0 and _get_state(cur, user_id) is None:
+            # まだ state 行が無い（初回の1問目）
+            _set_state(cur, user_id, 1)
+            accepted = True
+
+    if not accepted:
+        cur_idx = _get_state(cur, user_id) or 0
+        return AnswerResult(order, cur_idx, cur_idx, cur_idx >= len(order), mid, False)
+
+    _save_answer(cur, user_id, order[idx], answer)
+    _record_answer_event(cur, user_id, order[idx], idx, answer)
+
+    next_idx = idx + 1
+    return AnswerResult(order, idx, next_idx, next_idx >= len(order), mid)
+
+
+def _load_answers(cur: sqlite3.Cursor, user_id: int) -> List[Tuple[int, str]]:
+    return unpack_answers(_get_answer_vector(cur, user_id))
+
+
+def _get_profile(cur: sqlite3.Cursor, user_id: int) -> Tuple[dict, dict]:
+    cur.execute("SELECT picks, meters FROM profiles WHERE user_id=?", (user_id,))
+    row = cur.fetchone()
+    if row is None:
+        return {}, {}
+    return json.loads(row[0]), json.loads(row[1])
+
+
+def _load_completed_profiles(cur: sqlite3.Cursor) -> List[Tuple[int, dict]]:
+    cur.execute("SELECT user_id, picks FROM profiles WHERE completed=1")
+    return [(int(uid), json.loads(picks)) for uid, picks in cur.fetchall()]
+
+
+# --- 相性の上位リスト（/match は1行読むだけ）---
+MatchList = List[Tuple[int, int]]
+
+
+def _save_match_lists(cur: sqlite3.Cursor, lists: Dict[int, MatchList]) -> None:
+    cur.executemany(
+        "INSERT OR REPLACE INTO match_lists(user_id, entries) VALUES(?, ?)",
+        [(uid, json.dumps(entries, separators=(",", ":"))) for uid, entries in lists.items()]
+    )
+
+
+def save_match_lists(lists: Dict[int, MatchList]) -> None:
+    """変わったリストだけを書く {user_id: [(相性％, user_id), ...]}"""
+    if lists:
+        _write(None, _save_match_lists, lists)
+
+
+def _replace_match_lists(cur: sqlite3.Cursor, lists: Dict[int, MatchList]) -> None:
+    cur.execute("DELETE FROM match_lists")
+    _save_match_lists(cur, lists)
+
+
+def replace_match_lists(lists: Dict[int, MatchList]) -> None:
+    """全員分を置き換える（一括再作成）"""
+    _write(None, _replace_match_lists, lists)
+
+
+def _get_match_list(cur: sqlite3.Cursor, user_id: int) -> Optional[MatchList]:
+    cur.execute("SELECT entries FROM match_lists WHERE user_id=?", (user_id,))
+    row = cur.fetchone()
+    return [(int(p), int(u)) for p, u in json.loads(row[0])] if row else None
+
+
+def get_match_list(user_id: int) -> Optional[MatchList]:
+    """[(相性％, user_id), ...] / 診断未完了なら None"""
+    return _read(None, _get_match_list, user_id)
+
+
+def _load_match_lists(cur: sqlite3.Cursor) -> Dict[int, MatchList]:
+    cur.execute("SELECT user_id, entries FROM match_lists")
+    return {int(uid): [(int(p), int(u)) for p, u in json.loads(entries)] for uid, entries in cur.fetchall()}
+
+
+def load_match_lists() -> Dict[int, MatchList]:
+    return _read(None, _load_match_lists)
+
+
+def _reset_user(cur: sqlite3.Cursor, user_id: int) -> None:
+    old = _get_state(cur, user_id)
+    cur.execute("DELETE FROM answer_vectors WHERE user_id=?", (user_id,))
+    cur.execute("DELETE FROM profiles WHERE user_id=?", (user_id,))
+    cur.execute("DELETE FROM match_lists WHERE user_id=?", (user_id,))
+    cur.execute("DELETE FROM user_state WHERE user_id=?", (user_id,))
+    _count_state_change(cur, old, None)
+    _sessions.invalidate(("state", user_id))
+
+
+def _count(cur: sqlite3.Cursor, sql: str, params: tuple = ()) -> int:
+    cur.execute(sql, params)
+    return int(cur.fetchone()[0])
+
+
+# --- 集計カウンタ（/logs 用）---
+# user_state が変わるたびに同じトランザクションで増減させるので、/logs は2行読むだけ。
+# count_* は元テーブルを数え直す版（整合性チェック用）
+
+def _count_state_change(cur: sqlite3.Cursor, old: Optional[int], new: Optional[int]) -> None:
+    """user_state の1行が old → new（None は行なし）になったときのカウンタ増減"""
+    n = len(BANK)
+    d_total = (new is not None) - (old is not None)
+    d_completed = (new is not None and new >= n) - (old is not None and old >= n)
+    if d_total:
+        cur.execute("UPDATE stats_counters SET value = value + ? WHERE name='total_users'", (d_total,))
+    if d_completed:
+        cur.execute("UPDATE stats_counters SET value = value + ? WHERE name='completed_users'", (d_completed,))
+
+
+def _recount_users(cur: sqlite3.Cursor) -> dict:
+    counts = {
+        "total_users": _count(cur, "SELECT COUNT(*) FROM user_state"),
+        "completed_users": _count(cur, "SELECT COUNT(*) FROM user_state WHERE idx >= ?", (len(BANK),)),
+    }
+    cur.executemany(
+        "INSERT OR REPLACE INTO stats_counters(name, value) VALUES(?, ?)",
+        list(counts.items())
+    )
+    return counts
+
+
+def _get_user_counters(cur: sqlite3.Cursor) -> dict:
+    cur.execute("SELECT name, value FROM stats_counters")
+    counters = {name: int(value) for name, value in cur.fetchall()}
+    total = counters.get("total_users", 0)
+    completed = counters.get("completed_users", 0)
+    return {"total": total, "completed": completed, "inprogress": total - completed}
+
+
+# --- 回答の分析（/answer_stats 用）---
+# 回答1件ごとに answer_events へ1行追記し、同じトランザクションで
+#   question_answer_counts: 質問 × 回答の件数
+#   funnel_counts: step 0 = 開始したセッション数 / step k = k 問目まで答えたセッション数（出題順の位置）
+# を1ずつ足す。/answer_stats は集計済みの行（質問数 × 5 + 質問数 + 1 行）を読むだけ。
+# どちらも累計（やり直し前の回答も数える）
+
+
+def _bump_funnel(cur: sqlite3.Cursor, step: int) -> None:
+    cur.execute("""
+    INSERT INTO funnel_counts(step, count) VALUES(?, 1)
+    ON CONFLICT(step) DO UPDATE SET count = count + 1
+    """, (step,))
+
+
+def _record_answer_event(cur: sqlite3.Cursor, user_id: int, question_id: int, position: int, answer: str) -> None:
+    cur.execute(
+        "INSERT INTO answer_events(user_id, question_id, position, answer, at) VALUES(?, ?, ?, ?, ?)",
+        (user_id, question_id, position, answer, time.time())
+    )
+    cur.execute("""
+    INSERT INTO question_answer_counts(question_id, answer, count) VALUES(?, ?, 1)
+    ON CONFLICT(question_id, answer) DO UPDATE SET count = count + 1
+    """, (question_id, answer))
+    _bump_funnel(cur, position + 1)
+
+
+def _get_answer_stats(cur: sqlite3.Cursor) -> AnswerStats:
+    funnel = [0] * (len(BANK) + 1)
+    cur.execute("SELECT step, count FROM funnel_counts WHERE step <= ?", (len(BANK),))
+    for step, count in cur.fetchall():
+        funnel[step] = count
+    answers: Dict[int, Dict[str, int]] = {}
+    cur.execute("SELECT question_id, answer, count FROM question_answer_counts")
+    for qid, ans, count in cur.fetchall():
+        answers.setdefault(qid, {})[ans] = count
+    return AnswerStats(funnel, answers)
+
+
+# 出題順は storage.seed_order（DB にはシードだけを持つ）
+def _get_or_create_order(cur: sqlite3.Cursor, user_id: int, question_ids: Sequence[int]) -> Sequence[int]:
+    cur.execute("SELECT seed, order_json FROM question_order WHERE user_id=?", (user_id,))
+    row = cur.fetchone()
+    if row:
+        seed, order_json = row
+        # order_json は v10 より前に作られた行（リセットするまでそのまま使う）
+        ids = seed_order(seed, BANK.version, tuple(question_ids)) if seed is not None else json.loads(order_json)
+        _sessions.fill(("order", user_id), ids)
+        return ids
+
+    seed = new_order_seed()
+    cur.execute("INSERT OR REPLACE INTO question_order(user_id, seed) VALUES(?, ?)", (user_id, seed))
+    ids = seed_order(seed, BANK.version, tuple(question_ids))
+    _sessions.put(("order", user_id), ids)
+    return ids
+
+
+def _reset_order(cur: sqlite3.Cursor, user_id: int) -> None:
+    cur.execute("DELETE FROM question_order WHERE user_id=?", (user_id,))
+    _sessions.invalidate(("order", user_id))
+
+
+def _get_message_id(cur: sqlite3.Cursor, user_id: int) -> Optional[int]:
+    cur.execute("SELECT message_id FROM user_msg WHERE user_id=?", (user_id,))
+    row = cur.fetchone()
+    mid = int(row[0]) if row else None
+    _sessions.fill(("msg", user_id), mid)
+    return mid
+
+
+def _set_message_id(cur: sqlite3.Cursor, user_id: int, message_id: int) -> None:
+    cur.execute("""
+    INSERT INTO user_msg(user_id, message_id) VALUES(?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET message_id=excluded.message_id
+    """, (user_id, message_id))
+    _sessions.put(("msg", user_id), message_id)
+
+
+def _reset_message_id(cur: sqlite3.Cursor, user_id: int) -> None:
+    cur.execute("DELETE FROM user_msg WHERE user_id=?", (user_id,))
+    _sessions.invalidate(("msg", user_id))
+
+
+def _start_session(cur: sqlite3.Cursor, user_id: int, question_ids: Sequence[int]) -> Sequence[int]:
+    _reset_user(cur, user_id)
+    _reset_order(cur, user_id)
+    _reset_message_id(cur, user_id)
+    _set_state(cur, user_id, 0)
+    _bump_funnel(cur, 0)
+    return _get_or_create_order(cur, user_id, question_ids)
+
+
+def _save_room(cur: sqlite3.Cursor, guild_id: int, user_id: int, channel_id: int) -> None:
+    cur.execute("DELETE FROM user_rooms WHERE channel_id=?", (channel_id,))
+    cur.execute("""
+    INSERT INTO user_rooms(guild_id, user_id, channel_id) VALUES(?, ?, ?)
+    ON CONFLICT(guild_id, user_id) DO UPDATE SET channel_id=excluded.channel_id
+    """, (guild_id, user_id, channel_id))
+
+
+def save_room(guild_id: int, user_id: int, channel_id: int) -> None:
+    _write(None, _save_room, guild_id, user_id, channel_id)
+
+
+def _delete_room(cur: sqlite3.Cursor, channel_id: int) -> None:
+    cur.execute("DELETE FROM user_rooms WHERE channel_id=?", (channel_id,))
+
+
+def delete_room(channel_id: int) -> None:
+    _write(None, _delete_room, channel_id)
+
+
+def _replace_guild_rooms(cur: sqlite3.Cursor, guild_id: int, rooms: List[Tuple[int, int]]) -> None:
+    cur.execute("DELETE FROM user_rooms WHERE guild_id=?", (guild_id,))
+    cur.executemany(
+        "INSERT OR REPLACE INTO user_rooms(guild_id, user_id, channel_id) VALUES(?, ?, ?)",
+        [(guild_id, uid, cid) for uid, cid in rooms]
+    )
+
+
+def replace_guild_rooms(guild_id: int, rooms: List[Tuple[int, int]]) -> None:
+    """ギルドのルーム一覧を丸ごと置き換える（起動時の再構築）rooms: [(user_id, channel_id), ...]"""
+    _write(None, _replace_guild_rooms, guild_id, rooms)
+
+
+def count_rooms(guild_id: int) -> int:
+    """user_rooms の件数（RoomRegistry との整合性チェック用）"""
+    return _read(None, _count, "SELECT COUNT(*) FROM user_rooms WHERE guild_id=?", (guild_id,))
+
+
+def _add_room_deadline(cur: sqlite3.Cursor, channel_id: int, guild_id: int, user_id: int, due_at: float) -> None:
+    cur.execute("""
+    INSERT INTO room_deadlines(channel_id, guild_id, user_id, due_at) VALUES(?, ?, ?, ?)
+    ON CONFLICT(channel_id) DO UPDATE SET
+        guild_id=excluded.guild_id, user_id=excluded.user_id, due_at=excluded.due_at
+    """, (channel_id, guild_id, user_id, due_at))
+
+
+def add_room_deadline(channel_id: int, guild_id: int, user_id: int, due_at: float) -> None:
+    _write(None, _add_room_deadline, channel_id, guild_id, user_id, due_at)
+
+
+def _delete_room_deadlines(cur: sqlite3.Cursor, channel_ids: List[int]) -> None:
+    cur.executemany("DELETE FROM room_deadlines WHERE channel_id=?", [(cid,) for cid in channel_ids])
+
+
+def delete_room_deadlines(channel_ids: List[int]) -> None:
+    _write(None, _delete_room_deadlines, channel_ids)
+
+
+def _load_room_deadlines(cur: sqlite3.Cursor) -> List[Tuple[int, int, int, float]]:
+    cur.execute("SELECT channel_id, guild_id, user_id, due_at FROM room_deadlines ORDER BY due_at")
+    return [(int(c), int(g), int(u), float(d)) for c, g, u, d in cur.fetchall()]
+
+
+def load_room_deadlines() -> List[Tuple[int, int, int, float]]:
+    """[(channel_id, guild_id, user_id, due_at), ...]"""
+    return _read(None, _load_room_deadlines)
+
+
+# --- 放置・退出ユーザーのセッション整理（bot.py の compact_sessions から少しずつ呼ぶ）---
+# 対象ユーザーの user_state / answer_vectors / question_order を archived_sessions の1行にまとめ、
+# user_msg / profiles / match_lists は消す（再開するときは start_session で作り直す）
+
+
+def _find_stale_sessions(cur: sqlite3.Cursor, cutoff: float, limit: int) -> List[int]:
+    cur.execute(
+        "SELECT user_id FROM user_state WHERE updated_at < ? AND idx < ? ORDER BY updated_at LIMIT ?",
+        (cutoff, len(BANK), limit)
+    )
+    return [int(r[0]) for r in cur.fetchall()]
+
+
+def _list_session_users(cur: sqlite3.Cursor) -> List[int]:
+    cur.execute("SELECT user_id FROM user_state")
+    return [int(r[0]) for r in cur.fetchall()]
+
+
+def _archive_sessions(cur: sqlite3.Cursor, user_ids: Sequence[int], reason: str) -> ArchiveResult:
+    now = time.time()
+    users, rows = [], 0
+    for user_id in user_ids:
+        cur.execute("SELECT idx, updated_at FROM user_state WHERE user_id=?", (user_id,))
+        state = cur.fetchone()
+        if state is None:
+            continue
+        cur.execute("SELECT seed, order_json FROM question_order WHERE user_id=?", (user_id,))
+        order = cur.fetchone() or (None, None)
         cur.execute("""
-        UPDATE answers
-        SET answer = ans
-        WHERE answer IS NULL
-        """)
+        INSERT OR REPLACE INTO archived_sessions(
+            user_id, idx, answers, order_seed, order_json, updated_at, reason, archived_at
+        ) VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+        """, (user_id, state[0], _get_answer_vector(cur, user_id) or None, order[0], order[1], state[1], reason, now))
 
-        # PRIMARY KEYが旧(user_id,qid)のままでも、
-        # 保存/参照は question_id/answer を使える状態になる。
-        # （完全にPKを変更したいならテーブル作り直しが必要だが、まず動かすことを優先）
+        for table in ("user_state", "answer_vectors", "question_order", "user_msg", "profiles", "match_lists"):
+            cur.execute(f"DELETE FROM {table} WHERE user_id=?", (user_id,))
+            rows += cur.rowcount
+        _count_state_change(cur, state[0], None)
+        _invalidate_session(user_id)
+        users.append((user_id, int(state[0])))
+    return ArchiveResult(users, rows)
 
 
-def get_state(user_id: int) -> int:
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.cursor()
-        cur.execute("SELECT idx FROM user_state WHERE user_id=?", (user_id,))
-        row = cur.fetchone()
-        if row is None:
-            cur.execute("INSERT INTO user_state(user_id, idx) VALUES(?, 0)", (user_id,))
-            con.commit()
+def _incremental_vacuum(cur: sqlite3.Cursor, max_pages: int) -> int:
+    before = _count(cur, "PRAGMA freelist_count")
+    cur.execute(f"PRAGMA incremental_vacuum({int(max_pages)})")
+    cur.fetchall()
+    return before - _count(cur, "PRAGMA freelist_count")
+
+
+def incremental_vacuum(max_pages: int) -> int:
+    """空きページを最大 max_pages ページ OS に返す。戻り値: 返したページ数（0 なら空きなし）"""
+    return _write(None, _incremental_vacuum, max_pages)
+
+
+def _page_stats(cur: sqlite3.Cursor) -> dict:
+    return {name: _count(cur, f"PRAGMA {name}") for name in ("page_size", "page_count", "freelist_count")}
+
+
+def page_stats() -> dict:
+    """page_size / page_count / freelist_count（DB ファイルの使用量と空き）"""
+    return _read(None, _page_stats)
+
+
+# =========================================================
+# セッションの保存先（STORAGE_BACKEND=sqlite | memory）
+# =========================================================
+# 進み具合・回答・出題順・案内メッセージ・回答の集計は SessionStore を通す。
+# sqlite: 上の _xxx(cur, ...) を _write / _read で実行する（これまでどおり）
+# memory: memory_store.MemoryStore に置き、操作ログ + スナップショットで永続化する。
+#         初めて起動したときは SQLite にあるセッションを取り込む（以降 SQLite 側のセッションの表は使わない）
+# 部屋・期限・相性リスト・meta・archived_sessions はどちらでも SQLite
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sqlite")
+MEMORY_STORE_DIR = os.environ.get("MEMORY_STORE_DIR", "")  # 既定: DB_PATH + ".memstore"
+MEMORY_LOG_FLUSH_MS = float(os.environ.get("MEMORY_LOG_FLUSH_MS", "5"))
+MEMORY_LOG_FSYNC = os.environ.get("MEMORY_LOG_FSYNC", "1") != "0"
+MEMORY_SNAPSHOT_INTERVAL = float(os.environ.get("MEMORY_SNAPSHOT_INTERVAL", "300"))  # 秒
+MEMORY_SNAPSHOT_OPS = int(os.environ.get("MEMORY_SNAPSHOT_OPS", "200000"))           # この件数のログがたまったら
+
+
+class SQLiteStore(SessionStore):
+    name = "sqlite"
+
+    def get_state(self, user_id: int) -> int:
+        idx = _sessions.get(("state", user_id))
+        if idx is not MISSING:
+            return idx
+
+        idx = _read(user_id, _get_state, user_id)
+        if idx is None:
+            _write(user_id, _init_state, user_id)
             return 0
-        return int(row[0])
+        return idx
+
+    def set_state(self, user_id: int, idx: int) -> None:
+        _write(user_id, _set_state, user_id, idx)
+
+    def save_answer(self, user_id: int, question_id: int, answer: str) -> None:
+        _write(user_id, _save_answer, user_id, question_id, answer)
+
+    def record_answer(self, user_id: int, idx: int, answer: str, question_ids: Sequence[int]) -> AnswerResult:
+        """
+        ボタン1回分の処理を1トランザクション・1コミットで行う。
+        order取得 → state確認・前進 → 回答保存 → message_id取得
+        書き込みロックを先に取るので、連打されても同じ idx を二重に進めない。
+        order / message_id がセッションキャッシュにあれば読み取りは省く（キャッシュもロックの中で読む）。
+        """
+        return _write(user_id, _record_answer, user_id, idx, answer, question_ids)
+
+    def load_answers(self, user_id: int) -> List[Tuple[int, str]]:
+        return _read(user_id, _load_answers, user_id)
+
+    def get_profile(self, user_id: int) -> Tuple[dict, dict]:
+        return _read(user_id, _get_profile, user_id)
+
+    def load_completed_profiles(self) -> List[Tuple[int, dict]]:
+        return _read(None, _load_completed_profiles)
+
+    def rebuild_profiles(self) -> int:
+        def rebuild(cur: sqlite3.Cursor) -> int:
+            n = _rebuild_profiles(cur)
+            cur.execute("DELETE FROM match_lists")
+            return n
+        return _write(None, rebuild)
+
+    def reset_user(self, user_id: int) -> None:
+        _write(user_id, _reset_user, user_id)
+
+    def get_user_counters(self) -> dict:
+        return _read(None, _get_user_counters)
+
+    def check_user_counters(self) -> Tuple[dict, dict]:
+        def check(cur: sqlite3.Cursor) -> Tuple[dict, dict]:
+            before = _get_user_counters(cur)
+            _recount_users(cur)
+            return before, _get_user_counters(cur)
+        return _write(None, check)
+
+    def count_total_users(self) -> int:
+        return _read(None, _count, "SELECT COUNT(*) FROM user_state")
+
+    def count_completed_users(self, total_questions: int) -> int:
+        return _read(None, _count, "SELECT COUNT(*) FROM user_state WHERE idx >= ?", (total_questions,))
+
+    def count_inprogress_users(self, total_questions: int) -> int:
+        return _read(None, _count, "SELECT COUNT(*) FROM user_state WHERE idx < ?", (total_questions,))
+
+    def get_answer_stats(self) -> AnswerStats:
+        return _read(None, _get_answer_stats)
+
+    def get_or_create_order(self, user_id: int, question_ids: Sequence[int]) -> Sequence[int]:
+        ids = _sessions.get(("order", user_id))
+        if ids is not MISSING:
+            return ids
+        return _write(user_id, _get_or_create_order, user_id, question_ids)
+
+    def reset_order(self, user_id: int) -> None:
+        _write(user_id, _reset_order, user_id)
+
+    def get_message_id(self, user_id: int) -> Optional[int]:
+        mid = _sessions.get(("msg", user_id))
+        if mid is not MISSING:
+            return mid
+        return _read(user_id, _get_message_id, user_id)
+
+    def set_message_id(self, user_id: int, message_id: int) -> None:
+        _write(user_id, _set_message_id, user_id, message_id)
+
+    def reset_message_id(self, user_id: int) -> None:
+        _write(user_id, _reset_message_id, user_id)
+
+    def start_session(self, user_id: int, question_ids: Sequence[int]) -> Sequence[int]:
+        return _write(user_id, _start_session, user_id, question_ids)
+
+    def find_stale_sessions(self, cutoff: float, limit: int) -> List[int]:
+        return _read(None, _find_stale_sessions, cutoff, limit)
+
+    def list_session_users(self) -> List[int]:
+        return _read(None, _list_session_users)
+
+    def archive_sessions(self, user_ids: Sequence[int], reason: str) -> ArchiveResult:
+        return _write(None, _archive_sessions, user_ids, reason)
+
+    def flush(self) -> None:
+        _flush_writer()
+
+    def close(self) -> None:
+        _flush_writer()
+
+
+_sqlite_store = SQLiteStore()
+_store: SessionStore = _sqlite_store
+
+
+def _export_sessions(cur: sqlite3.Cursor) -> Tuple[list, list, list]:
+    """SQLite のセッションを MemoryStore.import_sessions の形で（sessions, funnel, answer_counts）"""
+    cur.execute("""
+    SELECT s.user_id, s.idx, s.updated_at, v.answers, o.seed, o.order_json, m.message_id
+    FROM user_state s
+    LEFT JOIN answer_vectors v ON v.user_id = s.user_id
+    LEFT JOIN question_order o ON o.user_id = s.user_id
+    LEFT JOIN user_msg m ON m.user_id = s.user_id
+    """)
+    sessions = cur.fetchall()
+    cur.execute("SELECT step, count FROM funnel_counts")
+    funnel = cur.fetchall()
+    cur.execute("SELECT question_id, answer, count FROM question_answer_counts")
+    return sessions, funnel, cur.fetchall()
+
+
+def _forget_match_lists(user_ids: Optional[List[int]]) -> None:
+    # メモリ版でやり直し・整理したユーザーの相性リスト（SQLite 版は同じトランザクションで消している）
+    def forget(cur: sqlite3.Cursor) -> None:
+        if user_ids is None:
+            cur.execute("DELETE FROM match_lists")
+        else:
+            cur.executemany("DELETE FROM match_lists WHERE user_id=?", [(uid,) for uid in user_ids])
+    _write(None, forget)
+
+
+def _insert_archived_sessions(cur: sqlite3.Cursor, rows: List[tuple]) -> None:
+    cur.executemany("""
+    INSERT OR REPLACE INTO archived_sessions(
+        user_id, idx, answers, order_seed, order_json, updated_at, reason, archived_at
+    ) VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+
+
+# メモリ版の回答イベントを answer_events のどこまで書いたか（メモリ版のログの位置 "ログ番号:件数"）
+MEMORY_EVENTS_MARK = "memory_events_mark"
+
+
+def _insert_answer_events(cur: sqlite3.Cursor, rows: List[tuple], mark: Tuple[int, int]) -> None:
+    cur.executemany(
+        "INSERT INTO answer_events(user_id, question_id, position, answer, at) VALUES(?, ?, ?, ?, ?)", rows
+    )
+    _set_meta(cur, MEMORY_EVENTS_MARK, f"{mark[0]}:{mark[1]}")
+
+
+def _open_store() -> None:
+    """STORAGE_BACKEND の保存先を開く（init_db の最後。開き直すときは前のものを閉じてから）"""
+    global _store
+    if _store is not _sqlite_store:
+        _store.close()
+        _store = _sqlite_store
+    if STORAGE_BACKEND == "sqlite":
+        return
+    if STORAGE_BACKEND != "memory":
+        raise ValueError(f"unknown STORAGE_BACKEND: {STORAGE_BACKEND!r}")
+
+    mark = _read(None, _get_meta, MEMORY_EVENTS_MARK)
+    store = MemoryStore(
+        MEMORY_STORE_DIR or DB_PATH + ".memstore",
+        flush_interval=MEMORY_LOG_FLUSH_MS / 1000.0,
+        fsync=MEMORY_LOG_FSYNC,
+        snapshot_interval=MEMORY_SNAPSHOT_INTERVAL,
+        snapshot_ops=MEMORY_SNAPSHOT_OPS,
+        on_forget=_forget_match_lists,
+        on_archive=lambda rows: _write(None, _insert_archived_sessions, rows),
+        on_events=lambda rows, mark: _write(None, _insert_answer_events, rows, mark),
+        events_mark=tuple(int(x) for x in mark.split(":")) if mark else (0, 0),
+    )
+    if store.is_new:
+        # 前のメモリ版の保存先の位置は、新しいログの番号とは関係ない
+        _write(None, _set_meta, MEMORY_EVENTS_MARK, "0:0")
+        n = store.import_sessions(*_read(None, _export_sessions))
+        print(f"memory store: imported {n} sessions from {DB_PATH}")
+    stats = store.stats()
+    print(
+        f"memory store {store.directory}: {stats['users']} sessions,"
+        f" replayed {stats['recovered_ops']} ops in {stats['recovery_ms']:.1f}ms"
+    )
+    _store = store
+
+
+def storage_stats() -> dict:
+    """backend と、メモリ版なら users / pending / since_snapshot / ops / snapshots / recovered_ops など"""
+    return _store.stats()
+
+
+def get_state(user_id: int) -> int:
+    return _store.get_state(user_id)
 
 
 def set_state(user_id: int, idx: int) -> None:
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.cursor()
-        cur.execute("""
-        INSERT INTO user_state(user_id, idx) VALUES(?, ?)
-        ON CONFLICT(user_id) DO UPDATE SET idx=excluded.idx
-        """, (user_id, idx))
-        con.commit()
+    _store.set_state(user_id, idx)
 
 
 def save_answer(user_id: int, question_id: int, answer: str) -> None:
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.cursor()
+    _store.save_answer(user_id, question_id, answer)
 
-        # 旧DBで PRIMARY KEY(user_id,qid) のままでも動くように両対応
-        cols = _table_columns(cur, "answers")
-        if "question_id" in cols and "answer" in cols:
-            cur.execute("""
-            INSERT INTO answers(user_id, question_id, answer) VALUES(?, ?, ?)
-            ON CONFLICT(user_id, question_id) DO UPDATE SET answer=excluded.answer
-            """, (user_id, question_id, answer))
-        else:
-            # 念のためのフォールバック（基本ここには来ない）
-            cur.execute("""
-            INSERT INTO answers(user_id, qid, ans) VALUES(?, ?, ?)
-            ON CONFLICT(user_id, qid) DO UPDATE SET ans=excluded.ans
-            """, (user_id, question_id, answer))
 
-        con.commit()
+def record_answer(user_id: int, idx: int, answer: str, question_ids: Sequence[int]) -> AnswerResult:
+    """
+    ボタン1回分の処理（order取得 → state確認・前進 → 回答保存 → message_id取得）をまとめて行う。
+    押されたボタンの idx が現在の state と一致するときだけ進める（連打されても同じ idx を二重に進めない）
+    """
+    return _store.record_answer(user_id, idx, answer, question_ids)
 
 
 def load_answers(user_id: int) -> List[Tuple[int, str]]:
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.cursor()
-        cols = _table_columns(cur, "answers")
-
-        if "question_id" in cols and "answer" in cols:
-            cur.execute("""
-            SELECT question_id, answer
-            FROM answers
-            WHERE user_id=?
-            ORDER BY question_id
-            """, (user_id,))
-            return [(int(qid), ans) for (qid, ans) in cur.fetchall()]
-
-        # 旧形式フォールバック
-        cur.execute("""
-        SELECT qid, ans
-        FROM answers
-        WHERE user_id=?
-        ORDER BY qid
-        """, (user_id,))
-        return [(int(qid), ans) for (qid, ans) in cur.fetchall()]
+    return _store.load_answers(user_id)
+
+
+def get_profile(user_id: int) -> Tuple[dict, dict]:
+    """
+    (picks, meters)（未回答なら空）
+    """
+    return _store.get_profile(user_id)
+
+
+def load_completed_profiles() -> List[Tuple[int, dict]]:
+    """
+    診断完了ユーザー全員の picks（/match エンジンの初期ロード用）
+    """
+    return _store.load_completed_profiles()
+
+
+def rebuild_profiles() -> int:
+    """
+    profiles を answers から全件作り直す（質問バンクを変更した後に実行）
+    相性の上位リストも古くなるので消す（次の load で作り直される）
+    戻り値: 作成したプロフィール数
+    """
+    return _store.rebuild_profiles()
 
 
 def reset_user(user_id: int) -> None:
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.cursor()
-        cur.execute("DELETE FROM answers WHERE user_id=?", (user_id,))
-        cur.execute("DELETE FROM user_state WHERE user_id=?", (user_id,))
-        con.commit()
+    _store.reset_user(user_id)
+
+
+def get_user_counters() -> dict:
+    """{"total", "completed", "inprogress"}（維持しているカウンタを読むだけ・O(1)）"""
+    return _store.get_user_counters()
+
+
+def check_user_counters() -> Tuple[dict, dict]:
+    """
+    user_state を数え直してカウンタを修正する（整合性チェック）
+    戻り値: (修正前, 数え直した値)
+    """
+    return _store.check_user_counters()
 
 
 def count_total_users() -> int:
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.cursor()
-        cur.execute("SELECT COUNT(*) FROM user_state")
-        return int(cur.fetchone()[0])
+    return _store.count_total_users()
 
 
 def count_completed_users(total_questions: int) -> int:
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.cursor()
-        cur.execute("SELECT COUNT(*) FROM user_state WHERE idx >= ?", (total_questions,))
-        return int(cur.fetchone()[0])
+    return _store.count_completed_users(total_questions)
 
 
 def count_inprogress_users(total_questions: int) -> int:
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.cursor()
-        cur.execute("SELECT COUNT(*) FROM user_state WHERE idx < ?", (total_questions,))
-        return int(cur.fetchone()[0])
+    return _store.count_inprogress_users(total_questions)
 
 
-def get_or_create_order(user_id: int, question_ids: list[int]) -> list[int]:
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.cursor()
-        cur.execute("SELECT order_json FROM question_order WHERE user_id=?", (user_id,))
-        row = cur.fetchone()
-        if row:
-            return json.loads(row[0])
+def get_answer_stats() -> AnswerStats:
+    return _store.get_answer_stats()
 
-        ids = question_ids[:]
-        random.shuffle(ids)
-        cur.execute(
-            "INSERT OR REPLACE INTO question_order(user_id, order_json) VALUES(?, ?)",
-            (user_id, json.dumps(ids))
-        )
-        con.commit()
-        return ids
+
+def get_or_create_order(user_id: int, question_ids: Sequence[int]) -> Sequence[int]:
+    return _store.get_or_create_order(user_id, question_ids)
 
 
 def reset_order(user_id: int) -> None:
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.cursor()
-        cur.execute("DELETE FROM question_order WHERE user_id=?", (user_id,))
-        con.commit()
+    _store.reset_order(user_id)
 
 
 def get_message_id(user_id: int) -> Optional[int]:
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.cursor()
-        cur.execute("SELECT message_id FROM user_msg WHERE user_id=?", (user_id,))
-        row = cur.fetchone()
-        return int(row[0]) if row else None
+    return _store.get_message_id(user_id)
 
 
 def set_message_id(user_id: int, message_id: int) -> None:
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.cursor()
-        cur.execute("""
-        INSERT INTO user_msg(user_id, message_id) VALUES(?, ?)
-        ON CONFLICT(user_id) DO UPDATE SET message_id=excluded.message_id
-        """, (user_id, message_id))
-        con.commit()
+    _store.set_message_id(user_id, message_id)
 
 
 def reset_message_id(user_id: int) -> None:
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.cursor()
-        cur.execute("DELETE FROM user_msg WHERE user_id=?", (user_id,))
-        con.commit()
+    _store.reset_message_id(user_id)
+
+
+def start_session(user_id: int, question_ids: Sequence[int]) -> Sequence[int]:
+    """
+    診断のやり直し（reset_user → reset_order → reset_message_id → set_state(0) → 新しい出題順）を
+    1回の書き込みで行い、出題順を返す
+    """
+    return _store.start_session(user_id, question_ids)
+
+
+def find_stale_sessions(cutoff: float, limit: int) -> List[int]:
+    """cutoff（time.time()）より前から進んでいない未完了セッションを古い順に最大 limit 件"""
+    return _store.find_stale_sessions(cutoff, limit)
+
+
+def list_session_users() -> List[int]:
+    return _store.list_session_users()
+
+
+def archive_sessions(user_ids: Sequence[int], reason: str) -> ArchiveResult:
+    """
+    user_ids のセッションを archived_sessions に移す（1回の呼び出し = 1トランザクション。件数は呼び出し側で区切る）
+    reason: "ttl"（放置）/ "left"（サーバー退出）など
+    """
+    return _store.archive_sessions(user_ids, reason)
+
+
+# =========================================================
+# 計測（公開関数すべての所要時間・例外回数）
+# =========================================================
+# 呼び出し側（bot.py の to_thread など）から見た時間。group/async モードではコミット待ちも含む
+DB_CALL_SECONDS = metrics.REGISTRY.histogram("db_call_seconds", "db.py public function latency", ["fn"])
+DB_CALL_ERRORS = metrics.REGISTRY.counter("db_call_errors_total", "db.py public function exceptions", ["fn"])
+
+
+def _instrument_public_functions() -> None:
+    for name, fn in list(globals().items()):
+        if name.startswith("_") or not inspect.isfunction(fn) or fn.__module__ != __name__:
+            continue
+        globals()[name] = metrics.timed(DB_CALL_SECONDS.labels(fn=name), DB_CALL_ERRORS.labels(fn=name))(fn)
+
+
+_instrument_public_functions()
+
+metrics.REGISTRY.gauge("db_connections_open", "open sqlite connections").set_function(lambda: len(_pool))
+DB_CONNECTION_EVENTS = metrics.REGISTRY.gauge(
+    "db_connection_events", "sqlite connections opened / closed / checked out (cumulative)", ["kind"]
+)
+for _kind in ("opened", "closed", "checkouts"):
+    DB_CONNECTION_EVENTS.labels(kind=_kind).set_function(lambda kind=_kind: _pool_stats[kind])
+metrics.REGISTRY.gauge("db_writer_queue_depth", "writes waiting for the writer thread").set_function(_writer.queue_depth)
+metrics.REGISTRY.gauge("db_writer_max_batch", "largest batch committed by the writer thread").set_function(
+    lambda: _writer.stats["max_batch"]
+)
+DB_WRITER_EVENTS = metrics.REGISTRY.gauge(
+    "db_writer_events", "writer thread batches / writes / reads / failed writes (cumulative)", ["kind"]
+)
+for _kind in ("batches", "writes", "reads", "failed"):
+    DB_WRITER_EVENTS.labels(kind=_kind).set_function(lambda kind=_kind: _writer.stats[kind])
+metrics.REGISTRY.gauge("db_session_cache_size", "session cache entries").set_function(lambda: len(_sessions))
+DB_SESSION_CACHE_EVENTS = metrics.REGISTRY.gauge(
+    "db_session_cache_events", "session cache hits / misses / evictions / expirations / invalidations (cumulative)", ["kind"]
+)
+for _kind in ("hits", "misses", "evictions", "expirations", "invalidations"):
+    DB_SESSION_CACHE_EVENTS.labels(kind=_kind).set_function(lambda kind=_kind: _sessions.stats[kind])
+metrics.REGISTRY.gauge(
+    "db_store_pending_ops", "memory store operations not yet written to the log"
+).set_function(lambda: _store.stats().get("pending", 0))
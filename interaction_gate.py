@@ -0,0 +1,163 @@
+# interaction_gate.py
+# 回答ボタンのクリックをユーザーごとに1本ずつ処理するための仕組み
+# - 同じ interaction の再送は TTL つきの重複キャッシュで捨てる
+# - 最後に分かった進み具合（質問メッセージごと）を覚えておき、それより前の idx のクリック（連打・古いボタン）は DB に触らず捨てる
+# - 処理待ちのクリックがある間はメッセージ編集を後回しにし、最後の1回だけ送る
+#   （同じ質問への連打は後ろのクリックの編集に、送り済みと同じ内容の編集は送ったものにまとめる）
+
+import asyncio
+import time
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+Render = Callable[[], Awaitable[object]]
+
+
+class DedupCache:
+    """TTL 秒以内に見たキー（と値）を最大 maxsize 件まで覚えておく"""
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._seen: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def _expire(self, now: float) -> None:
+        while self._seen:
+            key, (expires, _) = next(iter(self._seen.items()))
+            if expires > now and len(self._seen) <= self.maxsize:
+                break
+            self._seen.popitem(last=False)
+
+    def seen(self, key: Hashable) -> bool:
+        entry = self._seen.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._seen.get(key)
+        return entry[1] if entry is not None and entry[0] > time.monotonic() else default
+
+    def add(self, key: Hashable, value: Any = True) -> None:
+        now = time.monotonic()
+        self._seen[key] = (now + self.ttl, value)
+        self._seen.move_to_end(key)
+        self._expire(now)
+
+    def discard(self, key: Hashable) -> None:
+        self._seen.pop(key, None)
+
+
+class _Slot:
+    __slots__ = ("lock", "waiting", "render", "render_key")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.waiting = 0
+        self.render: Optional[Render] = None
+        self.render_key: Optional[Hashable] = None
+
+
+class Turn:
+    """turn() の中で使う。render() で「このクリック後に送るメッセージ編集」を登録する"""
+
+    def __init__(self, gate: "InteractionGate", slot: _Slot):
+        self._gate = gate
+        self._slot = slot
+
+    def render(self, render: Render, key: Optional[Hashable] = None) -> None:
+        """
+        key: 編集後に表示される内容（同じ key の編集が成功済みで、他に送る編集が無ければ送らない）
+        """
+        if self._slot.render is not None:
+            # 前のクリックの編集はまだ送っていない → 送らずに上書き
+            self._gate.stats["coalesced"] += 1
+        elif key is not None and self._gate._shown.seen(key):
+            # 同じ内容の編集はもう送ってある（連打の2回目以降）
+            self._gate.stats["coalesced"] += 1
+            return
+        self._slot.render = render
+        self._slot.render_key = key
+
+
+class InteractionGate:
+    """
+    admit(*keys): どれかのキーを TTL 内に見ていれば False（重複クリック）
+    progress(user_id, message_id): その質問メッセージで最後に分かった記録結果（advance で覚える）
+    turn(user_id): ユーザーごとの直列化。抜けるときに、後ろに待っているクリックが無ければ
+                   最後に登録された render を1回だけ実行する（待ちがあれば次の turn に持ち越す）
+    """
+
+    def __init__(self, dedup_ttl: float = 900.0, max_keys: int = 50000):
+        self._dedup = DedupCache(dedup_ttl, max_keys)
+        self._shown = DedupCache(dedup_ttl, max_keys)  # 成功した編集の key
+        self._progress = DedupCache(dedup_ttl, max_keys)  # user_id → 最後の記録結果（next_idx が今の state）
+        self._slots: Dict[int, _Slot] = {}
+        self.stats = Counter()
+
+    def admit(self, *keys: Hashable) -> bool:
+        if any(self._dedup.seen(k) for k in keys):
+            self.stats["duplicates"] += 1
+            return False
+        for k in keys:
+            self._dedup.add(k)
+        self.stats["admitted"] += 1
+        return True
+
+    def forget(self, *keys: Hashable) -> None:
+        """処理に失敗したクリックを再送できるようにする"""
+        for k in keys:
+            self._dedup.discard(k)
+
+    def progress(self, user_id: int, message_id: Optional[int]) -> Optional[Any]:
+        """
+        advance で覚えた結果。別の質問メッセージ（作り直したセッション）のクリックなら None
+        turn の中で呼べば、前のクリックの結果まで反映されている
+        """
+        res = self._progress.get(user_id)
+        if res is None or message_id is None or res.message_id != message_id:
+            return None
+        return res
+
+    def advance(self, user_id: int, res: Any) -> None:
+        """record_answer の結果（受け付けたかどうかに関わらず next_idx が今の state）を覚える"""
+        self._progress.add(user_id, res)
+
+    def reset(self, user_id: int) -> None:
+        """セッションを作り直したときに呼ぶ（覚えている進み具合を捨てる）"""
+        self._progress.discard(user_id)
+
+    def snapshot(self) -> dict:
+        return {"active_users": len(self._slots), "dedup_keys": len(self._dedup), **self.stats}
+
+    @asynccontextmanager
+    async def turn(self, user_id: int):
+        slot = self._slots.get(user_id)
+        if slot is None:
+            slot = self._slots[user_id] = _Slot()
+
+        slot.waiting += 1
+        acquired = False
+        try:
+            await slot.lock.acquire()
+            acquired = True
+            slot.waiting -= 1
+
+            yield Turn(self, slot)
+
+            if slot.render is not None and slot.waiting == 0:
+                render, slot.render = slot.render, None
+                key, slot.render_key = slot.render_key, None
+                self.stats["renders"] += 1
+                await render()
+                if key is not None:
+                    self._shown.add(key)
+        finally:
+            if acquired:
+                slot.lock.release()
+            else:
+                slot.waiting -= 1
+            if slot.waiting == 0 and not slot.lock.locked():
+                self._slots.pop(user_id, None)
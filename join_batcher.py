@@ -0,0 +1,80 @@
+# join_batcher.py
+# 短い時間窓のあいだに来たイベント（サーバー参加など）をまとめて1回で処理する
+# - キー（送り先チャンネルなど）ごとに、最初の1件から window 秒後か max_batch 件たまった時点で handler に渡す
+# - handler は1本ずつ順に呼ぶ（固定メッセージの編集が前後しないように）
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set
+
+Handler = Callable[[Hashable, List[Any]], Awaitable[None]]
+
+
+class JoinBatcher:
+    """
+    add(key, item_id, item) で貯める。同じ item_id は窓の中で1回だけ（入退室の繰り返しなど）。
+    stats: queued（受け付けた件数）/ duplicates / batches / items（handler に渡した件数）/ errors / max_batch
+    """
+
+    def __init__(self, handler: Handler, window: float = 5.0, max_batch: int = 50):
+        self.handler = handler
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: Dict[Hashable, Dict[Hashable, Any]] = {}
+        self._timers: Dict[Hashable, asyncio.Task] = {}
+        self._running: Set[asyncio.Task] = set()  # max_batch で即時に出したバッチ（参照を持っておく）
+        self._lock = asyncio.Lock()
+        self.stats = {"queued": 0, "duplicates": 0, "batches": 0, "items": 0, "errors": 0, "max_batch": 0}
+
+    def __len__(self) -> int:
+        """まだ handler に渡していない件数（キュー長）"""
+        return sum(len(items) for items in self._pending.values())
+
+    def add(self, key: Hashable, item_id: Hashable, item: Any) -> None:
+        items = self._pending.setdefault(key, {})
+        if item_id in items:
+            self.stats["duplicates"] += 1
+            return
+        items[item_id] = item
+        self.stats["queued"] += 1
+
+        if len(items) >= self.max_batch:
+            timer = self._timers.pop(key, None)
+            if timer is not None:
+                timer.cancel()
+            task = asyncio.create_task(self._flush(key, self._pending.pop(key)))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+        elif key not in self._timers:
+            self._timers[key] = asyncio.create_task(self._flush_later(key))
+
+    def snapshot(self) -> dict:
+        return {"depth": len(self), **self.stats}
+
+    async def _flush_later(self, key: Hashable) -> None:
+        await asyncio.sleep(self.window)
+        self._timers.pop(key, None)
+        items = self._pending.pop(key, None)
+        if items:
+            await self._flush(key, items)
+
+    async def _flush(self, key: Hashable, items: Dict[Hashable, Any]) -> None:
+        batch = list(items.values())
+        async with self._lock:
+            try:
+                await self.handler(key, batch)
+            except Exception as e:
+                self.stats["errors"] += 1
+                print("join batch handler failed:", repr(e))
+            self.stats["batches"] += 1
+            self.stats["items"] += len(batch)
+            self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+
+    async def flush(self, key: Optional[Hashable] = None) -> None:
+        """窓を待たずに今たまっている分を処理する（key=None なら全部）"""
+        for k in [key] if key is not None else list(self._pending):
+            timer = self._timers.pop(k, None)
+            if timer is not None:
+                timer.cancel()
+            items = self._pending.pop(k, None)
+            if items:
+                await self._flush(k, items)
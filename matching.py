@@ -0,0 +1,548 @@
+# matching.py
+# 相性マッチング（/match 用）
+# 完了ユーザーのカテゴリ別最頻回答を (ユーザー数 × カテゴリ数) の行列で保持し、
+# 全員との一致率を1回のベクトル演算で求める。
+# /match の上位検索は、同じピックの組（シグネチャ）ごとにユーザーをまとめた索引を
+# 一致数の多い順にたどって求める（ユーザー数に依存しない）。
+
+import heapq
+import multiprocessing
+import threading
+from bisect import bisect_left, insort
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations, product
+from math import comb
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+# 回答コード：0=未回答（そのカテゴリは比較対象外）, A..E=1..5
+LETTER_CODE = {"A": 1, "B": 2, "C": 3, "D": 4, "E": 5}
+
+_INITIAL_CAPACITY = 1024
+
+
+def compatibility_percent(picks_a: dict, picks_b: dict, categories: List[str]) -> int:
+    """
+    基準となる相性％（カテゴリ一致率）。MatchEngine はこれと同じ値を返す。
+    """
+    usable = [c for c in categories if c in picks_a and c in picks_b]
+    if not usable:
+        return 0
+    same = sum(1 for c in usable if picks_a[c] == picks_b[c])
+    return int(round(same / len(usable) * 100))
+
+
+def encode_picks(picks: dict, categories: List[str]) -> np.ndarray:
+    return np.array([LETTER_CODE.get(picks.get(c), 0) for c in categories], dtype=np.int8)
+
+
+def score_rows(me: np.ndarray, codes: np.ndarray) -> np.ndarray:
+    """
+    me: (C,)  codes: (N, C) -> (N,) の相性％
+    compatibility_percent と同じ式（float64 の除算 + 偶数丸め）で計算する。
+    """
+    usable = (codes > 0) & (me > 0)
+    same = ((codes == me) & usable).sum(axis=1)
+    n_usable = usable.sum(axis=1)
+    pct = np.zeros(codes.shape[0], dtype=np.int64)
+    ok = n_usable > 0
+    pct[ok] = np.rint(same[ok] / n_usable[ok] * 100).astype(np.int64)
+    return pct
+
+
+def top_k_indices(pct: np.ndarray, uids: np.ndarray, k: int) -> np.ndarray:
+    """
+    相性％の降順・同率は user_id の昇順で上位 k 件の添字を返す（部分ソート）。
+    """
+    n = pct.shape[0]
+    if n == 0 or k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if n <= k:
+        return np.lexsort((uids, -pct))
+
+    # k番目に大きい％を境界値として、境界より上は全部・境界と同率は user_id の小さい順に補充
+    threshold = np.partition(pct, n - k)[n - k]
+    above = np.flatnonzero(pct > threshold)
+    tied = np.flatnonzero(pct == threshold)
+    need = k - above.shape[0]
+    if tied.shape[0] > need:
+        tied = tied[np.argpartition(uids[tied], need - 1)[:need]]
+    chosen = np.concatenate([above, tied])
+    return chosen[np.lexsort((uids[chosen], -pct[chosen]))]
+
+
+Signature = Tuple[int, ...]
+
+
+def _percent(same: int, usable: int) -> int:
+    # compatibility_percent と同じ式
+    return int(round(same / usable * 100)) if usable else 0
+
+
+class SignatureIndex:
+    """
+    シグネチャ（カテゴリ順のピックのコード列）→ そのシグネチャのユーザー（user_id 昇順）。
+    相性％は2人のシグネチャだけで決まり、シグネチャは高々 6^カテゴリ数 通りなので、
+    top_k は「一致数の多いシグネチャから順に」バケツを見て k 人そろった時点で止める。
+
+    未回答カテゴリ（コード 0）があると比較対象のカテゴリ数が変わるので、
+    回答済みカテゴリの組（mask）ごとにバケツを分けておく。
+    """
+
+    def __init__(self, categories: List[str]):
+        self.categories = list(categories)
+        self._sig_of: Dict[int, Signature] = {}
+        self._groups: Dict[int, Dict[Signature, List[int]]] = {}  # mask → signature → user_id（昇順）
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sig_of)
+
+    @staticmethod
+    def _mask(sig: Signature) -> int:
+        return sum(1 << i for i, x in enumerate(sig) if x)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._sig_of.clear()
+            self._groups.clear()
+
+    def add(self, user_id: int, sig: Signature) -> None:
+        with self._lock:
+            self._remove_locked(user_id)
+            self._sig_of[user_id] = sig
+            group = self._groups.setdefault(self._mask(sig), {})
+            insort(group.setdefault(sig, []), user_id)
+
+    def remove(self, user_id: int) -> None:
+        with self._lock:
+            self._remove_locked(user_id)
+
+    def _remove_locked(self, user_id: int) -> None:
+        sig = self._sig_of.pop(user_id, None)
+        if sig is None:
+            return
+        mask = self._mask(sig)
+        group = self._groups[mask]
+        bucket = group[sig]
+        del bucket[bisect_left(bucket, user_id)]
+        if not bucket:
+            del group[sig]
+            if not group:
+                del self._groups[mask]
+
+    def counts(self) -> Dict[Signature, int]:
+        """シグネチャごとの人数"""
+        with self._lock:
+            return {sig: len(b) for group in self._groups.values() for sig, b in group.items()}
+
+    def _buckets_at(self, me: Signature, mask: int, same: int) -> Iterator[List[int]]:
+        """mask のグループのうち、me と比較できるカテゴリでちょうど same 個一致するバケツ"""
+        group = self._groups[mask]
+        shared = [i for i in range(len(me)) if mask >> i & 1 and me[i]]
+        free = [i for i in range(len(me)) if mask >> i & 1 and not me[i]]
+
+        # 該当しうるシグネチャを作って引く / グループ内の実在バケツを全部見る、の安い方
+        n_candidates = comb(len(shared), same) * 4 ** (len(shared) - same) * 5 ** len(free)
+        if n_candidates > len(group):
+            for sig, bucket in group.items():
+                if sum(1 for i in shared if sig[i] == me[i]) == same:
+                    yield bucket
+            return
+
+        base = [0] * len(me)
+        for agree in combinations(shared, same):
+            differ = [i for i in shared if i not in agree]
+            for i in agree:
+                base[i] = me[i]
+            choices = [[v for v in range(1, 6) if v != me[i]] for i in differ] + [range(1, 6)] * len(free)
+            for values in product(*choices):
+                for i, v in zip(differ + free, values):
+                    base[i] = v
+                bucket = group.get(tuple(base))
+                if bucket:
+                    yield bucket
+
+    def top_k(self, user_id: int, k: int = 3) -> List[Tuple[int, int]]:
+        """[(相性％, user_id), ...]（相性の高い順・同率は user_id 昇順・本人は除外）"""
+        with self._lock:
+            me = self._sig_of.get(user_id)
+            if me is None:
+                return []
+            return self._rank_locked(me, k, user_id)
+
+    def rank(self, sig: Signature, k: int, exclude: Optional[int] = None) -> List[Tuple[int, int]]:
+        """シグネチャ sig の人から見た上位 k 件（exclude の user_id は除く）"""
+        with self._lock:
+            return self._rank_locked(sig, k, exclude)
+
+    def _rank_locked(self, me: Signature, k: int, exclude: Optional[int]) -> List[Tuple[int, int]]:
+        if k <= 0:
+            return []
+        my_mask = self._mask(me)
+
+        # 相性％ → その値になる (mask, 一致数) の一覧
+        levels: Dict[int, List[Tuple[int, int]]] = defaultdict(list)
+        for mask in self._groups:
+            usable = bin(mask & my_mask).count("1")
+            for same in range(usable + 1):
+                levels[_percent(same, usable)].append((mask, same))
+
+        result: List[Tuple[int, int]] = []
+        for pct in sorted(levels, reverse=True):
+            need = k - len(result)
+            candidates = []
+            for mask, same in levels[pct]:
+                for bucket in self._buckets_at(me, mask, same):
+                    # 各バケツは昇順なので先頭 need+1 人（除外する本人の分）だけで足りる
+                    candidates.extend(u for u in bucket[:need + 1] if u != exclude)
+            result.extend((pct, u) for u in heapq.nsmallest(need, candidates))
+            if len(result) >= k:
+                break
+        return result
+
+
+# =========================================================
+# 上位リストの一括作成（起動時・再集計時。プロセスプールで分割できる）
+# =========================================================
+# 同じシグネチャの人のランキングは「本人を除く」以外は同じなので、
+# シグネチャごとに上位 k+1 件を求めてから各ユーザーに配る。
+# 上位 k+1 件に入る人のシグネチャは「(相性％, そのシグネチャの最小 user_id)」で並べた上位 k+1 個に必ず含まれるので、
+# 採点はシグネチャ同士（高々 6^カテゴリ数 × 同数）で済む。
+_POOL_MIN_SIGNATURES = 1024  # これより少なければプロセスを立てる方が遅い
+_RANK_BLOCK = 128            # 一度に採点するシグネチャ数（メモリ ≒ 128 × シグネチャ数 × カテゴリ数 バイト）
+_worker_state = None
+
+
+def _entry_key(entry: Tuple[int, int]) -> Tuple[int, int]:
+    return -entry[0], entry[1]
+
+
+def _signature_heads(codes: np.ndarray, uids: np.ndarray):
+    """
+    -> (uniq, inverse, sorted_uids, starts, counts)
+    uniq: 異なるシグネチャ / inverse: 各ユーザーのシグネチャ番号
+    sorted_uids[starts[j]:starts[j]+counts[j]]: シグネチャ j のユーザー（user_id 昇順）
+    """
+    uniq, inverse = np.unique(codes, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.lexsort((uids, inverse))
+    counts = np.bincount(inverse, minlength=uniq.shape[0])
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    return uniq, inverse, uids[order], starts, counts
+
+
+def _score_block(me: np.ndarray, codes: np.ndarray) -> np.ndarray:
+    """me: (B, C)  codes: (N, C) -> (B, N) の相性％（compatibility_percent と同じ値）"""
+    n_cat = codes.shape[1]
+    same = np.zeros((me.shape[0], codes.shape[0]), dtype=np.int16)
+    n_usable = np.zeros_like(same)
+    for c in range(n_cat):  # カテゴリごとに足す（3次元の配列を作らない）
+        mine, theirs = me[:, c:c + 1], codes[None, :, c]
+        usable = (mine > 0) & (theirs > 0)
+        n_usable += usable
+        same += (mine == theirs) & usable
+    # (比較できた数, 一致数) の組は高々 (C+1)^2 通りなので、％は表引きで求める
+    table = np.array(
+        [_percent(sm, us) for us in range(n_cat + 1) for sm in range(n_cat + 1)], dtype=np.int64
+    )
+    n_usable *= n_cat + 1
+    n_usable += same
+    return table[n_usable]
+
+
+def _rank_signatures(state, indices) -> List[List[Tuple[int, int]]]:
+    uniq, sorted_uids, starts, counts, k = state
+    n_sig = uniq.shape[0]
+    first_uid = sorted_uids[starts]
+    # 同じ％なら最小 user_id の小さいシグネチャを先に
+    tie = np.empty(n_sig, dtype=np.int64)
+    tie[np.argsort(first_uid)] = np.arange(n_sig - 1, -1, -1)
+    m = min(k, n_sig)
+
+    out = []
+    indices = np.asarray(indices, dtype=np.int64)
+    for b0 in range(0, indices.shape[0], _RANK_BLOCK):
+        block = indices[b0:b0 + _RANK_BLOCK]
+        pct = _score_block(uniq[block], uniq)
+        key = pct * n_sig + tie
+        top = np.argpartition(-key, m - 1, axis=1)[:, :m]
+        for b in range(block.shape[0]):
+            entries = []
+            for j in top[b].tolist():
+                p = int(pct[b, j])
+                head = sorted_uids[starts[j]:starts[j] + min(k, counts[j])]
+                entries.extend((p, int(u)) for u in head)
+            entries.sort(key=_entry_key)
+            out.append(entries[:k])
+    return out
+
+
+def _init_rank_worker(*state) -> None:
+    global _worker_state
+    _worker_state = state
+
+
+def _rank_chunk(indices) -> List[List[Tuple[int, int]]]:
+    return _rank_signatures(_worker_state, indices)
+
+
+def build_lists(codes: np.ndarray, uids: np.ndarray, k: int, workers: int = 1) -> Dict[int, List[Tuple[int, int]]]:
+    """
+    codes: (N, C) / uids: (N,) -> {user_id: [(相性％, user_id), ...] 上位 k 件}
+    workers > 1 ならシグネチャを分けてプロセスプールで計算する
+    """
+    if uids.shape[0] == 0:
+        return {}
+    uniq, inverse, sorted_uids, starts, counts = _signature_heads(codes, uids)
+    state = (uniq, sorted_uids, starts, counts, k + 1)
+    n_sig = uniq.shape[0]
+
+    if workers > 1 and n_sig >= _POOL_MIN_SIGNATURES:
+        chunks = np.array_split(np.arange(n_sig), workers * 4)
+        ctx = multiprocessing.get_context("spawn")  # スレッドを持つ bot プロセスから fork しない
+        with ProcessPoolExecutor(workers, mp_context=ctx, initializer=_init_rank_worker, initargs=state) as pool:
+            rankings = [r for part in pool.map(_rank_chunk, chunks) for r in part]
+    else:
+        rankings = _rank_signatures(state, range(n_sig))
+
+    return {
+        uid: [e for e in rankings[i] if e[1] != uid][:k]
+        for uid, i in zip(uids.tolist(), inverse.tolist())
+    }
+
+
+class MatchEngine:
+    """
+    診断完了ユーザーのピック行列・シグネチャ索引・ユーザーごとの上位リスト。
+    - upsert   : 完了時に1行追加/更新し、新しい人が入るべきリストだけを更新する
+    - remove   : リセット時に行を削除し、その人を含んでいたリストだけを作り直す
+    - top_k    : シグネチャ索引から上位を返す（ユーザー数に依存しない）
+    - top_k_scan: 全員を一括採点して上位を返す（同じ結果・検算や一括処理用）
+    upsert / remove は変わったリスト {user_id: [(相性％, user_id), ...]} を返すので、呼び出し側で保存する。
+    """
+
+    def __init__(self, categories: List[str], list_size: int = 3):
+        self.categories = list(categories)
+        self.list_size = list_size
+        self._codes = np.zeros((_INITIAL_CAPACITY, len(self.categories)), dtype=np.int8)
+        self._uids = np.zeros(_INITIAL_CAPACITY, dtype=np.int64)
+        # 各行のリストの最下位（これより上なら入る）。リストが list_size 未満なら -1
+        self._thr_pct = np.full(_INITIAL_CAPACITY, -1, dtype=np.int16)
+        self._thr_uid = np.zeros(_INITIAL_CAPACITY, dtype=np.int64)
+        self._row: Dict[int, int] = {}
+        self._index = SignatureIndex(self.categories)
+        self._lists: Dict[int, List[Tuple[int, int]]] = {}
+        self._holders: Dict[int, Set[int]] = {}  # user_id → その人をリストに含むユーザー
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._row)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._row
+
+    @property
+    def eligible(self) -> frozenset:
+        """マッチ対象（診断完了）ユーザーの集合"""
+        with self._lock:
+            return frozenset(self._row)
+
+    def _grow(self) -> None:
+        cap = self._codes.shape[0] * 2
+        n = len(self._row)
+        codes = np.zeros((cap, len(self.categories)), dtype=np.int8)
+        uids = np.zeros(cap, dtype=np.int64)
+        thr_pct = np.full(cap, -1, dtype=np.int16)
+        thr_uid = np.zeros(cap, dtype=np.int64)
+        codes[:n] = self._codes[:n]
+        uids[:n] = self._uids[:n]
+        thr_pct[:n] = self._thr_pct[:n]
+        thr_uid[:n] = self._thr_uid[:n]
+        self._codes, self._uids, self._thr_pct, self._thr_uid = codes, uids, thr_pct, thr_uid
+
+    def load(self, profiles: List[Tuple[int, dict]]) -> None:
+        """
+        起動時の一括ロード（既存の内容は置き換える）。
+        リストは空になるので、続けて load_lists() か rebuild_lists() を呼ぶ
+        """
+        with self._lock:
+            self._row.clear()
+            self._index.clear()
+            self._lists.clear()
+            self._holders.clear()
+            self._version += 1
+            for uid, picks in profiles:
+                self._insert_locked(uid, encode_picks(picks, self.categories))
+
+    def _insert_locked(self, user_id: int, codes: np.ndarray) -> int:
+        row = self._row.get(user_id)
+        if row is None:
+            row = len(self._row)
+            if row >= self._codes.shape[0]:
+                self._grow()
+            self._row[user_id] = row
+            self._uids[row] = user_id
+        self._codes[row] = codes
+        self._thr_pct[row] = -1
+        self._index.add(user_id, tuple(int(x) for x in codes))
+        return row
+
+    def _set_list_locked(self, owner: int, entries: Optional[List[Tuple[int, int]]]) -> None:
+        for _, uid in self._lists.pop(owner, ()):
+            holders = self._holders.get(uid)
+            if holders is not None:
+                holders.discard(owner)
+                if not holders:
+                    del self._holders[uid]
+        if entries is None:
+            return
+        self._lists[owner] = entries
+        for _, uid in entries:
+            self._holders.setdefault(uid, set()).add(owner)
+        row = self._row[owner]
+        if len(entries) >= self.list_size:
+            self._thr_pct[row], self._thr_uid[row] = entries[-1]
+        else:
+            self._thr_pct[row] = -1
+
+    def load_lists(self, lists: Dict[int, List[Tuple[int, int]]]) -> bool:
+        """
+        保存済みのリストを読み込む。完了ユーザー全員分がそろっていなければ False（rebuild_lists が必要）
+        """
+        with self._lock:
+            want = min(self.list_size, max(0, len(self._row) - 1))
+            if lists.keys() != self._row.keys() or any(len(v) != want for v in lists.values()):
+                return False
+            self._lists.clear()
+            self._holders.clear()
+            for owner, entries in lists.items():
+                self._set_list_locked(owner, [(int(p), int(u)) for p, u in entries])
+            return True
+
+    def rebuild_lists(self, workers: int = 1) -> Dict[int, List[Tuple[int, int]]]:
+        """全員のリストを作り直して返す（計算中の upsert / remove はやり直しで取り込む）"""
+        for _ in range(3):
+            with self._lock:
+                n = len(self._row)
+                codes = self._codes[:n].copy()
+                uids = self._uids[:n].copy()
+                version = self._version
+            lists = build_lists(codes, uids, self.list_size, workers)
+            with self._lock:
+                if version == self._version:
+                    break
+        else:
+            with self._lock:
+                n = len(self._row)
+                lists = build_lists(self._codes[:n], self._uids[:n], self.list_size)
+
+        with self._lock:
+            self._lists.clear()
+            self._holders.clear()
+            for owner, entries in lists.items():
+                self._set_list_locked(owner, entries)
+        return lists
+
+    def list_of(self, user_id: int) -> Optional[List[Tuple[int, int]]]:
+        with self._lock:
+            entries = self._lists.get(user_id)
+            return list(entries) if entries is not None else None
+
+    def upsert(self, user_id: int, picks: dict) -> Dict[int, List[Tuple[int, int]]]:
+        codes = encode_picks(picks, self.categories)
+        with self._lock:
+            changed = self._remove_locked(user_id) if user_id in self._row else {}
+            row = self._insert_locked(user_id, codes)
+            self._version += 1
+            n = len(self._row)
+
+            # 新しい人が最下位より上に来るリストだけに差し込む
+            pct = score_rows(codes, self._codes[:n])
+            thr_pct = self._thr_pct[:n]
+            enters = (pct > thr_pct) | ((pct == thr_pct) & (user_id < self._thr_uid[:n]))
+            enters[row] = False
+            for r in np.flatnonzero(enters).tolist():
+                owner = int(self._uids[r])
+                entries = sorted(self._lists.get(owner, []) + [(int(pct[r]), user_id)], key=_entry_key)
+                entries = entries[:self.list_size]
+                self._set_list_locked(owner, entries)
+                changed[owner] = entries
+
+            own = self._index.rank(tuple(int(x) for x in codes), self.list_size, user_id)
+            self._set_list_locked(user_id, own)
+            changed[user_id] = own
+            return changed
+
+    def remove(self, user_id: int) -> Dict[int, List[Tuple[int, int]]]:
+        with self._lock:
+            if user_id not in self._row:
+                return {}
+            self._version += 1
+            return self._remove_locked(user_id)
+
+    def _remove_locked(self, user_id: int) -> Dict[int, List[Tuple[int, int]]]:
+        self._set_list_locked(user_id, None)
+        row = self._row.pop(user_id)
+        self._index.remove(user_id)
+        last = len(self._row)
+        if row != last:
+            moved = int(self._uids[last])
+            self._codes[row] = self._codes[last]
+            self._uids[row] = moved
+            self._thr_pct[row] = self._thr_pct[last]
+            self._thr_uid[row] = self._thr_uid[last]
+            self._row[moved] = row
+
+        # この人を含んでいたリストを作り直す（同じシグネチャの人は同じランキングを使い回す）
+        changed = {}
+        rankings: Dict[Signature, List[Tuple[int, int]]] = {}
+        for owner in self._holders.pop(user_id, set()):
+            sig = tuple(int(x) for x in self._codes[self._row[owner]])
+            ranking = rankings.get(sig)
+            if ranking is None:
+                ranking = rankings[sig] = self._index.rank(sig, self.list_size + 1)
+            entries = [e for e in ranking if e[1] != owner][:self.list_size]
+            self._set_list_locked(owner, entries)
+            changed[owner] = entries
+        return changed
+
+    def picks_of(self, user_id: int) -> Optional[dict]:
+        with self._lock:
+            row = self._row.get(user_id)
+            if row is None:
+                return None
+            codes = self._codes[row].copy()
+        letters = {v: k for k, v in LETTER_CODE.items()}
+        return {c: letters[int(x)] for c, x in zip(self.categories, codes) if x > 0}
+
+    def signature_counts(self) -> Dict[Signature, int]:
+        return self._index.counts()
+
+    def top_k(self, user_id: int, k: int = 3) -> List[Tuple[int, int]]:
+        """
+        [(相性％, user_id), ...] を相性の高い順に返す（同率は user_id 昇順・本人は除外）
+        """
+        return self._index.top_k(user_id, k)
+
+    def top_k_scan(self, user_id: int, k: int = 3) -> List[Tuple[int, int]]:
+        """top_k と同じ結果を全員の一括採点で求める"""
+        with self._lock:
+            n = len(self._row)
+            row = self._row.get(user_id)
+            if row is None:
+                return []
+            codes = self._codes[:n].copy()
+            uids = self._uids[:n].copy()
+
+        me = codes[row].copy()
+        pct = score_rows(me, codes)
+        keep = np.ones(n, dtype=bool)
+        keep[row] = False
+        pct, uids = pct[keep], uids[keep]
+
+        idx = top_k_indices(pct, uids, k)
+        return [(int(pct[i]), int(uids[i])) for i in idx]
@@ -0,0 +1,627 @@
+# memory_store.py
+# セッションをすべてメモリに置く保存先（STORAGE_BACKEND=memory）
+# - 読み書きは dict の操作だけ。変更は1件ごとに「操作」として追記ログ（ops-NNNNNNNN.log、JSON 1行1件）に積み、
+#   専用スレッドが flush_interval ごとにまとめて書き出す（fsync=True なら書くたびに fsync）
+# - 一定件数・一定時間ごとに全体をスナップショット（snapshot.json）に書き、それより前のログは消す
+#   （書き出し中に来た操作は次のログファイルに入るので、スナップショットを取る間も止めない）
+# - 起動時はスナップショットを読み、続きのログを順に再生して元に戻す（最後の行が途中で切れていたらそこまで）
+# - 回答イベント（SQLite 版の answer_events）は on_events で SQLite に渡す。ログのどこまで渡したか（mark）も
+#   同じトランザクションで記録してもらい、起動時はそれより後のログの回答だけ渡し直す
+# 耐久性は DB_WRITE_MODE=async と同じ: 呼び出しは書き出しを待たずに戻り、flush() で待てる
+
+import heapq
+import json
+import os
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from profiles import aggregate
+from question_bank import BANK
+from storage import (
+    AnswerResult, AnswerStats, ArchiveResult, SessionStore,
+    new_order_seed, pack_answer, seed_order, unpack_answers,
+)
+
+SNAPSHOT_FILE = "snapshot.json"
+SNAPSHOT_FORMAT = 1
+LOG_PREFIX = "ops-"
+LOG_SUFFIX = ".log"
+
+# 保存先の外（SQLite）に残るものの後始末。どちらもストアのロックを外してから呼ぶ
+Forget = Callable[[Optional[List[int]]], None]  # 相性リストを消す user_id（None は全員）
+Archive = Callable[[List[tuple]], None]         # archived_sessions に書く行
+Mark = Tuple[int, int]                          # (ログ番号, そのログの何件目まで)
+Events = Callable[[List[tuple], Mark], None]    # answer_events に書く行 (user_id, question_id, position, answer, at) と mark
+
+
+def _log_name(seq: int) -> str:
+    return f"{LOG_PREFIX}{seq:08d}{LOG_SUFFIX}"
+
+
+def _fsync_dir(path: str) -> None:
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class MemoryStore(SessionStore):
+    """
+    操作（ログの1行）:
+      ["s", uid, idx, at]            state を idx にする（無ければ作る）
+      ["a", uid, qid, ans]           回答を保存
+      ["r", uid, pos, qid, ans, at]  出題順 pos 番目への回答（state を pos+1 に進め、集計にも足す）
+      ["o", uid, seed]               出題順のシード
+      ["m", uid, message_id]         案内メッセージ
+      ["x", uid, what]               "user" | "order" | "msg" を消す
+      ["n", uid, seed, at]           やり直し（全部消して state 0・新しいシード・開始数 +1）
+      ["z", uid]                     整理（セッションを丸ごと消す。中身は on_archive に渡してある）
+    """
+
+    name = "memory"
+
+    def __init__(
+        self,
+        directory: str,
+        flush_interval: float = 0.005,
+        fsync: bool = True,
+        snapshot_interval: float = 300.0,
+        snapshot_ops: int = 200_000,
+        on_forget: Optional[Forget] = None,
+        on_archive: Optional[Archive] = None,
+        on_events: Optional[Events] = None,
+        events_mark: Mark = (0, 0),
+    ):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_ops = snapshot_ops
+        self.on_forget = on_forget
+        self.on_archive = on_archive
+        self.on_events = on_events
+        self.events_mark = events_mark  # on_events に渡し終えた位置（起動時に SQLite から読んだもの）
+
+        self._state: Dict[int, int] = {}
+        self._updated: Dict[int, float] = {}
+        self._answers: Dict[int, bytes] = {}
+        self._seeds: Dict[int, int] = {}
+        self._legacy_orders: Dict[int, List[int]] = {}  # SQLite から持ってきたシード導入前の出題順
+        self._msg: Dict[int, int] = {}
+        self._funnel: Counter = Counter()
+        self._answer_counts: Counter = Counter()        # (question_id, answer) -> 件数
+        self._completed = 0
+
+        self._lock = threading.RLock()
+        self._durable = threading.Condition(self._lock)
+        self._pending: List[list] = []
+        self._seq = 0          # 受け付けた操作の通し番号
+        self._durable_seq = 0  # ログに書き終えた操作の通し番号
+        self._since_snapshot = 0
+        self._snapshot_requested = False
+        self._last_snapshot = time.monotonic()
+        self._log_seq = 0
+        self._log_ops = 0      # 今のログに書いた操作の件数
+        self._log = None
+        self._events: List[Tuple[Mark, tuple]] = []  # on_events にまだ渡していない回答（専用スレッドだけが触る）
+        self._closing = False
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.is_new = True  # 開いたときにスナップショットもログも無かった
+        self._stats = {
+            "ops": 0, "log_writes": 0, "log_bytes": 0, "fsyncs": 0,
+            "snapshots": 0, "snapshot_bytes": 0, "snapshot_ms": 0.0,
+            "recovered_ops": 0, "recovery_ms": 0.0, "torn_tail": 0, "errors": 0,
+            "events_exported": 0,
+        }
+
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+        if self._events:
+            self._seq += 1  # 渡し直す回答も flush() で待てるように（空の操作として数える）
+        self._log_seq += 1
+        self._log = open(os.path.join(directory, _log_name(self._log_seq)), "ab")
+        self._thread = threading.Thread(target=self._run, name="memory-store", daemon=True)
+        self._thread.start()
+
+    def __len__(self) -> int:
+        return len(self._state)
+
+    # =========================================================
+    # 操作の適用（ライブの呼び出しと起動時の再生で同じものを通す）
+    # =========================================================
+    def _put_state(self, user_id: int, idx: int, at: float) -> None:
+        old = self._state.get(user_id)
+        n = len(BANK)
+        self._completed += (idx >= n) - (old is not None and old >= n)
+        self._state[user_id] = idx
+        self._updated[user_id] = at
+
+    def _drop_user(self, user_id: int) -> int:
+        """state と回答を消す。戻り値: 消した要素数"""
+        old = self._state.pop(user_id, None)
+        self._updated.pop(user_id, None)
+        if old is not None and old >= len(BANK):
+            self._completed -= 1
+        return (old is not None) + (self._answers.pop(user_id, None) is not None)
+
+    def _drop_order(self, user_id: int) -> int:
+        return (self._seeds.pop(user_id, None) is not None) + (self._legacy_orders.pop(user_id, None) is not None)
+
+    def _apply(self, op: list) -> None:
+        kind, uid = op[0], op[1]
+        if kind == "s":
+            self._put_state(uid, op[2], op[3])
+        elif kind == "a":
+            self._answers[uid] = pack_answer(self._answers.get(uid, b""), op[2], op[3])
+        elif kind == "r":
+            _, _, pos, qid, ans, at = op
+            self._answers[uid] = pack_answer(self._answers.get(uid, b""), qid, ans)
+            self._put_state(uid, pos + 1, at)
+            self._answer_counts[(qid, ans)] += 1
+            self._funnel[pos + 1] += 1
+        elif kind == "o":
+            self._legacy_orders.pop(uid, None)
+            self._seeds[uid] = op[2]
+        elif kind == "m":
+            self._msg[uid] = op[2]
+        elif kind == "x":
+            if op[2] == "user":
+                self._drop_user(uid)
+            elif op[2] == "order":
+                self._drop_order(uid)
+            else:
+                self._msg.pop(uid, None)
+        elif kind == "n":
+            self._drop_user(uid)
+            self._drop_order(uid)
+            self._msg.pop(uid, None)
+            self._put_state(uid, 0, op[3])
+            self._seeds[uid] = op[2]
+            self._funnel[0] += 1
+        elif kind == "z":
+            self._drop_user(uid)
+            self._drop_order(uid)
+            self._msg.pop(uid, None)
+        else:
+            raise ValueError(f"unknown op: {op!r}")
+
+    def _do(self, op: list) -> None:
+        # ロック中に呼ぶ。適用に失敗した操作（不正な回答など）はログに残さない
+        self._apply(op)
+        self._pending.append(op)
+        self._seq += 1
+        self._since_snapshot += 1
+        self._stats["ops"] += 1
+
+    def _order_of(self, user_id: int, question_ids: Sequence[int]) -> Optional[Sequence[int]]:
+        seed = self._seeds.get(user_id)
+        if seed is not None:
+            return seed_order(seed, BANK.version, tuple(question_ids))
+        return self._legacy_orders.get(user_id)
+
+    def _was_completed(self, user_id: int) -> bool:
+        return self._state.get(user_id, -1) >= len(BANK)
+
+    # =========================================================
+    # SessionStore
+    # =========================================================
+    def get_state(self, user_id: int) -> int:
+        with self._lock:
+            idx = self._state.get(user_id)
+            if idx is None:
+                self._do(["s", user_id, 0, time.time()])
+                return 0
+            return idx
+
+    def set_state(self, user_id: int, idx: int) -> None:
+        with self._lock:
+            self._do(["s", user_id, idx, time.time()])
+
+    def save_answer(self, user_id: int, question_id: int, answer: str) -> None:
+        with self._lock:
+            self._do(["a", user_id, question_id, answer])
+
+    def record_answer(self, user_id: int, idx: int, answer: str, question_ids: Sequence[int]) -> AnswerResult:
+        with self._lock:
+            order = self.get_or_create_order(user_id, question_ids)
+            mid = self._msg.get(user_id)
+            current = self._state.get(user_id)
+            if 0 <= idx < len(order) and (current == idx or (current is None and idx == 0)):
+                self._do(["r", user_id, idx, order[idx], answer, time.time()])
+                return AnswerResult(order, idx, idx + 1, idx + 1 >= len(order), mid)
+            current = current or 0
+            return AnswerResult(order, current, current, current >= len(order), mid, False)
+
+    def load_answers(self, user_id: int) -> List[Tuple[int, str]]:
+        return unpack_answers(self._answers.get(user_id, b""))
+
+    def get_profile(self, user_id: int) -> Tuple[dict, dict]:
+        picks, meters, _ = aggregate(self.load_answers(user_id))
+        return picks, meters
+
+    def load_completed_profiles(self) -> List[Tuple[int, dict]]:
+        n = len(BANK)
+        with self._lock:
+            rows = [(uid, self._answers.get(uid, b"")) for uid, idx in self._state.items() if idx >= n]
+        return [(uid, aggregate(unpack_answers(blob))[0]) for uid, blob in rows]
+
+    def rebuild_profiles(self) -> int:
+        # プロフィールは読むたびに回答から作るので作り直すものは無い。相性リストだけ消す
+        if self.on_forget is not None:
+            self.on_forget(None)
+        return len(self._answers)
+
+    def reset_user(self, user_id: int) -> None:
+        with self._lock:
+            completed = self._was_completed(user_id)
+            self._do(["x", user_id, "user"])
+        if completed and self.on_forget is not None:
+            self.on_forget([user_id])
+
+    def get_user_counters(self) -> dict:
+        with self._lock:
+            total, completed = len(self._state), self._completed
+        return {"total": total, "completed": completed, "inprogress": total - completed}
+
+    def check_user_counters(self) -> Tuple[dict, dict]:
+        with self._lock:
+            before = self.get_user_counters()
+            self._completed = self.count_completed_users(len(BANK))
+            return before, self.get_user_counters()
+
+    def count_total_users(self) -> int:
+        return len(self._state)
+
+    def count_completed_users(self, total_questions: int) -> int:
+        with self._lock:
+            return sum(1 for idx in self._state.values() if idx >= total_questions)
+
+    def count_inprogress_users(self, total_questions: int) -> int:
+        with self._lock:
+            return sum(1 for idx in self._state.values() if idx < total_questions)
+
+    def get_answer_stats(self) -> AnswerStats:
+        with self._lock:
+            funnel = [self._funnel.get(step, 0) for step in range(len(BANK) + 1)]
+            answers: Dict[int, Dict[str, int]] = {}
+            for (qid, ans), count in self._answer_counts.items():
+                answers.setdefault(qid, {})[ans] = count
+        return AnswerStats(funnel, answers)
+
+    def get_or_create_order(self, user_id: int, question_ids: Sequence[int]) -> Sequence[int]:
+        with self._lock:
+            ids = self._order_of(user_id, question_ids)
+            if ids is None:
+                self._do(["o", user_id, new_order_seed()])
+                ids = self._order_of(user_id, question_ids)
+            return ids
+
+    def reset_order(self, user_id: int) -> None:
+        with self._lock:
+            self._do(["x", user_id, "order"])
+
+    def get_message_id(self, user_id: int) -> Optional[int]:
+        return self._msg.get(user_id)
+
+    def set_message_id(self, user_id: int, message_id: int) -> None:
+        with self._lock:
+            self._do(["m", user_id, message_id])
+
+    def reset_message_id(self, user_id: int) -> None:
+        with self._lock:
+            self._do(["x", user_id, "msg"])
+
+    def start_session(self, user_id: int, question_ids: Sequence[int]) -> Sequence[int]:
+        with self._lock:
+            completed = self._was_completed(user_id)
+            self._do(["n", user_id, new_order_seed(), time.time()])
+            ids = self._order_of(user_id, question_ids)
+        if completed and self.on_forget is not None:
+            self.on_forget([user_id])
+        return ids
+
+    def find_stale_sessions(self, cutoff: float, limit: int) -> List[int]:
+        n = len(BANK)
+        with self._lock:
+            stale = [(at, uid) for uid, at in self._updated.items() if at < cutoff and self._state[uid] < n]
+        return [uid for _, uid in heapq.nsmallest(limit, stale)]
+
+    def list_session_users(self) -> List[int]:
+        with self._lock:
+            return list(self._state)
+
+    def archive_sessions(self, user_ids: Sequence[int], reason: str) -> ArchiveResult:
+        now = time.time()
+        users, rows, archived = [], 0, []
+        with self._lock:
+            for user_id in user_ids:
+                idx = self._state.get(user_id)
+                if idx is None:
+                    continue
+                legacy = self._legacy_orders.get(user_id)
+                archived.append((
+                    user_id, idx, self._answers.get(user_id) or None, self._seeds.get(user_id),
+                    json.dumps(legacy) if legacy is not None else None,
+                    self._updated.get(user_id), reason, now,
+                ))
+                rows += (
+                    1 + (user_id in self._answers)
+                    + (user_id in self._seeds or user_id in self._legacy_orders) + (user_id in self._msg)
+                )
+                self._do(["z", user_id])
+                users.append((user_id, idx))
+        if archived:
+            if self.on_archive is not None:
+                self.on_archive(archived)
+            if self.on_forget is not None:
+                self.on_forget([uid for uid, _ in users])
+        return ArchiveResult(users, rows)
+
+    def flush(self) -> None:
+        with self._durable:
+            target = self._seq
+            if self._durable_seq >= target:
+                return
+            self._wakeup.set()
+            while self._durable_seq < target and self._thread is not None and self._thread.is_alive():
+                self._durable.wait(0.1)
+
+    def snapshot(self) -> None:
+        """次の書き出しでスナップショットを取り、書き終わるまで待つ"""
+        with self._lock:
+            self._snapshot_requested = True
+            self._seq += 1  # flush() が書き出しを待つように（空の操作として数える）
+        self.flush()
+
+    def close(self) -> None:
+        """残りのログを書き、スナップショットを取って止める"""
+        thread = self._thread
+        if thread is None:
+            return
+        with self._lock:
+            self._snapshot_requested = self._snapshot_requested or self._since_snapshot > 0
+            self._closing = True
+        self._wakeup.set()
+        thread.join()
+        self._thread = None
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "backend": self.name,
+                "users": len(self._state),
+                "pending": len(self._pending),
+                "since_snapshot": self._since_snapshot,
+                "log_seq": self._log_seq,
+                "events_pending": len(self._events),
+                **self._stats,
+            }
+
+    # =========================================================
+    # SQLite から移す（初めてメモリ版で起動したとき）
+    # =========================================================
+    def import_sessions(self, sessions: Iterable[tuple], funnel: Iterable[Tuple[int, int]],
+                        answer_counts: Iterable[Tuple[int, str, int]]) -> int:
+        """
+        sessions: (user_id, idx, updated_at, answers, seed, order_json, message_id)
+        取り込んだ後すぐスナップショットを取る（ログには積まない）。戻り値: 取り込んだ人数
+        """
+        count = 0
+        with self._lock:
+            for uid, idx, at, blob, seed, order_json, mid in sessions:
+                self._put_state(uid, idx, at if at is not None else time.time())
+                if blob:
+                    self._answers[uid] = bytes(blob)
+                if seed is not None:
+                    self._seeds[uid] = seed
+                elif order_json is not None:
+                    self._legacy_orders[uid] = json.loads(order_json)
+                if mid is not None:
+                    self._msg[uid] = mid
+                count += 1
+            self._funnel.update(dict(funnel))
+            self._answer_counts.update({(qid, ans): n for qid, ans, n in answer_counts})
+        self.snapshot()
+        return count
+
+    # =========================================================
+    # 永続化（ログの書き出しとスナップショットは専用スレッドだけが行う）
+    # =========================================================
+    def _snapshot_due(self) -> bool:
+        if self._snapshot_requested:
+            return True
+        if self._since_snapshot >= self.snapshot_ops:
+            return True
+        return self._since_snapshot > 0 and time.monotonic() - self._last_snapshot >= self.snapshot_interval
+
+    def _dump(self) -> dict:
+        # ロック中に呼ぶ。ここで写した内容には、同じロックで取り出したログの分まで入っている
+        return {
+            "format": SNAPSHOT_FORMAT,
+            "saved_at": time.time(),
+            "state": [[uid, idx, self._updated.get(uid)] for uid, idx in self._state.items()],
+            "answers": [[uid, blob.hex()] for uid, blob in self._answers.items()],
+            "seeds": list(self._seeds.items()),
+            "legacy_orders": list(self._legacy_orders.items()),
+            "msg": list(self._msg.items()),
+            "funnel": list(self._funnel.items()),
+            "answer_counts": [[qid, ans, n] for (qid, ans), n in self._answer_counts.items()],
+            # 消えるログにあって、まだ on_events に渡せていない回答
+            "events": [[*mark, *row] for mark, row in self._events],
+        }
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            with self._lock:
+                ops, self._pending = self._pending, []
+                seq = self._seq
+                closing = self._closing
+                self._collect_events(ops)
+                dump = None
+                if self._snapshot_due():
+                    dump = self._dump()
+                    self._since_snapshot = 0
+                    self._snapshot_requested = False
+                    self._last_snapshot = time.monotonic()
+            try:
+                if ops:
+                    self._write_log(ops)
+                if dump is not None:
+                    self._write_snapshot(dump)
+            except Exception as e:
+                self._stats["errors"] += 1
+                print("memory store write failed:", repr(e))
+            self._export_events()
+            with self._durable:
+                self._durable_seq = seq
+                self._durable.notify_all()
+            if closing:
+                return
+
+    def _collect_events(self, ops: List[list]) -> None:
+        # ロック中に呼ぶ。ops はこのあと今のログに書く分（mark はそのログの何件目か）
+        base = self._log_ops
+        self._log_ops += len(ops)
+        if self.on_events is None:
+            return
+        for i, op in enumerate(ops, start=base + 1):
+            if op[0] == "r":
+                _, uid, pos, qid, ans, at = op
+                self._events.append(((self._log_seq, i), (uid, qid, pos, ans, at)))
+
+    def _export_events(self) -> None:
+        if not self._events:
+            return
+        n = len(self._events)
+        try:
+            self.on_events([row for _, row in self._events[:n]], self._events[n - 1][0])
+        except Exception as e:
+            # 次の書き出しでもう一度渡す
+            self._stats["errors"] += 1
+            print("memory store answer events export failed:", repr(e))
+            return
+        del self._events[:n]
+        self._stats["events_exported"] += n
+
+    def _write_log(self, ops: List[list]) -> None:
+        data = "".join(json.dumps(op, separators=(",", ":")) + "\n" for op in ops).encode("utf-8")
+        self._log.write(data)
+        self._log.flush()
+        if self.fsync:
+            os.fsync(self._log.fileno())
+            self._stats["fsyncs"] += 1
+        self._stats["log_writes"] += 1
+        self._stats["log_bytes"] += len(data)
+
+    def _write_snapshot(self, dump: dict) -> None:
+        t0 = time.perf_counter()
+        # 以降の操作は新しいログへ。スナップショットは「このログから再生すればよい」番号を持つ
+        self._log.close()
+        self._log_seq += 1
+        self._log = open(os.path.join(self.directory, _log_name(self._log_seq)), "ab")
+        self._log_ops = 0
+        dump["log"] = self._log_seq
+
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        tmp = path + ".tmp"
+        data = json.dumps(dump, separators=(",", ":")).encode("utf-8")
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        _fsync_dir(self.directory)
+
+        for seq, name in self._log_files():
+            if seq < self._log_seq:
+                os.remove(os.path.join(self.directory, name))
+        self._stats["snapshots"] += 1
+        self._stats["snapshot_bytes"] = len(data)
+        self._stats["snapshot_ms"] = (time.perf_counter() - t0) * 1000
+
+    def _log_files(self) -> List[Tuple[int, str]]:
+        files = []
+        for name in os.listdir(self.directory):
+            if name.startswith(LOG_PREFIX) and name.endswith(LOG_SUFFIX):
+                try:
+                    files.append((int(name[len(LOG_PREFIX):-len(LOG_SUFFIX)]), name))
+                except ValueError:
+                    continue
+        return sorted(files)
+
+    def _recover(self) -> None:
+        t0 = time.perf_counter()
+        start = 0
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        if os.path.exists(path):
+            self.is_new = False
+            with open(path, "rb") as f:
+                dump = json.loads(f.read())
+            if dump.get("format") != SNAPSHOT_FORMAT:
+                raise RuntimeError(f"unknown memory store snapshot format: {dump.get('format')}")
+            for uid, idx, at in dump["state"]:
+                self._put_state(uid, idx, at)
+            self._answers = {uid: bytes.fromhex(h) for uid, h in dump["answers"]}
+            self._seeds = dict(dump["seeds"])
+            self._legacy_orders = dict(dump["legacy_orders"])
+            self._msg = dict(dump["msg"])
+            self._funnel = Counter(dict(dump["funnel"]))
+            self._answer_counts = Counter({(qid, ans): n for qid, ans, n in dump["answer_counts"]})
+            for log_seq, i, *row in dump.get("events", []):
+                self._recover_event((log_seq, i), tuple(row))
+            start = dump["log"]
+
+        files = self._log_files()
+        replayed = 0
+        for seq, name in files:
+            self._log_seq = max(self._log_seq, seq)
+            self.is_new = False
+            if seq < start:
+                continue
+            with open(os.path.join(self.directory, name), "rb") as f:
+                lines = f.read().split(b"\n")
+            i = 0
+            for j, line in enumerate(lines):
+                if not line:
+                    continue
+                try:
+                    op = json.loads(line)
+                except ValueError:
+                    # 改行で終わっていない最後の1行は書いている途中で落ちた分なので捨てる。それ以外は壊れている
+                    if j == len(lines) - 1:
+                        self._stats["torn_tail"] += 1
+                        break
+                    raise
+                self._apply(op)
+                replayed += 1
+                i += 1
+                if op[0] == "r":
+                    _, uid, pos, qid, ans, at = op
+                    self._recover_event((seq, i), (uid, qid, pos, ans, at))
+        self._log_seq = max(self._log_seq, start - 1)
+
+        # 質問数が変わっていても「完了」を今のバンクで数え直す
+        n = len(BANK)
+        self._completed = sum(1 for idx in self._state.values() if idx >= n)
+        self._since_snapshot = replayed
+        self._stats["recovered_ops"] = replayed
+        self._stats["recovery_ms"] = (time.perf_counter() - t0) * 1000
+
+    def _recover_event(self, mark: Mark, row: tuple) -> None:
+        # on_events に渡し終えていない回答だけ渡し直す
+        if self.on_events is not None and mark > tuple(self.events_mark):
+            self._events.append((mark, row))
@@ -0,0 +1,355 @@
+# metrics.py
+# プロセス内の簡易メトリクス（カウンタ・ゲージ・固定バケットのヒストグラム）
+# - db.py の公開関数 / Discord REST / ハンドラ全体の所要時間を記録する
+# - Prometheus のテキスト形式で出力（METRICS_PORT を指定するとローカルの HTTP で公開）
+# - スレッドから（to_thread 経由の db.py からも）そのまま呼べる
+
+import functools
+import inspect
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# 秒。Discord の REST（数十〜数百 ms）と SQLite（〜1ms）の両方が見える刻み
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    if float(v).is_integer():
+        return str(int(v))
+    return repr(float(v))
+
+
+class _CounterChild:
+    __slots__ = ("_lock", "value")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeChild:
+    __slots__ = ("_lock", "value", "_fn")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+        self._fn: Optional[Callable[[], float]] = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.inc(-amount)
+
+    def set_function(self, fn: Callable[[], float]) -> None:
+        """出力するたびに fn() を呼んで値にする（キュー長・キャッシュ件数など）"""
+        self._fn = fn
+
+    def get(self) -> float:
+        if self._fn is not None:
+            try:
+                return float(self._fn())
+            except Exception:
+                return float("nan")
+        return self.value
+
+
+class _HistogramChild:
+    __slots__ = ("_lock", "_bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self._lock = threading.Lock()
+        self._bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 最後は +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        i = bisect_left(self._bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """バケットからの推定値（バケット内は線形補間）。記録なしは None"""
+        with self._lock:
+            counts = list(self.counts)
+            total = self.count
+        if total == 0:
+            return None
+        rank = q * total
+        seen = 0
+        for i, c in enumerate(counts):
+            if c and seen + c >= rank:
+                lo = self._bounds[i - 1] if i > 0 else 0.0
+                if i >= len(self._bounds):
+                    return lo
+                return lo + (self._bounds[i] - lo) * ((rank - seen) / c)
+            seen += c
+        return self._bounds[-1]
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values, **kw):
+        if kw:
+            if values or set(kw) != set(self.labelnames):
+                raise ValueError(f"{self.name}: expected labels {self.labelnames}, got {sorted(kw)}")
+            values = tuple(kw[n] for n in self.labelnames)
+        key = tuple(str(v) for v in values)
+        if len(key) != len(self.labelnames):
+            raise ValueError(f"{self.name}: expected labels {self.labelnames}, got {key}")
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def children(self) -> List[Tuple[Tuple[str, ...], object]]:
+        with self._lock:
+            return sorted(self._children.items())
+
+    def _default(self):
+        return self.labels()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self._default().inc(amount)
+
+    def render(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}"
+            for key, child in self.children()
+        ]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float) -> None:
+        self._default().set(value)
+
+    def inc(self, amount: float = 1.0) -> None:
+        self._default().inc(amount)
+
+    def dec(self, amount: float = 1.0) -> None:
+        self._default().dec(amount)
+
+    def set_function(self, fn: Callable[[], float]) -> None:
+        self._default().set_function(fn)
+
+    def render(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.get())}"
+            for key, child in self.children()
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def summary(self, limit: Optional[int] = None) -> List[dict]:
+        """ラベルごとの count / sum / mean / p50 / p95 / p99（合計時間の多い順）"""
+        rows = []
+        for key, child in self.children():
+            if child.count == 0:
+                continue
+            rows.append({
+                "labels": dict(zip(self.labelnames, key)),
+                "count": child.count,
+                "sum": child.sum,
+                "mean": child.sum / child.count,
+                "p50": child.quantile(0.50),
+                "p95": child.quantile(0.95),
+                "p99": child.quantile(0.99),
+            })
+        rows.sort(key=lambda r: r["sum"], reverse=True)
+        return rows[:limit] if limit is not None else rows
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, child in self.children():
+            with child._lock:
+                counts = list(child.counts)
+                total, total_sum = child.count, child.sum
+            cumulative = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                cumulative += c
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total_sum)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {total}")
+        return lines
+
+
+class Registry:
+    """名前 → メトリクス。同じ名前で2回作ると既存のものを返す"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, *args, **kw):
+        with self._lock:
+            m = self._metrics.get(name)
+            if m is None:
+                m = self._metrics[name] = cls(name, *args, **kw)
+            elif not isinstance(m, cls):
+                raise ValueError(f"metric {name} already registered as {m.kind}")
+            return m
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, help, labelnames)
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help, labelnames, buckets)
+
+    def get(self, name: str) -> Optional[_Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """Prometheus テキスト形式（version 0.0.4）"""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        out = []
+        for m in metrics:
+            out.append(f"# HELP {m.name} {_escape(m.help)}")
+            out.append(f"# TYPE {m.name} {m.kind}")
+            out.extend(m.render())
+        return "\n".join(out) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def timed(hist, errors=None):
+    """
+    関数（同期 / async どちらも）の所要時間を hist（ヒストグラムの子）に記録するデコレータ。
+    errors（カウンタの子）を渡すと例外の回数も数える。
+    """
+    def deco(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kw):
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kw)
+                except BaseException:
+                    if errors is not None:
+                        errors.inc()
+                    raise
+                finally:
+                    hist.observe(time.perf_counter() - start)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kw):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kw)
+            except BaseException:
+                if errors is not None:
+                    errors.inc()
+                raise
+            finally:
+                hist.observe(time.perf_counter() - start)
+        return wrapper
+    return deco
+
+
+class _Handler(BaseHTTPRequestHandler):
+    registry: Registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # アクセスログは出さない
+
+
+def start_http_server(port: int, host: str = "127.0.0.1", registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    """GET /metrics を返す HTTP サーバーを daemon スレッドで起動する"""
+    handler = type("MetricsHandler", (_Handler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
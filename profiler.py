@@ -0,0 +1,188 @@
+# profiler.py
+# 動いている bot を止めずに N 秒だけ取るサンプリングプロファイラ（/profile 用）
+# - スレッド: 別スレッドから sys._current_frames() を interval ごとに読む（イベントループ・to_thread・db-writer の実行中の処理）
+# - タスク: イベントループ上で interval ごとに asyncio のタスクを見て、await 中のコルーチンの連なりを記録する
+#           （Discord の HTTP 待ちのように、どのスレッドでも実行されていない「待ち」はこちらに出る）
+# 取っていないときはスレッドもフックも無いので、普段の処理には何も足さない。
+# 出力は collapsed stack 形式（"root;caller;callee 件数"。flamegraph.pl / speedscope でそのまま読める）
+
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+Stack = Tuple[str, ...]  # 外側 → 内側。各要素は "関数名 (モジュール名)"
+
+# 時間の内訳を出す分類（どれかのフレームが当てはまれば、そのサンプルをその分類に数える。重複あり）
+CATEGORIES: Dict[str, Callable[[str], bool]] = {
+    "on_interaction": lambda frame: frame.startswith("on_interaction (bot)"),
+    "db": lambda frame: frame.endswith(" (db)"),
+    "discord_http": lambda frame: frame.endswith((" (discord.http)", " (discord.webhook.async_)"))
+    or " (aiohttp." in frame,
+}
+
+# 何もせずに待っているだけのスレッド（一番内側のフレームで判定）は「空き」として集計から外す
+_IDLE_MODULES = ("(selectors)", "(threading)", "(queue)")
+_IDLE_FRAMES = {"_worker (concurrent.futures.thread)"}
+
+
+def _label(code, module: Optional[str]) -> str:
+    if not module or module == "__main__":
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({module})"
+
+
+def _frame_stack(frame) -> List[str]:
+    stack = []
+    while frame is not None:
+        stack.append(_label(frame.f_code, frame.f_globals.get("__name__")))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def _coro_stack(coro) -> List[str]:
+    """タスクのコルーチンから、await している先を内側までたどる"""
+    stack = []
+    while coro is not None:
+        code = getattr(coro, "cr_code", None) or getattr(coro, "gi_code", None) or getattr(coro, "ag_code", None)
+        if code is None:
+            break
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None) or getattr(coro, "ag_frame", None)
+        stack.append(_label(code, frame.f_globals.get("__name__") if frame is not None else None))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None) or getattr(coro, "ag_await", None)
+    return stack
+
+
+def is_idle(stack: Stack) -> bool:
+    return bool(stack) and (stack[-1].endswith(_IDLE_MODULES) or stack[-1] in _IDLE_FRAMES)
+
+
+class Profile:
+    """
+    threads: スレッドのサンプル（root は "thread:名前"）
+    tasks  : タスクのサンプル（root は "task:名前"）
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.threads: Counter = Counter()
+        self.tasks: Counter = Counter()
+        self.thread_ticks = 0
+        self.task_ticks = 0
+        self.started = time.time()
+        self.duration = 0.0
+
+    def busy_threads(self) -> Counter:
+        return Counter({stack: n for stack, n in self.threads.items() if not is_idle(stack)})
+
+    def attribution(self) -> Dict[str, Tuple[int, int]]:
+        """分類 → (実行中スレッドのサンプル数, タスクのサンプル数)"""
+        busy = self.busy_threads()
+        out = {}
+        for name, match in CATEGORIES.items():
+            out[name] = (
+                sum(n for stack, n in busy.items() if any(match(f) for f in stack)),
+                sum(n for stack, n in self.tasks.items() if any(match(f) for f in stack)),
+            )
+        return out
+
+    def top_functions(self, limit: int = 15) -> List[Tuple[str, int, int]]:
+        """実行中スレッドのサンプルから (関数, self, total)。self の多い順"""
+        own: Counter = Counter()
+        total: Counter = Counter()
+        for stack, n in self.busy_threads().items():
+            own[stack[-1]] += n
+            for frame in set(stack[1:]):
+                total[frame] += n
+        return [(f, own[f], total[f]) for f, _ in own.most_common(limit)]
+
+    def collapsed(self) -> str:
+        lines = [";".join(stack) + f" {n}" for stack, n in sorted(self.threads.items())]
+        lines += [";".join(stack) + f" {n}" for stack, n in sorted(self.tasks.items())]
+        return "\n".join(lines) + "\n"
+
+    def summary(self, limit: int = 15) -> str:
+        busy = sum(self.busy_threads().values())
+        task_samples = sum(self.tasks.values())
+        lines = [
+            f"{self.duration:.1f}s @ {self.interval * 1000:g}ms: "
+            f"thread samples {sum(self.threads.values())} (busy {busy}) / task samples {task_samples}",
+            "",
+            f"{'category':<16} {'busy threads':>12} {'tasks':>8}",
+        ]
+        for name, (t, a) in self.attribution().items():
+            lines.append(
+                f"{name:<16} {t / busy * 100 if busy else 0:>11.1f}% {a / task_samples * 100 if task_samples else 0:>7.1f}%"
+            )
+        lines += ["", f"{'self':>6} {'total':>6}  function (busy thread samples)"]
+        for frame, own, total in self.top_functions(limit):
+            lines.append(f"{own:>6} {total:>6}  {frame}")
+        return "\n".join(lines)
+
+    def write(self, directory: str) -> Tuple[str, str]:
+        """collapsed stack と summary をファイルに書く。戻り値: (collapsed のパス, summary のパス)"""
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, time.strftime("profile-%Y%m%d-%H%M%S", time.localtime(self.started)))
+        with open(base + ".collapsed", "w", encoding="utf-8") as f:
+            f.write(self.collapsed())
+        with open(base + ".txt", "w", encoding="utf-8") as f:
+            f.write(self.summary(50) + "\n")
+        return base + ".collapsed", base + ".txt"
+
+
+class SamplingProfiler:
+    """run(seconds) の間だけサンプルを取る。同時に1本だけ（呼び出し側でそろえる）"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+
+    def _sample_threads(self, profile: Profile, stop: threading.Event) -> None:
+        me = threading.get_ident()
+        while not stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                root = f"thread:{names.get(ident, ident)}"
+                profile.threads[(root, *_frame_stack(frame))] += 1
+            profile.thread_ticks += 1
+
+    def _sample_tasks(self, profile: Profile, skip: Optional[asyncio.Task]) -> None:
+        # call_later のコールバックから呼ぶ（イベントループのスレッドなので all_tasks を安全に読める）
+        for task in asyncio.all_tasks():
+            if task is skip or task.done():
+                continue
+            stack = _coro_stack(task.get_coro())
+            if stack:
+                profile.tasks[(f"task:{task.get_name()}", *stack)] += 1
+        profile.task_ticks += 1
+
+    async def run(self, seconds: float) -> Profile:
+        profile = Profile(self.interval)
+        loop = asyncio.get_running_loop()
+        me = asyncio.current_task()  # /profile 自身の待ちは数えない
+        stop = threading.Event()
+        sampler = threading.Thread(target=self._sample_threads, args=(profile, stop), name="profiler", daemon=True)
+
+        handle = None
+
+        def tick():
+            nonlocal handle
+            self._sample_tasks(profile, me)
+            handle = loop.call_later(self.interval, tick)
+
+        start = time.perf_counter()
+        sampler.start()
+        handle = loop.call_later(self.interval, tick)
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            handle.cancel()
+            stop.set()
+            await asyncio.to_thread(sampler.join)
+            profile.duration = time.perf_counter() - start
+        return profile
@@ -0,0 +1,43 @@
+# profiles.py
+# 回答 → プロフィール（カテゴリ別の最頻回答・平均星・回答数）の集計
+# bot.py の表示と db.py の profiles テーブル更新で同じ集計を使う。
+
+from collections import defaultdict, Counter
+from typing import Dict, List, Tuple
+
+from question_bank import BANK
+
+# 5段階：A=★1〜E=★5
+STAR_MAP = {"A": 1, "B": 2, "C": 3, "D": 4, "E": 5}
+VALID_ANS = set(STAR_MAP.keys())
+
+
+def aggregate_category(letters: List[str]) -> Tuple[str, int, Dict[str, int]]:
+    """
+    1カテゴリ分の回答（question_id 順）から (最頻回答, 平均星, 文字別回答数)
+    最頻が同数のときは先に出た回答を採用（Counter.most_common と同じ）
+    """
+    c = Counter(letters)
+    pick = c.most_common(1)[0][0]
+    meter = int(round(sum(STAR_MAP[x] for x in letters) / len(letters)))
+    return pick, meter, dict(c)
+
+
+def aggregate(answers: List[Tuple[int, str]]):
+    """
+    answers: [(question_id, answer), ...]（question_id 順）
+    -> picks, meters, counts
+    """
+    by_cat = defaultdict(list)
+    for qid, ans in answers:
+        cat = BANK.category_of.get(qid)
+        if cat and ans in VALID_ANS:
+            by_cat[cat].append(ans)
+
+    picks = {}
+    meters = {}
+    counts = {}
+    for cat, lst in by_cat.items():
+        picks[cat], meters[cat], counts[cat] = aggregate_category(lst)
+
+    return picks, meters, counts
@@ -0,0 +1,58 @@
+# question_bank.py
+# questions.py を起動時に1回だけコンパイルした索引
+# id → 質問 / カテゴリ → id 一覧 / カテゴリの固定順 / バンクのバージョン（内容のハッシュ）
+
+import hashlib
+import json
+from typing import Dict, List, Tuple
+
+from questions import QUESTIONS
+
+
+class QuestionBank:
+    """
+    questions: questions.py の QUESTIONS 形式（id / category / text / choices）
+    version  : 質問内容から決まる短いハッシュ。質問を足したり並べ替えたりすると変わるので、
+               集計やキャッシュのキーに使う。
+    """
+
+    def __init__(self, questions: List[dict]):
+        self.questions: Tuple[dict, ...] = tuple(questions)
+        self.by_id: Dict[int, dict] = {}
+        self.category_of: Dict[int, str] = {}
+        ids_by_category: Dict[str, List[int]] = {}
+
+        for q in self.questions:
+            qid = q["id"]
+            if qid in self.by_id:
+                raise ValueError(f"duplicate question id: {qid}")
+            self.by_id[qid] = q
+            cat = q.get("category")
+            if cat:
+                self.category_of[qid] = cat
+                ids_by_category.setdefault(cat, []).append(qid)
+
+        self.ids: Tuple[int, ...] = tuple(q["id"] for q in self.questions)
+        # カテゴリの表示・比較順は questions.py に最初に出てきた順
+        self.categories: Tuple[str, ...] = tuple(ids_by_category)
+        self.ids_by_category: Dict[str, Tuple[int, ...]] = {
+            cat: tuple(sorted(ids)) for cat, ids in ids_by_category.items()
+        }
+
+        canonical = json.dumps(
+            [[q["id"], q.get("category"), q["text"], [list(c) for c in q.get("choices", [])]] for q in self.questions],
+            ensure_ascii=False, separators=(",", ":"),
+        )
+        self.version = hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:12]
+
+    def __len__(self) -> int:
+        return len(self.questions)
+
+    def question(self, qid: int) -> dict:
+        try:
+            return self.by_id[qid]
+        except KeyError:
+            raise KeyError(f"question id not found: {qid}") from None
+
+
+BANK = QuestionBank(QUESTIONS)
@@ -0,0 +1,114 @@
+# room_pool.py
+# 事前に作っておく非公開の予備ルーム（参加直後の /room 集中でチャンネル作成のレート制限に当たらないように）
+# - 予備ルームは topic が SPARE_TOPIC の非公開チャンネル。起動時にギルドを走査して拾い直す
+# - 取り出しは take() で O(1)。減った分は裏のタスクが refill_interval 秒に1件ずつ作り足す
+# - チャンネル作成・編集そのものは呼び出し側（bot.py）が渡す create で行う
+
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Iterable, Optional
+
+SPARE_TOPIC = "pool:spare"
+
+Create = Callable[[int], Awaitable[int]]
+
+
+def is_spare_topic(topic: Optional[str]) -> bool:
+    return (topic or "") == SPARE_TOPIC
+
+
+class RoomPool:
+    """
+    ギルドごとに予備ルームの channel_id を size 件まで貯めておく。
+    create(guild_id) は予備ルームを1件作って channel_id を返す coroutine。
+    作り足すのは replace_guild() で登録したギルドだけ。size が 0 なら何もしない
+    """
+
+    def __init__(self, create: Create, size: int, refill_interval: float = 2.0, error_backoff: float = 60.0):
+        self.create = create
+        self.size = size
+        self.refill_interval = refill_interval
+        self.error_backoff = error_backoff
+        self._spare: Dict[int, Deque[int]] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"claimed": 0, "empty": 0, "stale": 0, "created": 0, "errors": 0, "last_refill": None}
+
+    def __len__(self) -> int:
+        return sum(len(q) for q in self._spare.values())
+
+    def count(self, guild_id: int) -> int:
+        q = self._spare.get(guild_id)
+        return len(q) if q is not None else 0
+
+    def replace_guild(self, guild_id: int, channel_ids: Iterable[int]) -> None:
+        """ギルドの予備ルームを丸ごと置き換える（起動時の走査結果）"""
+        self._spare[guild_id] = deque(channel_ids)
+        self._wakeup.set()
+
+    def add(self, guild_id: int, channel_id: int) -> None:
+        q = self._spare.setdefault(guild_id, deque())
+        if channel_id not in q:
+            q.append(channel_id)
+
+    def discard(self, channel_id: int) -> bool:
+        """予備ルームが消された・使えなくなったときに外す"""
+        for q in self._spare.values():
+            if channel_id in q:
+                q.remove(channel_id)
+                self._wakeup.set()
+                return True
+        return False
+
+    def take(self, guild_id: int) -> Optional[int]:
+        """予備ルームを1件取り出す（無ければ None。呼び出し側はその場で作る）"""
+        q = self._spare.get(guild_id)
+        if not q:
+            self.stats["empty"] += 1
+            return None
+        self.stats["claimed"] += 1
+        self._wakeup.set()
+        return q.popleft()
+
+    def start(self) -> None:
+        if self.size > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def snapshot(self) -> dict:
+        """
+        spare: 予備の合計 / claimed: 予備から渡した回数 / empty: 予備が無くてその場で作らせた回数
+        stale: 渡したが消えていて使えなかった回数（呼び出し側が数える）
+        """
+        return {"spare": len(self), "size": self.size, "refill_interval": self.refill_interval, **self.stats}
+
+    def _next_short(self) -> Optional[int]:
+        # いちばん足りないギルドから
+        short = [(len(q), gid) for gid, q in self._spare.items() if len(q) < self.size]
+        return min(short)[1] if short else None
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            guild_id = self._next_short()
+            if guild_id is None:
+                await self._wakeup.wait()
+                continue
+
+            try:
+                channel_id = await self.create(guild_id)
+            except Exception as e:
+                self.stats["errors"] += 1
+                print("room pool refill failed:", repr(e))
+                await asyncio.sleep(self.error_backoff)
+                continue
+            if guild_id in self._spare:
+                self.add(guild_id, channel_id)
+            self.stats["created"] += 1
+            self.stats["last_refill"] = time.time()
+            await asyncio.sleep(self.refill_interval)
@@ -0,0 +1,92 @@
+# rooms.py
+# 診断ルームの索引（user_id ↔ channel_id）
+# 起動時にギルドのチャンネルを1回だけ走査して作り、以後はチャンネル作成/削除イベントで更新する。
+# 永続化は db.py の user_rooms テーブル（bot.py 側で to_thread して書く）。
+
+import re
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+_TOPIC_RE = re.compile(r"^user:(\d+)(?:\s|$)")
+
+
+def room_owner_from_topic(topic: Optional[str]) -> Optional[int]:
+    """
+    topic: "user:{id} name:..." → id（ルームでなければ None）
+    """
+    m = _TOPIC_RE.match(topic or "")
+    return int(m.group(1)) if m else None
+
+
+class RoomRegistry:
+    """
+    (guild_id, user_id) → channel_id と channel_id → (guild_id, user_id) の双方向索引。
+    件数はギルドごとに保持するので /logs は O(1)。
+    """
+
+    def __init__(self):
+        self._by_user: Dict[Tuple[int, int], int] = {}
+        self._by_channel: Dict[int, Tuple[int, int]] = {}
+        self._counts: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._by_channel)
+
+    def channel_of(self, guild_id: int, user_id: int) -> Optional[int]:
+        return self._by_user.get((guild_id, user_id))
+
+    def owner_of(self, channel_id: int) -> Optional[int]:
+        item = self._by_channel.get(channel_id)
+        return item[1] if item else None
+
+    def count(self, guild_id: int) -> int:
+        return self._counts.get(guild_id, 0)
+
+    def add(self, guild_id: int, user_id: int, channel_id: int) -> Optional[int]:
+        """
+        登録する。同じユーザーの古いルームが登録済みなら置き換え、その channel_id を返す
+        """
+        with self._lock:
+            old_channel = self._by_user.get((guild_id, user_id))
+            if old_channel == channel_id:
+                return None
+            if old_channel is not None:
+                self._remove_locked(old_channel)
+            self._remove_locked(channel_id)
+            self._by_user[(guild_id, user_id)] = channel_id
+            self._by_channel[channel_id] = (guild_id, user_id)
+            self._counts[guild_id] = self._counts.get(guild_id, 0) + 1
+            return old_channel
+
+    def remove_channel(self, channel_id: int) -> Optional[int]:
+        """削除する。登録されていたルームの user_id を返す"""
+        with self._lock:
+            return self._remove_locked(channel_id)
+
+    def _remove_locked(self, channel_id: int) -> Optional[int]:
+        item = self._by_channel.pop(channel_id, None)
+        if item is None:
+            return None
+        guild_id, user_id = item
+        if self._by_user.get(item) == channel_id:
+            del self._by_user[item]
+        self._counts[guild_id] -= 1
+        return user_id
+
+    def replace_guild(self, guild_id: int, rooms: Iterable[Tuple[int, int]]) -> None:
+        """
+        ギルドの登録内容を丸ごと置き換える（起動時の一括再構築）
+        rooms: [(user_id, channel_id), ...]
+        """
+        with self._lock:
+            for channel_id, (gid, _) in list(self._by_channel.items()):
+                if gid == guild_id:
+                    self._remove_locked(channel_id)
+            for user_id, channel_id in rooms:
+                old_channel = self._by_user.get((guild_id, user_id))
+                if old_channel is not None:
+                    self._remove_locked(old_channel)
+                self._by_user[(guild_id, user_id)] = channel_id
+                self._by_channel[channel_id] = (guild_id, user_id)
+                self._counts[guild_id] = self._counts.get(guild_id, 0) + 1
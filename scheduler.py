@@ -0,0 +1,119 @@
+# scheduler.py
+# 期限つきジョブを1本のタスクとヒープで回すスケジューラ（ルーム自動削除用）
+# 期限の永続化は呼び出し側（bot.py → db.py の room_deadlines）で行い、
+# 起動時に読み直して schedule() し直せば再開できる。
+
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+Handler = Callable[[List[Tuple[Hashable, Any]]], Awaitable[None]]
+
+
+class DeadlineScheduler:
+    """
+    schedule(key, due_at, payload) で登録（同じ key は上書き）、cancel(key) で取り消し。
+    期限が来たものは最大 batch_size 件ずつ handler にまとめて渡し、
+    続きがあるときはバッチ間に batch_interval 秒あける（Discord のレート制限対策）。
+
+    due_at は time.time() 基準（再起動をまたいで永続化するため）
+    """
+
+    def __init__(self, handler: Handler, batch_size: int = 5, batch_interval: float = 1.0):
+        self.handler = handler
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        self._entries: Dict[Hashable, Tuple[float, Any]] = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"fired": 0, "batches": 0, "errors": 0, "lag_last": 0.0, "lag_max": 0.0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def schedule(self, key: Hashable, due_at: float, payload: Any = None) -> None:
+        self._entries[key] = (due_at, payload)
+        heapq.heappush(self._heap, (due_at, next(self._seq), key))
+        if self._heap[0][2] == key:
+            self._wakeup.set()
+
+    def cancel(self, key: Hashable) -> bool:
+        # ヒープからは取り出したときに捨てる（遅延削除）
+        return self._entries.pop(key, None) is not None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def snapshot(self) -> dict:
+        """
+        depth: 待ち件数 / lag_*: 期限から実行までの遅れ（秒）
+        overdue: 先頭が期限を過ぎてから今までの秒数（詰まっていると増え続ける）
+        """
+        next_due = self._peek()
+        now = time.time()
+        return {
+            "depth": len(self._entries),
+            "next_in": max(0.0, next_due - now) if next_due is not None else None,
+            "overdue": max(0.0, now - next_due) if next_due is not None else 0.0,
+            **self.stats,
+        }
+
+    def _peek(self) -> Optional[float]:
+        # 取り消し済み・上書き済みのものを先頭から捨てる
+        while self._heap:
+            due_at, _, key = self._heap[0]
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == due_at:
+                return due_at
+            heapq.heappop(self._heap)
+        return None
+
+    def _pop_due(self, now: float) -> List[Tuple[Hashable, Any]]:
+        batch = []
+        while len(batch) < self.batch_size:
+            due_at = self._peek()
+            if due_at is None or due_at > now:
+                break
+            _, _, key = heapq.heappop(self._heap)
+            _, payload = self._entries.pop(key)
+            lag = now - due_at
+            self.stats["lag_last"] = lag
+            self.stats["lag_max"] = max(self.stats["lag_max"], lag)
+            batch.append((key, payload))
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            due_at = self._peek()
+            now = time.time()
+            if due_at is None or due_at > now:
+                timeout = None if due_at is None else due_at - now
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            batch = self._pop_due(now)
+            try:
+                await self.handler(batch)
+            except Exception as e:
+                self.stats["errors"] += 1
+                print("scheduler handler failed:", repr(e))
+            self.stats["fired"] += len(batch)
+            self.stats["batches"] += 1
+
+            next_due = self._peek()
+            if next_due is not None and next_due <= time.time():
+                await asyncio.sleep(self.batch_interval)
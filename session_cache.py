@@ -0,0 +1,76 @@
+# session_cache.py
+# user_state / question_order / user_msg の前段に置くセッションキャッシュ（LRU + TTL）
+# 書き込みは db.py 側で DB と同時に反映（write-through）し、reset_* で無効化する。
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+MISSING = object()
+
+
+class SessionCache:
+    """
+    key -> value を最大 maxsize 件、最終書き込みから ttl 秒まで保持する。
+    - get  : 無ければ MISSING
+    - put  : 上書き（DBへ書いた値）
+    - fill : まだ無いときだけ入れる（DBから読んだ値。並行した put を古い値で潰さない）
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.stats["misses"] += 1
+                return MISSING
+            value, expires = item
+            if expires <= now:
+                del self._data[key]
+                self.stats["expirations"] += 1
+                self.stats["misses"] += 1
+                return MISSING
+            self._data.move_to_end(key)
+            self.stats["hits"] += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._store(key, value)
+
+    def fill(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            if key not in self._data:
+                self._store(key, value)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.stats["invalidations"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def _store(self, key: Hashable, value: Any) -> None:
+        # _lock を取った状態で呼ぶ
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"size": len(self._data), "maxsize": self.maxsize, **self.stats}
@@ -0,0 +1,194 @@
+# storage.py
+# セッション（進み具合・回答・出題順・案内メッセージ・回答の集計）の保存先の共通インターフェース
+# - SessionStore: db.py の公開関数が呼ぶ先。SQLite 版（db.SQLiteStore）とメモリ版（memory_store.MemoryStore）がある
+# - どちらの実装でも同じ結果になるように、戻り値の型・回答ベクトルの詰め方・出題順の作り方はここで共有する
+# 部屋・期限・相性リスト・meta は SQLite のまま（件数が少なく、バックエンドを切り替えても変わらない）
+
+import abc
+import functools
+import os
+import random
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+ORDER_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", "30000"))
+
+
+class AnswerResult(NamedTuple):
+    order: Sequence[int]
+    idx: int                   # 回答を保存した位置（受け付けなかったときは現在の state）
+    next_idx: int
+    completed: bool
+    message_id: Optional[int]
+    accepted: bool = True      # False: 押されたボタンの idx が現在の state と違った（古いボタン・連打）
+
+
+class AnswerStats(NamedTuple):
+    funnel: List[int]                     # funnel[k] = k 問目まで答えたセッション数（funnel[0] は開始数）
+    answers: Dict[int, Dict[str, int]]   # question_id -> {回答: 件数}
+
+
+class ArchiveResult(NamedTuple):
+    users: List[Tuple[int, int]]  # 移した (user_id, idx)
+    rows: int                     # 元のテーブル（メモリ版は要素）から消した件数
+
+
+# --- 回答ベクトル（1ユーザー1つ。question_id の位置に回答1文字を1バイトで、未回答は 0）---
+MAX_QUESTION_ID = 1023  # ベクトルの長さの上限（question_id + 1 バイト）
+
+
+def pack_answer(blob: bytes, question_id: int, answer: str) -> bytes:
+    if not 0 <= question_id <= MAX_QUESTION_ID:
+        raise ValueError(f"question id out of range: {question_id}")
+    code = answer.encode("utf-8")
+    if len(code) != 1 or code == b"\0":
+        raise ValueError(f"answer must be a single ASCII character: {answer!r}")
+    buf = bytearray(blob)
+    if len(buf) <= question_id:
+        buf.extend(bytes(question_id + 1 - len(buf)))
+    buf[question_id] = code[0]
+    return bytes(buf)
+
+
+def unpack_answers(blob: bytes) -> List[Tuple[int, str]]:
+    """[(question_id, answer), ...]（question_id 順）"""
+    return [(qid, chr(b)) for qid, b in enumerate(blob) if b]
+
+
+# 出題順は (シード, 質問バンクのバージョン) から決まる並べ替え。
+# 同じ組み合わせなら何度計算しても同じ順になるので、保存するのはシードだけ。
+# 質問バンクが変わると順番も変わる（旧バンクの順番は新しい質問 id と合わないため）
+@functools.lru_cache(maxsize=ORDER_CACHE_SIZE)
+def seed_order(seed: int, version: str, question_ids: Tuple[int, ...]) -> Tuple[int, ...]:
+    ids = list(question_ids)
+    random.Random(f"{version}:{seed}").shuffle(ids)
+    return tuple(ids)
+
+
+def new_order_seed() -> int:
+    # SQLite の INTEGER（符号つき 64bit）に収まる範囲
+    return random.getrandbits(64) - (1 << 63)
+
+
+class SessionStore(abc.ABC):
+    """
+    db.py の同名の公開関数と同じ引数・戻り値。
+    書き込みは呼び出しが返った時点で以降の読み取りに見える（永続化がいつ終わるかは実装による。flush() で待てる）
+    """
+
+    name = ""
+
+    # --- 進み具合 ---
+    @abc.abstractmethod
+    def get_state(self, user_id: int) -> int:
+        """無ければ 0 で作る"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_state(self, user_id: int, idx: int) -> None:
+        raise NotImplementedError
+
+    # --- 回答 ---
+    @abc.abstractmethod
+    def save_answer(self, user_id: int, question_id: int, answer: str) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def record_answer(self, user_id: int, idx: int, answer: str, question_ids: Sequence[int]) -> AnswerResult:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def load_answers(self, user_id: int) -> List[Tuple[int, str]]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_profile(self, user_id: int) -> Tuple[dict, dict]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def load_completed_profiles(self) -> List[Tuple[int, dict]]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def rebuild_profiles(self) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def reset_user(self, user_id: int) -> None:
+        raise NotImplementedError
+
+    # --- 集計 ---
+    @abc.abstractmethod
+    def get_user_counters(self) -> dict:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def check_user_counters(self) -> Tuple[dict, dict]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def count_total_users(self) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def count_completed_users(self, total_questions: int) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def count_inprogress_users(self, total_questions: int) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_answer_stats(self) -> AnswerStats:
+        raise NotImplementedError
+
+    # --- 出題順・案内メッセージ ---
+    @abc.abstractmethod
+    def get_or_create_order(self, user_id: int, question_ids: Sequence[int]) -> Sequence[int]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def reset_order(self, user_id: int) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_message_id(self, user_id: int) -> Optional[int]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_message_id(self, user_id: int, message_id: int) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def reset_message_id(self, user_id: int) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def start_session(self, user_id: int, question_ids: Sequence[int]) -> Sequence[int]:
+        raise NotImplementedError
+
+    # --- 古いセッションの整理 ---
+    @abc.abstractmethod
+    def find_stale_sessions(self, cutoff: float, limit: int) -> List[int]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def list_session_users(self) -> List[int]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def archive_sessions(self, user_ids: Sequence[int], reason: str) -> ArchiveResult:
+        raise NotImplementedError
+
+    # --- 永続化 ---
+    @abc.abstractmethod
+    def flush(self) -> None:
+        """ここまでの書き込みが永続化されるまで待つ"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def close(self) -> None:
+        """未永続化の分を書き出して止める（終了時）"""
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {"backend": self.name}
@@ -0,0 +1,26 @@
+# tests/conftest.py
+# リポジトリ直下のモジュールを import できるようにし、db.py を一時ファイルの DB に向ける
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    """
+    空の一時 DB を指した db モジュール（init_db は呼ばない）。
+    DB_WRITE_MODE は monkeypatch.setattr(db, "DB_WRITE_MODE", ...) で切り替える
+    """
+    import db
+    db.stop_writer()
+    db.close_all_connections()
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "test.db"))
+    monkeypatch.setattr(db, "STORAGE_BACKEND", "sqlite")
+    monkeypatch.setattr(db, "DB_WRITE_MODE", "sync")
+    yield db
+    db.stop_writer()
+    db.close_all_connections()
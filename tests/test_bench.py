@@ -0,0 +1,25 @@
+# tests/test_bench.py
+# bench.py の集計（nearest-rank のパーセンタイル）の境界
+
+from bench import percentile
+
+
+def test_percentile_nearest_rank_on_whole_ranks():
+    # q * n が整数のときはちょうどその順位（銀行丸めで1つずれないこと）
+    assert percentile([1.0, 2.0], 0.50) == 1.0
+    samples = [float(i) for i in range(1, 101)]
+    assert percentile(samples, 0.50) == 50.0
+    assert percentile(samples, 0.95) == 95.0
+    assert percentile(samples, 0.99) == 99.0
+
+
+def test_percentile_rounds_up_between_ranks():
+    samples = [1.0, 2.0, 3.0]
+    assert percentile(samples, 0.50) == 2.0   # 1.5 → 2番目
+    assert percentile(samples, 0.95) == 3.0
+
+
+def test_percentile_clamps():
+    assert percentile([], 0.5) == 0.0
+    assert percentile([7.0], 0.0) == 7.0
+    assert percentile([1.0, 2.0], 1.0) == 2.0
@@ -0,0 +1,153 @@
+# tests/test_interaction_gate.py
+# InteractionGate：再送の重複排除、ユーザーごとの直列化、メッセージ編集のまとめ方、覚えておく進み具合
+
+import asyncio
+import time
+
+import pytest
+
+from interaction_gate import DedupCache, InteractionGate
+from storage import AnswerResult
+
+
+def test_admit_drops_resent_interactions_until_forgotten():
+    gate = InteractionGate()
+    assert gate.admit(("interaction", 1))
+    assert not gate.admit(("interaction", 1))
+    assert gate.admit(("interaction", 2))
+    gate.forget(("interaction", 1))  # 処理に失敗したので再送を受け付ける
+    assert gate.admit(("interaction", 1))
+    assert gate.stats["admitted"] == 3 and gate.stats["duplicates"] == 1
+
+
+def test_dedup_cache_expires_and_bounds_its_size(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    cache = DedupCache(ttl=10.0, maxsize=3)
+    cache.add("a", 1)
+    now[0] += 5
+    for key in ("b", "c", "d"):
+        cache.add(key)
+    assert len(cache) == 3 and not cache.seen("a")  # 一番古いものから捨てる
+    assert cache.get("b") is True
+    now[0] += 10
+    assert not cache.seen("b") and cache.get("b", "gone") == "gone"
+
+
+def run_clicks(gate, user_id, clicks):
+    """clicks: [(key, 失敗させるか)]。同時に押して、送った編集の key を返す"""
+    sent = []
+
+    async def click(key, fail):
+        async with gate.turn(user_id) as turn:
+            await asyncio.sleep(0)
+
+            async def render():
+                if fail:
+                    raise RuntimeError("edit failed")
+                sent.append(key)
+
+            turn.render(render, key=key)
+
+    async def main():
+        return await asyncio.gather(*(click(k, f) for k, f in clicks), return_exceptions=True)
+
+    return sent, asyncio.run(main())
+
+
+def test_queued_clicks_send_only_the_last_edit():
+    gate = InteractionGate()
+    sent, _ = run_clicks(gate, 1, [("q1", False), ("q2", False), ("q3", False)])
+    # 1回目の編集は後ろのクリックが待っている間は送らず、最後の1回だけ送る
+    assert sent == ["q3"]
+    assert gate.stats["renders"] == 1 and gate.stats["coalesced"] == 2
+    assert gate.snapshot()["active_users"] == 0
+
+
+def test_already_shown_edit_is_not_sent_again():
+    gate = InteractionGate()
+    assert run_clicks(gate, 1, [("q1", False)])[0] == ["q1"]
+    assert run_clicks(gate, 1, [("q1", False)])[0] == []
+    assert run_clicks(gate, 1, [("q2", False)])[0] == ["q2"]
+
+
+def test_failed_edit_is_retried_by_the_next_click():
+    gate = InteractionGate()
+    sent, results = run_clicks(gate, 1, [("q1", True)])
+    assert sent == [] and isinstance(results[0], RuntimeError)
+    assert run_clicks(gate, 1, [("q1", False)])[0] == ["q1"]
+
+
+def test_turns_are_serialized_per_user_only():
+    gate = InteractionGate()
+    order = []
+
+    async def click(user_id, tag):
+        async with gate.turn(user_id):
+            order.append(("in", tag))
+            await asyncio.sleep(0.01)
+            order.append(("out", tag))
+
+    async def main():
+        await asyncio.gather(click(1, "a1"), click(1, "a2"), click(2, "b"))
+
+    asyncio.run(main())
+    a = [e for e in order if e[1].startswith("a")]
+    assert a == [("in", "a1"), ("out", "a1"), ("in", "a2"), ("out", "a2")]
+    assert order.index(("in", "b")) < order.index(("out", "a1"))
+
+
+@pytest.mark.parametrize("accepted", [True, False])
+def test_progress_is_tied_to_the_question_message(accepted):
+    gate = InteractionGate()
+    res = AnswerResult((5, 6, 7), 1 if accepted else 2, 2, False, 900, accepted)
+    gate.advance(1, res)
+    assert gate.progress(1, 900) == res
+    assert gate.progress(1, 901) is None   # 別の質問メッセージ（作り直したセッション）
+    assert gate.progress(1, None) is None
+    assert gate.progress(2, 900) is None
+    gate.reset(1)
+    assert gate.progress(1, 900) is None
+
+
+def test_stale_clicks_skip_the_db_and_rerender(fresh_db, monkeypatch):
+    # bot.on_interaction を bench.py の偽の Discord で通す
+    import bench
+    import bot
+    db = fresh_db
+    db.init_db()
+    bot.load_match_engine()
+    monkeypatch.setattr(bot, "interaction_gate", InteractionGate())
+    calls = []
+    record = bot.record_answer
+    monkeypatch.setattr(bot, "record_answer", lambda user_id, idx, *a: calls.append(idx) or record(user_id, idx, *a))
+
+    async def main():
+        rest = bench.FakeREST(1)
+        guild = bench.FakeGuild(rest)
+        bot.room_pool.replace_guild(guild.id, [])
+        member = bench.FakeMember(guild, 42, "u")
+        await bot.create_or_open_room(bench.FakeInteraction(rest, guild, member))
+        ch = guild.get_channel(bot.room_registry.channel_of(guild.id, 42))
+        msg = ch.question_message
+
+        def click(idx, key):
+            return bot.on_interaction(bench.FakeInteraction(rest, guild, member, ch, f"ans:42:{idx}:{key}", msg))
+
+        await asyncio.gather(click(0, "A"), click(0, "B"), click(0, "C"))  # 連打
+        assert calls == [0] and db.get_state(42) == 1
+        await click(0, "D")                                                # 古いボタン
+        assert calls == [0]
+
+        # 編集に失敗していた（表示されたことになっていない）なら、古いボタンでも今の質問を表示し直す
+        bot.interaction_gate._shown = DedupCache(60, 100)
+        msg.embed = None
+        await click(0, "D")
+        assert calls == [0] and msg.embed is not None
+
+        await click(1, "A")
+        assert calls == [0, 1] and db.get_state(42) == 2
+        bot.room_closer.stop()
+
+    asyncio.run(main())
+    assert bot.interaction_gate.stats["db_skipped"] == 4
@@ -0,0 +1,97 @@
+# tests/test_matching.py
+# MatchEngine の上位検索（索引・一括採点・保存用リスト）が全員との総当たりと一致するかの検算
+# ランダムなピック（未回答カテゴリあり・同率が多く出るようカテゴリは少なめ）で、
+# 追加・更新・削除を重ねた後と、一括の作り直し（rebuild_lists）の後を確かめる。
+
+import random
+from typing import Dict, List, Tuple
+
+import pytest
+
+from matching import MatchEngine, compatibility_percent
+
+CATEGORIES = ["c0", "c1", "c2", "c3", "c4"]
+LETTERS = "ABCDE"
+K = 3
+
+
+def random_picks(rng: random.Random) -> dict:
+    # 2割くらいは一部カテゴリが未回答
+    return {c: rng.choice(LETTERS) for c in CATEGORIES if rng.random() > 0.1}
+
+
+def brute_force(profiles: Dict[int, dict], user_id: int, k: int) -> List[Tuple[int, int]]:
+    me = profiles[user_id]
+    scored = [
+        (compatibility_percent(me, picks, CATEGORIES), uid)
+        for uid, picks in profiles.items() if uid != user_id
+    ]
+    scored.sort(key=lambda e: (-e[0], e[1]))
+    return scored[:k]
+
+
+def brute_force_all(profiles: Dict[int, dict]) -> Dict[int, List[Tuple[int, int]]]:
+    return {uid: brute_force(profiles, uid, K) for uid in profiles}
+
+
+def assert_matches_brute_force(engine: MatchEngine, expected: Dict[int, List[Tuple[int, int]]]) -> None:
+    assert engine.eligible == frozenset(expected)
+    for uid, want in expected.items():
+        assert engine.top_k(uid, K) == want, uid
+        assert engine.top_k_scan(uid, K) == want, uid
+        assert engine.list_of(uid) == want, uid
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_incremental_updates_match_brute_force(seed):
+    rng = random.Random(seed)
+    engine = MatchEngine(CATEGORIES, list_size=K)
+    profiles: Dict[int, dict] = {}
+    uids = rng.sample(range(1, 10_000), 300)
+
+    for step in range(1500):
+        roll = rng.random()
+        if roll < 0.6 or not profiles:
+            uid = rng.choice(uids)  # 既にいる人なら回答し直し（更新）
+            picks = random_picks(rng)
+            engine.upsert(uid, picks)
+            profiles[uid] = picks
+        else:
+            uid = rng.choice(sorted(profiles))
+            engine.remove(uid)
+            del profiles[uid]
+        if step % 250 == 0:
+            assert_matches_brute_force(engine, brute_force_all(profiles))
+
+    assert_matches_brute_force(engine, brute_force_all(profiles))
+
+
+@pytest.mark.parametrize("seed", [4, 5])
+def test_bulk_rebuild_matches_brute_force(seed):
+    rng = random.Random(seed)
+    # 初期容量（1024 行）を超えて行列の拡張も通す
+    profiles = {uid: random_picks(rng) for uid in rng.sample(range(1, 100_000), 1100)}
+    engine = MatchEngine(CATEGORIES, list_size=K)
+    engine.load(list(profiles.items()))
+    lists = engine.rebuild_lists()
+
+    expected = brute_force_all(profiles)
+    assert lists == expected
+    assert_matches_brute_force(engine, expected)
+
+    # 作り直したリストの上に追加・削除を重ねても総当たりと一致する
+    for uid in rng.sample(sorted(profiles), 100):
+        engine.remove(uid)
+        del profiles[uid]
+    for uid in rng.sample(range(100_000, 110_000), 100):
+        picks = random_picks(rng)
+        engine.upsert(uid, picks)
+        profiles[uid] = picks
+    expected = brute_force_all(profiles)
+    assert_matches_brute_force(engine, expected)
+
+    # 保存済みリストからの復元（load_lists）も同じ結果
+    restored = MatchEngine(CATEGORIES, list_size=K)
+    restored.load(list(profiles.items()))
+    assert restored.load_lists({uid: engine.list_of(uid) for uid in profiles})
+    assert_matches_brute_force(restored, expected)
@@ -0,0 +1,172 @@
+# tests/test_memory_store.py
+# MemoryStore の復元：スナップショット＋続きのログの再生、書きかけの最後の行（torn tail）、
+# 回答イベント（on_events）を落とさず二重にも渡さないこと
+
+import json
+import os
+
+import pytest
+
+from memory_store import LOG_PREFIX, MemoryStore
+from question_bank import BANK
+
+
+def open_store(directory, **kw) -> MemoryStore:
+    return MemoryStore(str(directory), fsync=False, **kw)
+
+
+def crash(store: MemoryStore) -> None:
+    """ログは書き終えたがスナップショットは取らずに止まった状態にする（close() を呼ばない終了）"""
+    store.flush()
+    with store._lock:
+        store._closing = True
+    store._wakeup.set()
+    store._thread.join()
+    store._thread = None
+    store._log.close()
+
+
+def contents(store: MemoryStore) -> dict:
+    users = store.list_session_users()
+    return {
+        "users": sorted(users),
+        "state": {uid: store.get_state(uid) for uid in users},
+        "answers": {uid: store.load_answers(uid) for uid in users},
+        "order": {uid: list(store.get_or_create_order(uid, BANK.ids)) for uid in users},
+        "msg": {uid: store.get_message_id(uid) for uid in users},
+        "counters": store.get_user_counters(),
+        "stats": store.get_answer_stats(),
+    }
+
+
+def fill(store: MemoryStore, users, answers: int) -> None:
+    for uid in users:
+        store.start_session(uid, BANK.ids)
+        store.set_message_id(uid, uid * 10)
+        for idx in range(answers):
+            store.record_answer(uid, idx, "ABCDE"[(uid + idx) % 5], BANK.ids)
+
+
+def db_down(rows, mark):
+    raise RuntimeError("db down")
+
+
+def latest_log(directory) -> str:
+    logs = sorted(n for n in os.listdir(directory) if n.startswith(LOG_PREFIX))
+    return os.path.join(directory, logs[-1])
+
+
+def test_recovers_from_log_only(tmp_path):
+    store = open_store(tmp_path)
+    fill(store, [1, 2], 5)
+    fill(store, [3], len(BANK))
+    store.reset_user(2)
+    want = contents(store)
+    crash(store)
+
+    again = open_store(tmp_path)
+    assert contents(again) == want
+    assert again.stats()["recovered_ops"] > 0
+    again.close()
+
+
+def test_recovers_from_snapshot_and_later_log(tmp_path):
+    store = open_store(tmp_path)
+    fill(store, [1, 2], 5)
+    store.snapshot()
+    fill(store, [4], 3)
+    store.record_answer(1, 5, "E", BANK.ids)
+    want = contents(store)
+    crash(store)
+
+    again = open_store(tmp_path)
+    assert contents(again) == want
+    # スナップショットより前のログは消えていて、後のログだけ再生する
+    assert again.stats()["recovered_ops"] == 6  # start_session・set_message_id・回答3件・回答1件
+    again.close()
+
+    # close() はスナップショットを取るので、次はログの再生なし
+    reopened = open_store(tmp_path)
+    assert contents(reopened) == want
+    assert reopened.stats()["recovered_ops"] == 0
+    reopened.close()
+
+
+def test_torn_tail_is_dropped(tmp_path):
+    store = open_store(tmp_path)
+    fill(store, [1], 4)
+    want = contents(store)
+    crash(store)
+
+    # 書いている途中で落ちた最後の1行（改行なし）
+    with open(latest_log(tmp_path), "ab") as f:
+        f.write(json.dumps(["r", 1, 4, BANK.ids[0], "A", 0.0]).encode()[:-5])
+
+    again = open_store(tmp_path)
+    assert contents(again) == want
+    assert again.stats()["torn_tail"] == 1
+    again.close()
+
+
+def test_corrupt_line_in_the_middle_is_an_error(tmp_path):
+    store = open_store(tmp_path)
+    fill(store, [1], 2)
+    crash(store)
+    path = latest_log(tmp_path)
+    with open(path, "rb") as f:
+        lines = f.read().split(b"\n")
+    lines[1] = lines[1][:-3]
+    with open(path, "wb") as f:
+        f.write(b"\n".join(lines))
+
+    with pytest.raises(ValueError):
+        open_store(tmp_path)
+
+
+def test_answer_events_are_exported_once_across_a_crash(tmp_path):
+    exported, marks = [], []
+
+    def on_events(rows, mark):
+        exported.extend(rows)
+        marks.append(mark)
+
+    store = open_store(tmp_path, on_events=on_events)
+    fill(store, [1], 3)
+    store.flush()
+    assert [(uid, pos, ans) for uid, _, pos, ans, _ in exported] == [(1, 0, "B"), (1, 1, "C"), (1, 2, "D")]
+
+    # 書き出し前に落ちた分：ログにはあるが on_events には渡っていない
+    store.on_events = db_down
+    store.record_answer(1, 3, "E", BANK.ids)
+    store.record_answer(1, 4, "A", BANK.ids)
+    crash(store)
+    assert store.stats()["events_pending"] == 2
+
+    again = open_store(tmp_path, on_events=on_events, events_mark=marks[-1])
+    again.flush()
+    assert [(uid, pos, ans) for uid, _, pos, ans, _ in exported][3:] == [(1, 3, "E"), (1, 4, "A")]
+    again.close()
+
+    # スナップショット後に開き直しても渡し直さない
+    n = len(exported)
+    reopened = open_store(tmp_path, on_events=on_events, events_mark=marks[-1])
+    reopened.flush()
+    assert len(exported) == n
+    reopened.close()
+
+
+def test_pending_events_survive_a_snapshot(tmp_path):
+    exported, marks = [], []
+    store = open_store(tmp_path, on_events=db_down)
+    fill(store, [1], 2)
+    store.snapshot()  # まだ渡せていない回答が入ったログはここで消える
+    crash(store)
+
+    def on_events(rows, mark):
+        exported.extend(rows)
+        marks.append(mark)
+
+    again = open_store(tmp_path, on_events=on_events)
+    again.flush()
+    assert [(uid, pos) for uid, _, pos, _, _ in exported] == [(1, 0), (1, 1)]
+    again.close()
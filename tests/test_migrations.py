@@ -0,0 +1,109 @@
+# tests/test_migrations.py
+# 元のスキーマ（user_version 0・1回答1行の answers）の DB に init_db をかけて、
+# m1〜m12（answers を answer_vectors に詰めて DROP する m9 を含む）の後も中身が変わらないかを見る
+
+import json
+import sqlite3
+
+import pytest
+
+from profiles import aggregate
+from question_bank import BANK
+
+COMPLETE, PARTIAL, BAD_ANSWER, NO_ANSWERS = 101, 102, 103, 104
+
+
+def legacy_db(path: str, answer_cols=("question_id", "answer")) -> dict:
+    """
+    migration 前の形（bot の初期版が作るテーブル）に4人分を入れる。
+    戻り値: user_id → 期待する回答 [(question_id, answer), ...]
+    """
+    qcol, acol = answer_cols
+    ids = list(BANK.ids)
+    con = sqlite3.connect(path)
+    con.executescript(f"""
+    CREATE TABLE user_state (user_id INTEGER PRIMARY KEY, idx INTEGER NOT NULL);
+    CREATE TABLE answers (
+        user_id INTEGER NOT NULL, {qcol} INTEGER NOT NULL, {acol} TEXT NOT NULL,
+        PRIMARY KEY (user_id, {qcol})
+    );
+    CREATE TABLE question_order (user_id INTEGER PRIMARY KEY, order_json TEXT NOT NULL);
+    CREATE TABLE user_msg (user_id INTEGER PRIMARY KEY, message_id INTEGER NOT NULL);
+    """)
+    expected = {
+        COMPLETE: [(qid, "ABCDE"[qid % 5]) for qid in ids],
+        PARTIAL: [(qid, "EDCBA"[qid % 5]) for qid in ids[:7]],
+        BAD_ANSWER: [(ids[0], "A"), (ids[2], "C")],
+        NO_ANSWERS: [],
+    }
+    rows = [(uid, qid, ans) for uid, answers in expected.items() for qid, ans in answers]
+    rows.append((BAD_ANSWER, ids[1], "AB"))  # 1文字でない回答は m9 で捨てる
+    con.executemany(f"INSERT INTO answers(user_id, {qcol}, {acol}) VALUES(?, ?, ?)", rows)
+    states = {COMPLETE: len(ids), PARTIAL: 7, BAD_ANSWER: 3, NO_ANSWERS: 0}
+    con.executemany("INSERT INTO user_state(user_id, idx) VALUES(?, ?)", list(states.items()))
+    con.executemany(
+        "INSERT INTO question_order(user_id, order_json) VALUES(?, ?)",
+        [(uid, json.dumps(ids[::-1])) for uid in expected],
+    )
+    con.execute("INSERT INTO user_msg(user_id, message_id) VALUES(?, ?)", (PARTIAL, 555))
+    con.commit()
+    con.close()
+    return expected
+
+
+@pytest.mark.parametrize("answer_cols", [("question_id", "answer"), ("qid", "ans")])
+def test_migrations_keep_legacy_sessions(fresh_db, answer_cols):
+    db = fresh_db
+    expected = legacy_db(db.DB_PATH, answer_cols)
+
+    db.init_db()
+    assert [v for v, _, _ in db.migration_report] == list(range(1, len(db.MIGRATIONS) + 1))
+
+    con = sqlite3.connect(db.DB_PATH)
+    assert con.execute("PRAGMA user_version").fetchone()[0] == len(db.MIGRATIONS)
+    tables = {name for (name,) in con.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    assert "answers" not in tables and "answer_vectors" in tables
+    assert con.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    con.close()
+
+    for uid, answers in expected.items():
+        assert db.load_answers(uid) == answers, uid
+        picks, meters = db.get_profile(uid)
+        want_picks, want_meters, _ = aggregate(answers)
+        if answers:
+            assert (picks, meters) == (want_picks, want_meters), uid
+        # シード導入前の出題順はリセットするまでそのまま
+        assert list(db.get_or_create_order(uid, BANK.ids)) == list(BANK.ids)[::-1], uid
+
+    assert db.get_state(PARTIAL) == 7
+    assert db.get_message_id(PARTIAL) == 555
+    assert db.get_message_id(COMPLETE) is None
+    assert db.get_user_counters() == {"total": 4, "completed": 1, "inprogress": 3}
+    assert [uid for uid, _ in db.load_completed_profiles()] == [COMPLETE]
+
+    stats = db.get_answer_stats()
+    assert stats.funnel[0] == 4 and stats.funnel[7] == 2 and stats.funnel[len(BANK)] == 1
+    want_counts: dict = {}
+    for answers in expected.values():
+        for qid, ans in answers:
+            want_counts.setdefault(qid, {}).setdefault(ans, 0)
+            want_counts[qid][ans] += 1
+    assert stats.answers == want_counts
+
+
+def test_init_db_is_idempotent(fresh_db):
+    db = fresh_db
+    expected = legacy_db(db.DB_PATH)
+    db.init_db()
+    db.init_db()
+    assert db.migration_report == []
+    assert db.load_answers(COMPLETE) == expected[COMPLETE]
+
+
+def test_new_database_needs_no_vacuum(fresh_db, capsys):
+    db = fresh_db
+    db.init_db()
+    assert "vacuumed" not in capsys.readouterr().out
+    con = sqlite3.connect(db.DB_PATH)
+    assert con.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    con.close()
@@ -0,0 +1,126 @@
+# tests/test_record_answer.py
+# record_answer（1クリック = 1トランザクション）の受け付け・拒否。
+# 連打（同じ idx）・古いボタン（前の idx）・同時クリックで state が二重に進まず、回答も集計も上書きされないこと
+
+import threading
+
+import pytest
+
+from question_bank import BANK
+
+USER = 42
+CONFIGS = [("sqlite", "sync"), ("sqlite", "group"), ("sqlite", "async"), ("memory", "sync")]
+
+
+@pytest.fixture(params=CONFIGS, ids=["-".join(c) for c in CONFIGS])
+def store(request, fresh_db, monkeypatch):
+    db = fresh_db
+    backend, mode = request.param
+    monkeypatch.setattr(db, "STORAGE_BACKEND", backend)
+    monkeypatch.setattr(db, "DB_WRITE_MODE", mode)
+    monkeypatch.setattr(db, "MEMORY_LOG_FSYNC", False)
+    db.init_db()
+    return db
+
+
+def answer_count(db, question_id: int) -> int:
+    return sum(db.get_answer_stats().answers.get(question_id, {}).values())
+
+
+def test_accepts_in_order_and_completes(store):
+    db = store
+    order = db.start_session(USER, BANK.ids)
+    for idx in range(len(order)):
+        res = db.record_answer(USER, idx, "ABCDE"[idx % 5], BANK.ids)
+        assert res.accepted
+        assert (res.idx, res.next_idx) == (idx, idx + 1)
+        assert res.completed == (idx + 1 == len(order))
+        assert list(res.order) == list(order)
+    assert db.get_state(USER) == len(order)
+    assert dict(db.load_answers(USER)) == {qid: "ABCDE"[i % 5] for i, qid in enumerate(order)}
+
+    # 完了後のクリックは受け付けない
+    res = db.record_answer(USER, len(order) - 1, "E", BANK.ids)
+    assert not res.accepted and res.completed and res.idx == len(order)
+
+
+def test_duplicate_and_stale_clicks_are_rejected(store):
+    db = store
+    order = db.start_session(USER, BANK.ids)
+    assert db.record_answer(USER, 0, "A", BANK.ids).accepted
+    assert db.record_answer(USER, 1, "B", BANK.ids).accepted
+
+    for idx, ans in ((1, "E"), (0, "E"), (5, "E"), (-1, "E"), (len(order), "E")):
+        res = db.record_answer(USER, idx, ans, BANK.ids)
+        assert not res.accepted, idx
+        assert (res.idx, res.next_idx, res.completed) == (2, 2, False), idx
+
+    db.flush()
+    assert db.get_state(USER) == 2
+    assert db.load_answers(USER) == sorted([(order[0], "A"), (order[1], "B")])
+    assert answer_count(db, order[0]) == 1 and answer_count(db, order[1]) == 1
+    assert db.get_answer_stats().funnel[1:3] == [1, 1]
+
+
+def test_concurrent_clicks_on_the_same_question_advance_once(store):
+    db = store
+    order = db.start_session(USER, BANK.ids)
+    results = []
+    barrier = threading.Barrier(8)
+
+    def click(ans):
+        barrier.wait()
+        results.append((ans, db.record_answer(USER, 0, ans, BANK.ids)))
+
+    threads = [threading.Thread(target=click, args=("ABCDEABC"[i],)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    accepted = [ans for ans, r in results if r.accepted]
+    assert len(accepted) == 1
+    assert all(r.idx == 1 for _, r in results if not r.accepted)
+    db.flush()
+    assert db.get_state(USER) == 1
+    assert db.load_answers(USER) == [(order[0], accepted[0])]
+    assert answer_count(db, order[0]) == 1
+
+
+def test_restarted_session_uses_the_new_order_and_message(store):
+    db = store
+    db.start_session(USER, BANK.ids)
+    db.set_message_id(USER, 1000)
+    assert db.record_answer(USER, 0, "A", BANK.ids).message_id == 1000  # order / message_id がキャッシュに載る
+
+    new_order = db.start_session(USER, BANK.ids)
+    res = db.record_answer(USER, 0, "C", BANK.ids)
+    assert res.accepted
+    assert list(res.order) == list(new_order)
+    assert res.message_id is None
+    assert db.load_answers(USER) == [(new_order[0], "C")]
+
+
+def test_restart_between_cache_read_and_write(store, monkeypatch):
+    # クリックの書き込みが順番待ちの間に start_session がコミットされても、新しいセッションで判定する
+    db = store
+    if db.STORAGE_BACKEND != "sqlite":
+        pytest.skip("SQLite の書き込み経路だけの話")
+    db.start_session(USER, BANK.ids)
+    db.set_message_id(USER, 1000)
+    db.record_answer(USER, 0, "A", BANK.ids)
+
+    restarted = []
+    write = db._write
+
+    def restart_first(user_id, fn, *args):
+        if fn is db._record_answer and not restarted:
+            restarted.append(db.start_session(USER, BANK.ids))
+        return write(user_id, fn, *args)
+
+    monkeypatch.setattr(db, "_write", restart_first)
+    res = db.record_answer(USER, 0, "C", BANK.ids)
+    assert res.accepted
+    assert list(res.order) == list(restarted[0])
+    assert res.message_id is None
+    assert db.load_answers(USER) == [(restarted[0][0], "C")]